@@ -0,0 +1,67 @@
+"""Lecturer stats
+
+Revision ID: 2b7d9e4c1a53
+Revises: fcce40051eaa
+Create Date: 2026-10-18 15:02:37.518204
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7d9e4c1a53'
+down_revision = 'fcce40051eaa'
+branch_labels = None
+depends_on = None
+
+
+# Средняя оценка: суммы, из которых она считается, и комментарий колонки
+MARKS = {
+    'mark_kindness': (('mark_kindness_sum',), 'Средняя оценка доброты'),
+    'mark_freebie': (('mark_freebie_sum',), 'Средняя оценка халявности'),
+    'mark_clarity': (('mark_clarity_sum',), 'Средняя оценка понятности'),
+    'mark_general': (('mark_kindness_sum', 'mark_freebie_sum', 'mark_clarity_sum'), 'Средняя общая оценка'),
+}
+
+
+def upgrade():
+    op.create_table(
+        'lecturer_stats',
+        sa.Column('lecturer_id', sa.Integer(), nullable=False, comment='Идентификатор преподавателя'),
+        sa.Column('comment_count', sa.Integer(), nullable=False, comment='Число опубликованных отзывов'),
+        sa.Column('mark_kindness_sum', sa.Integer(), nullable=False, comment='Сумма оценок доброты'),
+        sa.Column('mark_freebie_sum', sa.Integer(), nullable=False, comment='Сумма оценок халявности'),
+        sa.Column('mark_clarity_sum', sa.Integer(), nullable=False, comment='Сумма оценок понятности'),
+        *[
+            sa.Column(
+                mark,
+                sa.Float(),
+                sa.Computed(f"({' + '.join(sums)})::float8 / NULLIF({len(sums)} * comment_count, 0)", persisted=True),
+                nullable=True,
+                comment=comment,
+            )
+            for mark, (sums, comment) in MARKS.items()
+        ],
+        sa.ForeignKeyConstraint(['lecturer_id'], ['lecturer.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('lecturer_id'),
+    )
+    # Бэкфилл по уже опубликованным отзывам
+    op.execute(
+        """
+        INSERT INTO lecturer_stats (lecturer_id, comment_count, mark_kindness_sum, mark_freebie_sum, mark_clarity_sum)
+        SELECT lecturer_id, count(*), sum(mark_kindness), sum(mark_freebie), sum(mark_clarity)
+        FROM comment
+        WHERE review_status = 'APPROVED' AND NOT is_deleted
+        GROUP BY lecturer_id
+        """
+    )
+    for mark in MARKS:
+        op.create_index(f'ix_lecturer_stats_{mark}', 'lecturer_stats', [mark])
+
+
+def downgrade():
+    for mark in MARKS:
+        op.drop_index(f'ix_lecturer_stats_{mark}', table_name='lecturer_stats')
+    op.drop_table('lecturer_stats')
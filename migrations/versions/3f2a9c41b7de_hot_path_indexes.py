@@ -0,0 +1,55 @@
+"""Hot path indexes
+
+Revision ID: 3f2a9c41b7de
+Revises: d322e8331f91
+Create Date: 2026-10-18 10:12:41.513208
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '3f2a9c41b7de'
+down_revision = 'd322e8331f91'
+branch_labels = None
+depends_on = None
+
+
+APPROVED_COMMENT_CONDITION = sa.text("review_status = 'APPROVED' AND NOT is_deleted")
+
+
+def upgrade():
+    op.create_index('ix_lecturer_timetable_id', 'lecturer', ['timetable_id'])
+    op.create_index('ix_comment_lecturer_id', 'comment', ['lecturer_id'])
+    op.create_index(
+        'ix_comment_approved_lecturer_create_ts',
+        'comment',
+        ['lecturer_id', 'create_ts'],
+        postgresql_where=APPROVED_COMMENT_CONDITION,
+    )
+    op.create_index(
+        'ix_comment_approved_create_ts', 'comment', ['create_ts'], postgresql_where=APPROVED_COMMENT_CONDITION
+    )
+    op.create_index(
+        'ix_comment_user_id_create_ts', 'comment', ['user_id', 'create_ts'], postgresql_where=sa.text('NOT is_deleted')
+    )
+    op.create_index(
+        'ix_lecturer_user_comment_user_lecturer_update_ts',
+        'lecturer_user_comment',
+        ['user_id', 'lecturer_id', 'update_ts'],
+    )
+    op.create_index('ix_comment_reaction_comment_uuid_reaction', 'comment_reaction', ['comment_uuid', 'reaction'])
+    op.create_index('ix_comment_reaction_user_id_comment_uuid', 'comment_reaction', ['user_id', 'comment_uuid'])
+
+
+def downgrade():
+    op.drop_index('ix_comment_reaction_user_id_comment_uuid', table_name='comment_reaction')
+    op.drop_index('ix_comment_reaction_comment_uuid_reaction', table_name='comment_reaction')
+    op.drop_index('ix_lecturer_user_comment_user_lecturer_update_ts', table_name='lecturer_user_comment')
+    op.drop_index('ix_comment_user_id_create_ts', table_name='comment')
+    op.drop_index('ix_comment_approved_create_ts', table_name='comment')
+    op.drop_index('ix_comment_approved_lecturer_create_ts', table_name='comment')
+    op.drop_index('ix_comment_lecturer_id', table_name='comment')
+    op.drop_index('ix_lecturer_timetable_id', table_name='lecturer')
@@ -0,0 +1,43 @@
+"""Outbox event
+
+Revision ID: 6d1f3b8e2c47
+Revises: 2b7d9e4c1a53
+Create Date: 2026-10-18 17:41:09.802113
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '6d1f3b8e2c47'
+down_revision = '2b7d9e4c1a53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'outbox_event',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column(
+            'kind',
+            sa.Enum('FIRST_COMMENT_ACHIEVEMENT', name='outboxkind', native_enum=False),
+            nullable=False,
+            comment='Что надо сделать',
+        ),
+        sa.Column('payload', postgresql.JSONB(astext_type=sa.Text()), nullable=False, comment='Аргументы события'),
+        sa.Column('attempts', sa.Integer(), nullable=False, comment='Число неудачных попыток'),
+        sa.Column('last_error', sa.String(), nullable=True, comment='Ошибка последней попытки'),
+        sa.Column('create_ts', sa.DateTime(), nullable=False),
+        sa.Column('next_attempt_ts', sa.DateTime(), nullable=False, comment='Время следующей попытки'),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index('ix_outbox_event_next_attempt_ts', 'outbox_event', ['next_attempt_ts'])
+
+
+def downgrade():
+    op.drop_index('ix_outbox_event_next_attempt_ts', table_name='outbox_event')
+    op.drop_table('outbox_event')
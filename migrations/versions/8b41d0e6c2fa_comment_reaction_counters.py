@@ -0,0 +1,68 @@
+"""Comment reaction counters
+
+Revision ID: 8b41d0e6c2fa
+Revises: 3f2a9c41b7de
+Create Date: 2026-10-18 11:05:17.224861
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b41d0e6c2fa'
+down_revision = '3f2a9c41b7de'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'comment',
+        sa.Column(
+            'like_count',
+            sa.Integer(),
+            server_default='0',
+            nullable=False,
+            comment='Число лайков, обновляется в like_comment',
+        ),
+    )
+    op.add_column(
+        'comment',
+        sa.Column(
+            'dislike_count',
+            sa.Integer(),
+            server_default='0',
+            nullable=False,
+            comment='Число дизлайков, обновляется в like_comment',
+        ),
+    )
+    # Бэкфилл счетчиков по уже поставленным реакциям
+    op.execute(
+        """
+        UPDATE comment
+        SET like_count = reactions.like_count, dislike_count = reactions.dislike_count
+        FROM (
+            SELECT
+                comment_uuid,
+                count(*) FILTER (WHERE reaction = 'LIKE') AS like_count,
+                count(*) FILTER (WHERE reaction = 'DISLIKE') AS dislike_count
+            FROM comment_reaction
+            GROUP BY comment_uuid
+        ) AS reactions
+        WHERE comment.uuid = reactions.comment_uuid
+        """
+    )
+    op.create_index(
+        'ix_comment_like_dislike_diff',
+        'comment',
+        [sa.text('(like_count - dislike_count)')],
+        postgresql_where=sa.text('NOT is_deleted'),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_comment_like_dislike_diff', table_name='comment')
+    op.drop_column('comment', 'dislike_count')
+    op.drop_column('comment', 'like_count')
@@ -0,0 +1,51 @@
+"""Comment limit counter
+
+Revision ID: 9a4c7e215b3d
+Revises: 6d1f3b8e2c47
+Create Date: 2026-10-18 18:25:51.336940
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4c7e215b3d'
+down_revision = '6d1f3b8e2c47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'comment_limit_counter',
+        sa.Column('user_id', sa.Integer(), autoincrement=False, nullable=False, comment='Идентификатор пользователя'),
+        sa.Column(
+            'lecturer_id',
+            sa.Integer(),
+            autoincrement=False,
+            nullable=False,
+            comment='Идентификатор преподавателя, 0 - все преподаватели',
+        ),
+        sa.Column('month', sa.Date(), nullable=False, comment='Первое число месяца'),
+        sa.Column('count', sa.Integer(), nullable=False, comment='Число отзывов за месяц'),
+        sa.PrimaryKeyConstraint('user_id', 'lecturer_id', 'month'),
+    )
+    # Бэкфилл по записям, которые раньше подсчитывались при каждом отзыве
+    op.execute(
+        """
+        INSERT INTO comment_limit_counter (user_id, lecturer_id, month, count)
+        SELECT user_id, coalesce(lecturer_id, 0), date_trunc('month', update_ts)::date, count(*)
+        FROM lecturer_user_comment
+        WHERE NOT is_deleted AND lecturer_id IS NOT NULL
+        GROUP BY GROUPING SETS (
+            (user_id, lecturer_id, date_trunc('month', update_ts)),
+            (user_id, date_trunc('month', update_ts))
+        )
+        """
+    )
+
+
+def downgrade():
+    op.drop_table('comment_limit_counter')
@@ -0,0 +1,65 @@
+"""Lecturer stats total
+
+Revision ID: a3e81f5c92d4
+Revises: d7b2f95a04c1
+Create Date: 2026-10-20 11:26:03.417952
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3e81f5c92d4'
+down_revision = 'd7b2f95a04c1'
+branch_labels = None
+depends_on = None
+
+
+# Средняя оценка: суммы, из которых она считается, и комментарий колонки
+MARKS = {
+    'mark_kindness': (('mark_kindness_sum',), 'Средняя оценка доброты'),
+    'mark_freebie': (('mark_freebie_sum',), 'Средняя оценка халявности'),
+    'mark_clarity': (('mark_clarity_sum',), 'Средняя оценка понятности'),
+    'mark_general': (('mark_kindness_sum', 'mark_freebie_sum', 'mark_clarity_sum'), 'Средняя общая оценка'),
+}
+
+
+def upgrade():
+    op.create_table(
+        'lecturer_stats_total',
+        sa.Column('id', sa.Integer(), nullable=False, comment='Строка одна, id всегда 1'),
+        sa.Column('comment_count', sa.Integer(), nullable=False, comment='Число опубликованных отзывов'),
+        sa.Column('mark_kindness_sum', sa.Integer(), nullable=False, comment='Сумма оценок доброты'),
+        sa.Column('mark_freebie_sum', sa.Integer(), nullable=False, comment='Сумма оценок халявности'),
+        sa.Column('mark_clarity_sum', sa.Integer(), nullable=False, comment='Сумма оценок понятности'),
+        *[
+            sa.Column(
+                mark,
+                sa.Float(),
+                sa.Computed(f"({' + '.join(sums)})::float8 / NULLIF({len(sums)} * comment_count, 0)", persisted=True),
+                nullable=True,
+                comment=comment,
+            )
+            for mark, (sums, comment) in MARKS.items()
+        ],
+        sa.PrimaryKeyConstraint('id'),
+    )
+    # Единственная строка с суммами по уже опубликованным отзывам
+    op.execute(
+        """
+        INSERT INTO lecturer_stats_total (id, comment_count, mark_kindness_sum, mark_freebie_sum, mark_clarity_sum)
+        SELECT 1, coalesce(sum(comment_count), 0), coalesce(sum(mark_kindness_sum), 0),
+            coalesce(sum(mark_freebie_sum), 0), coalesce(sum(mark_clarity_sum), 0)
+        FROM lecturer_stats
+        """
+    )
+    op.create_index(
+        'ix_lecturer_mark_weighted', 'lecturer', ['mark_weighted'], postgresql_where=sa.text('NOT is_deleted')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_lecturer_mark_weighted', table_name='lecturer')
+    op.drop_table('lecturer_stats_total')
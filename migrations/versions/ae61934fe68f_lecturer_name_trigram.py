@@ -0,0 +1,46 @@
+"""Lecturer name trigram index
+
+Revision ID: ae61934fe68f
+Revises: 8b41d0e6c2fa
+Create Date: 2026-10-18 12:31:09.604112
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'ae61934fe68f'
+down_revision = '8b41d0e6c2fa'
+branch_labels = None
+depends_on = None
+
+
+SEARCH_NAME = "translate(lower(last_name || ' ' || first_name || ' ' || middle_name), 'Ёё', 'ее')"
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.add_column(
+        'lecturer',
+        sa.Column(
+            'search_name',
+            sa.String(),
+            sa.Computed(SEARCH_NAME, persisted=True),
+            nullable=False,
+            comment='ФИО для поиска: в нижнем регистре, ё заменена на е',
+        ),
+    )
+    op.create_index(
+        'ix_lecturer_search_name_trgm',
+        'lecturer',
+        ['search_name'],
+        postgresql_using='gin',
+        postgresql_ops={'search_name': 'gin_trgm_ops'},
+    )
+
+
+def downgrade():
+    op.drop_index('ix_lecturer_search_name_trgm', table_name='lecturer')
+    op.drop_column('lecturer', 'search_name')
@@ -0,0 +1,81 @@
+"""Lecturer stats total stripes
+
+Revision ID: b5d2e8f41c07
+Revises: e4c9a1d73b60
+Create Date: 2026-10-21 14:37:12.904618
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d2e8f41c07'
+down_revision = 'e4c9a1d73b60'
+branch_labels = None
+depends_on = None
+
+
+STRIPES = 16
+
+# Средняя оценка: суммы, из которых она считается, и комментарий колонки
+MARKS = {
+    'mark_kindness': (('mark_kindness_sum',), 'Средняя оценка доброты'),
+    'mark_freebie': (('mark_freebie_sum',), 'Средняя оценка халявности'),
+    'mark_clarity': (('mark_clarity_sum',), 'Средняя оценка понятности'),
+    'mark_general': (('mark_kindness_sum', 'mark_freebie_sum', 'mark_clarity_sum'), 'Средняя общая оценка'),
+}
+
+
+def upgrade():
+    # Средние по одной строке из нескольких не имеют смысла, их считает запрос по сумме строк
+    for mark in MARKS:
+        op.drop_column('lecturer_stats_total', mark)
+    op.alter_column(
+        'lecturer_stats_total',
+        'id',
+        existing_type=sa.Integer(),
+        comment='Номер строки: id преподавателя по модулю STRIPES',
+        existing_comment='Строка одна, id всегда 1',
+    )
+    op.execute('DELETE FROM lecturer_stats_total')
+    op.execute(
+        f"""
+        INSERT INTO lecturer_stats_total (id, comment_count, mark_kindness_sum, mark_freebie_sum, mark_clarity_sum)
+        SELECT lecturer_id % {STRIPES}, sum(comment_count), sum(mark_kindness_sum),
+            sum(mark_freebie_sum), sum(mark_clarity_sum)
+        FROM lecturer_stats
+        GROUP BY lecturer_id % {STRIPES}
+        """
+    )
+
+
+def downgrade():
+    op.execute('DELETE FROM lecturer_stats_total')
+    op.execute(
+        """
+        INSERT INTO lecturer_stats_total (id, comment_count, mark_kindness_sum, mark_freebie_sum, mark_clarity_sum)
+        SELECT 1, coalesce(sum(comment_count), 0), coalesce(sum(mark_kindness_sum), 0),
+            coalesce(sum(mark_freebie_sum), 0), coalesce(sum(mark_clarity_sum), 0)
+        FROM lecturer_stats
+        """
+    )
+    op.alter_column(
+        'lecturer_stats_total',
+        'id',
+        existing_type=sa.Integer(),
+        comment='Строка одна, id всегда 1',
+        existing_comment='Номер строки: id преподавателя по модулю STRIPES',
+    )
+    for mark, (sums, comment) in MARKS.items():
+        op.add_column(
+            'lecturer_stats_total',
+            sa.Column(
+                mark,
+                sa.Float(),
+                sa.Computed(f"({' + '.join(sums)})::float8 / NULLIF({len(sums)} * comment_count, 0)", persisted=True),
+                nullable=True,
+                comment=comment,
+            ),
+        )
@@ -0,0 +1,50 @@
+"""Review queue
+
+Revision ID: c58e0a7d3f16
+Revises: 9a4c7e215b3d
+Create Date: 2026-10-18 19:12:40.563817
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e0a7d3f16'
+down_revision = '9a4c7e215b3d'
+branch_labels = None
+depends_on = None
+
+
+PENDING_COMMENT_CONDITION = sa.text("review_status = 'PENDING' AND NOT is_deleted")
+
+
+def upgrade():
+    op.add_column(
+        'comment',
+        sa.Column(
+            'review_claimed_by',
+            sa.Integer(),
+            nullable=True,
+            comment='Модератор, которому отзыв выдан из очереди модерации',
+        ),
+    )
+    op.add_column(
+        'comment',
+        sa.Column(
+            'review_claimed_until',
+            sa.DateTime(),
+            nullable=True,
+            comment='До какого времени отзыв закреплен за модератором',
+        ),
+    )
+    op.create_index(
+        'ix_comment_pending_create_ts', 'comment', ['create_ts'], postgresql_where=PENDING_COMMENT_CONDITION
+    )
+
+
+def downgrade():
+    op.drop_index('ix_comment_pending_create_ts', table_name='comment')
+    op.drop_column('comment', 'review_claimed_until')
+    op.drop_column('comment', 'review_claimed_by')
@@ -0,0 +1,44 @@
+"""Outbox event status
+
+Revision ID: d7b2f95a04c1
+Revises: c58e0a7d3f16
+Create Date: 2026-10-19 10:04:27.118530
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7b2f95a04c1'
+down_revision = 'c58e0a7d3f16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'outbox_event',
+        sa.Column(
+            'status',
+            sa.Enum('PENDING', 'FAILED', name='outboxstatus', native_enum=False),
+            nullable=False,
+            server_default='PENDING',
+            comment='PENDING - надо выполнить, FAILED - попытки исчерпаны',
+        ),
+    )
+    op.alter_column('outbox_event', 'status', server_default=None)
+    op.drop_index('ix_outbox_event_next_attempt_ts', table_name='outbox_event')
+    op.create_index(
+        'ix_outbox_event_pending_next_attempt_ts',
+        'outbox_event',
+        ['next_attempt_ts'],
+        postgresql_where=sa.text("status = 'PENDING'"),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_outbox_event_pending_next_attempt_ts', table_name='outbox_event')
+    op.create_index('ix_outbox_event_next_attempt_ts', 'outbox_event', ['next_attempt_ts'])
+    op.drop_column('outbox_event', 'status')
@@ -0,0 +1,56 @@
+"""Outbox event key
+
+Revision ID: e4c9a1d73b60
+Revises: a3e81f5c92d4
+Create Date: 2026-10-21 09:12:44.530271
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4c9a1d73b60'
+down_revision = 'a3e81f5c92d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        'outbox_event',
+        sa.Column(
+            'key',
+            sa.String(),
+            nullable=True,
+            comment='Пока ждет выполнения событие того же вида с этим ключом, такое же не добавляется',
+        ),
+    )
+    op.execute(
+        """
+        UPDATE outbox_event SET key = payload->>'user_id'
+        WHERE kind = 'FIRST_COMMENT_ACHIEVEMENT'
+        """
+    )
+    # Из ждущих повторов остается самое раннее событие
+    op.execute(
+        """
+        DELETE FROM outbox_event AS duplicate
+        USING outbox_event AS earliest
+        WHERE duplicate.status = 'PENDING' AND earliest.status = 'PENDING'
+            AND duplicate.kind = earliest.kind AND duplicate.key = earliest.key AND duplicate.id > earliest.id
+        """
+    )
+    op.create_index(
+        'ix_outbox_event_pending_kind_key',
+        'outbox_event',
+        ['kind', 'key'],
+        unique=True,
+        postgresql_where=sa.text("status = 'PENDING'"),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_outbox_event_pending_kind_key', table_name='outbox_event')
+    op.drop_column('outbox_event', 'key')
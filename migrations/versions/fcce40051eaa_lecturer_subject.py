@@ -0,0 +1,69 @@
+"""Lecturer subject
+
+Revision ID: fcce40051eaa
+Revises: ae61934fe68f
+Create Date: 2026-10-18 13:20:44.187315
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'fcce40051eaa'
+down_revision = 'ae61934fe68f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'lecturer_subject',
+        sa.Column('lecturer_id', sa.Integer(), nullable=False, comment='Идентификатор преподавателя'),
+        sa.Column('subject', sa.String(), nullable=False, comment='Предмет, как он указан в отзывах'),
+        sa.Column(
+            'search_subject',
+            sa.String(),
+            sa.Computed("translate(lower(subject), 'Ёё', 'ее')", persisted=True),
+            nullable=False,
+            comment='Предмет для поиска: в нижнем регистре, ё заменена на е',
+        ),
+        sa.Column(
+            'comment_count',
+            sa.Integer(),
+            nullable=False,
+            comment='Число опубликованных отзывов к преподавателю с этим предметом',
+        ),
+        sa.ForeignKeyConstraint(['lecturer_id'], ['lecturer.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('lecturer_id', 'subject'),
+    )
+    # Бэкфилл по уже опубликованным отзывам
+    op.execute(
+        """
+        INSERT INTO lecturer_subject (lecturer_id, subject, comment_count)
+        SELECT lecturer_id, subject, count(*)
+        FROM comment
+        WHERE review_status = 'APPROVED' AND NOT is_deleted AND subject IS NOT NULL
+        GROUP BY lecturer_id, subject
+        """
+    )
+    op.create_index(
+        'ix_lecturer_subject_search_subject',
+        'lecturer_subject',
+        ['search_subject'],
+        postgresql_ops={'search_subject': 'text_pattern_ops'},
+    )
+    op.create_index(
+        'ix_lecturer_subject_search_subject_trgm',
+        'lecturer_subject',
+        ['search_subject'],
+        postgresql_using='gin',
+        postgresql_ops={'search_subject': 'gin_trgm_ops'},
+    )
+
+
+def downgrade():
+    op.drop_index('ix_lecturer_subject_search_subject_trgm', table_name='lecturer_subject')
+    op.drop_index('ix_lecturer_subject_search_subject', table_name='lecturer_subject')
+    op.drop_table('lecturer_subject')
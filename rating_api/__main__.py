@@ -1,7 +1,35 @@
+import argparse
+import asyncio
+
 import uvicorn
 
+from rating_api.models import Comment
 from rating_api.routes.base import app
+from rating_api.settings import get_settings
+from rating_api.utils.db import db
+
+
+async def rebuild_stats() -> None:
+    """Пересобирает данные по опубликованным отзывам: предметы и статистику преподавателей"""
+    db.configure(str(get_settings().DB_DSN))
+    try:
+        async with db():
+            await Comment.rebuild_published(session=db.session)
+            await db.session.commit()
+    finally:
+        await db.dispose()
 
 
 if __name__ == '__main__':
-    uvicorn.run(app)
+    parser = argparse.ArgumentParser(prog="python -m rating_api")
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["run", "rebuild-stats"],
+        default="run",
+        help="run - запустить приложение, rebuild-stats - пересобрать lecturer_subject и lecturer_stats по отзывам",
+    )
+    if parser.parse_args().command == "rebuild-stats":
+        asyncio.run(rebuild_stats())
+    else:
+        uvicorn.run(app)
@@ -1,3 +1,4 @@
+import datetime
 from typing import Type
 
 
@@ -87,3 +88,27 @@ class UpdateError(RatingAPIError):
             f"{msg} Conflict with update a resource that already exists or has conflicting information.",
             f"{msg} Конфликт с обновлением ресурса, который уже существует или имеет противоречивую информацию.",
         )
+
+
+class CommentClaimed(RatingAPIError):
+    def __init__(self, moderator_id: int, until: datetime.datetime):
+        super().__init__(
+            f"The comment is claimed for review by moderator {moderator_id} until {until.isoformat()}",
+            f"Отзыв закреплен за модератором {moderator_id} до {until.isoformat()}",
+        )
+
+
+class InvalidCursor(RatingAPIError):
+    def __init__(self):
+        super().__init__(
+            "Invalid cursor. Request the first page again with the same sorting",
+            "Некорректный курсор. Запросите первую страницу заново с той же сортировкой",
+        )
+
+
+class WrongImportFormat(RatingAPIError):
+    def __init__(self):
+        super().__init__(
+            "Import payload must be NDJSON, optionally compressed with gzip",
+            "Данные для импорта должны быть в формате NDJSON, возможно сжатом gzip",
+        )
@@ -2,8 +2,9 @@ from __future__ import annotations
 
 import re
 
-from sqlalchemy import not_
+from sqlalchemy import Select, not_, select
 from sqlalchemy.exc import NoResultFound
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Query, Session, as_declarative, declared_attr
 
 from rating_api.exceptions import ObjectNotFound, UpdateError
@@ -61,7 +62,12 @@ class BaseDbModel(Base):
     @classmethod
     def update(cls, id: int | str, *, session: Session, **kwargs) -> BaseDbModel:
         obj = cls.get(id, session=session)
+        cls._apply_changes(obj, **kwargs)
+        session.flush()
+        return obj
 
+    @staticmethod
+    def _apply_changes(obj: BaseDbModel, **kwargs) -> None:
         # Технические поля не проверяются при update комментария
         technical_fields = {'update_ts', 'review_status'}
 
@@ -80,9 +86,6 @@ class BaseDbModel(Base):
         for k, v in kwargs.items():
             setattr(obj, k, v)
 
-        session.flush()
-        return obj
-
     @classmethod
     def delete(cls, id: int | str, *, session: Session) -> None:
         """Soft delete object if possible, else hard delete"""
@@ -92,3 +95,54 @@ class BaseDbModel(Base):
         else:
             session.delete(obj)
         session.flush()
+
+    @classmethod
+    async def acreate(cls, *, session: AsyncSession, **kwargs) -> BaseDbModel:
+        obj = cls(**kwargs)
+        session.add(obj)
+        await session.flush()
+        # Подгружаем server defaults и связи, ленивая загрузка в async недоступна
+        await session.refresh(obj)
+        return obj
+
+    @classmethod
+    def aquery(cls, *, with_deleted: bool = False) -> Select:
+        """Select statement with soft deletes for AsyncSession"""
+        objs = select(cls)
+        if not with_deleted and hasattr(cls, "is_deleted"):
+            objs = objs.where(not_(cls.is_deleted))
+        return objs
+
+    @classmethod
+    async def aget(
+        cls, id: int | str, *, with_deleted=False, for_update: bool = False, session: AsyncSession
+    ) -> BaseDbModel:
+        """Get object with soft deletes. `for_update` locks the row until the end of the transaction"""
+        objs = cls.aquery(with_deleted=with_deleted)
+        if hasattr(cls, "uuid"):
+            objs = objs.where(cls.uuid == id)
+        else:
+            objs = objs.where(cls.id == id)
+        if for_update:
+            objs = objs.with_for_update()
+        try:
+            return (await session.scalars(objs)).one()
+        except NoResultFound:
+            raise ObjectNotFound(cls, id)
+
+    @classmethod
+    async def aupdate(cls, id: int | str, *, session: AsyncSession, **kwargs) -> BaseDbModel:
+        obj = await cls.aget(id, session=session)
+        cls._apply_changes(obj, **kwargs)
+        await session.flush()
+        return obj
+
+    @classmethod
+    async def adelete(cls, id: int | str, *, session: AsyncSession) -> None:
+        """Soft delete object if possible, else hard delete"""
+        obj = await cls.aget(id, session=session)
+        if hasattr(obj, "is_deleted"):
+            obj.is_deleted = True
+        else:
+            await session.delete(obj)
+        await session.flush()
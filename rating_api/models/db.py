@@ -3,32 +3,56 @@ from __future__ import annotations
 import datetime
 import logging
 import uuid
+from collections import Counter, defaultdict
 from enum import Enum
+from typing import Any, Iterable, NamedTuple
 
 from sqlalchemy import (
     UUID,
     Boolean,
+    ColumnElement,
+    Computed,
+    Date,
     DateTime,
 )
 from sqlalchemy import Enum as DbEnum
 from sqlalchemy import (
     Float,
     ForeignKey,
+    Index,
     Integer,
+    Row,
+    ScalarSelect,
     String,
+    Subquery,
     UnaryExpression,
     and_,
-    case,
+    cast,
+    column,
+    delete,
     desc,
     func,
+    insert,
+    literal,
+    not_,
     nulls_last,
     or_,
     select,
+    text,
     true,
+    tuple_,
+    update,
+    values,
 )
+from sqlalchemy.dialects.postgresql import JSONB, aggregate_order_by
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
-from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy.orm.attributes import InstrumentedAttribute
+from sqlalchemy.orm import Mapped, aliased, mapped_column, relationship
+from sqlalchemy.orm.attributes import InstrumentedAttribute, set_committed_value
+from sqlalchemy.sql import Executable
+
+from rating_api.utils.mark import calc_weighted_mark
 
 from .base import BaseDbModel
 
@@ -42,14 +66,52 @@ class ReviewStatus(str, Enum):
     DISMISSED: str = "dismissed"
 
 
+# Условие частичных индексов по опубликованным отзывам. Enum хранится в БД по имени
+APPROVED_COMMENT_CONDITION = text("review_status = 'APPROVED' AND NOT is_deleted")
+# Условие частичного индекса очереди модерации
+PENDING_COMMENT_CONDITION = text("review_status = 'PENDING' AND NOT is_deleted")
+
+
+def normalize_search_text(value: str) -> str:
+    """Приводит строку поиска к виду колонок `Lecturer.search_name` и `LecturerSubject.search_subject`:
+    нижний регистр, ё заменена на е"""
+    return value.lower().replace("ё", "е")
+
+
 class Lecturer(BaseDbModel):
+    __table_args__ = (
+        Index("ix_lecturer_timetable_id", "timetable_id"),
+        # Место преподавателя считается по этому индексу, см. `current_rank`
+        Index("ix_lecturer_mark_weighted", "mark_weighted", postgresql_where=text("NOT is_deleted")),
+        Index(
+            "ix_lecturer_search_name_trgm",
+            "search_name",
+            postgresql_using="gin",
+            postgresql_ops={"search_name": "gin_trgm_ops"},
+        ),
+    )
+
     id: Mapped[int] = mapped_column(Integer, primary_key=True, comment="Идентификатор преподавателя")
     first_name: Mapped[str] = mapped_column(String, nullable=False, comment="Имя препода")
     last_name: Mapped[str] = mapped_column(String, nullable=False, comment="Фамилия препода")
     middle_name: Mapped[str] = mapped_column(String, nullable=False, comment="Отчество препода")
     avatar_link: Mapped[str] = mapped_column(String, nullable=True, comment="Ссылка на аву препода")
+    search_name: Mapped[str] = mapped_column(
+        String,
+        Computed("translate(lower(last_name || ' ' || first_name || ' ' || middle_name), 'Ёё', 'ее')", persisted=True),
+        nullable=False,
+        comment="ФИО для поиска: в нижнем регистре, ё заменена на е",
+    )
     timetable_id: Mapped[int]
-    comments: Mapped[list[Comment]] = relationship("Comment", back_populates="lecturer")
+    # Связи не грузятся неявно: ручки явно подключают selectinload, иначе список пуст
+    comments: Mapped[list[Comment]] = relationship("Comment", back_populates="lecturer", lazy="noload")
+    approved_comments: Mapped[list[Comment]] = relationship(
+        "Comment",
+        primaryjoin=lambda: and_(Comment.lecturer_id == Lecturer.id, Comment.is_approved),
+        order_by=lambda: Comment.create_ts.desc(),
+        viewonly=True,
+        lazy="noload",
+    )
     mark_weighted: Mapped[float] = mapped_column(
         Float,
         nullable=False,
@@ -66,6 +128,7 @@ class Lecturer(BaseDbModel):
     mark_freebie_weighted: Mapped[float] = mapped_column(
         Float, nullable=False, server_default='0.0', default=0, comment="Взвешенная оценка халявности, посчитана в dwh"
     )
+    # Снимок места на момент импорта или полного пересчета. В ответах ручек место считает `current_rank`
     rank: Mapped[int] = mapped_column(
         Integer, nullable=False, server_default='0', default=0, comment="Место в рейтинге, посчитана в dwh"
     )
@@ -81,29 +144,41 @@ class Lecturer(BaseDbModel):
         Boolean, nullable=False, default=False, comment="Идентификатор софт делита"
     )
 
+    # Средняя оценка в lecturer_stats и соответствующая ей взвешенная оценка преподавателя
+    WEIGHTED_MARKS = {
+        "mark_kindness": "mark_kindness_weighted",
+        "mark_freebie": "mark_freebie_weighted",
+        "mark_clarity": "mark_clarity_weighted",
+        "mark_general": "mark_weighted",
+    }
+
     @hybrid_method
     def search_by_name(self, query: str) -> bool:
-        response = true
-        query = query.split(' ')
-        for q in query:
-            q = q.lower()
+        # Каждое слово запроса должно быть подстрокой ФИО или быть похожим на слово из ФИО (опечатки).
+        # Оба условия идут по триграммному индексу ix_lecturer_search_name_trgm. Шаблон LIKE передается
+        # целиком, а не склеивается в SQL: иначе в подготовленном запросе с общим планом индекс не используется
+        response = true()
+        for token in normalize_search_text(query).split():
             response = and_(
                 response,
-                or_(
-                    func.lower(self.first_name).contains(q),
-                    func.lower(self.middle_name).contains(q),
-                    func.lower(self.last_name).contains(q),
-                ),
+                or_(self.search_name.like(f"%{token}%"), literal(token).bool_op("<<%")(self.search_name)),
             )
         return response
 
     @hybrid_method
     def search_by_subject(self, query: str) -> bool:
-        query = query.lower()
-        response = true
-        if query:
-            response = and_(Comment.review_status == ReviewStatus.APPROVED, func.lower(Comment.subject).contains(query))
-        return response
+        query = normalize_search_text(query)
+        if not query:
+            return true()
+        # Предметы ищутся по триграммному индексу lecturer_subject, отзывы не сканируются
+        return Lecturer.id.in_(select(LecturerSubject.lecturer_id).where(LecturerSubject.matches(query)))
+
+    @hybrid_method
+    def search_by_mark(self, mark: float | None) -> bool:
+        if mark is None:
+            return true()
+        # Средняя общая оценка хранится в lecturer_stats, условие идет по индексу ix_lecturer_stats_mark_general
+        return Lecturer.id.in_(select(LecturerStats.lecturer_id).where(LecturerStats.mark_general > mark))
 
     @hybrid_method
     def order_by_mark(
@@ -120,19 +195,200 @@ class Lecturer(BaseDbModel):
         elif "rank" in query:
             expression = self.rank
         else:
-            expression = func.avg(getattr(Comment, query)).filter(Comment.review_status == ReviewStatus.APPROVED)
+            # Средние берутся из lecturer_stats по первичному ключу, отзывы при сортировке не агрегируются
+            expression = (
+                select(getattr(LecturerStats, query))
+                .where(LecturerStats.lecturer_id == Lecturer.id)
+                .correlate(Lecturer)
+                .scalar_subquery()
+            )
         if not asc_order:
             expression = expression.desc()
         return nulls_last(expression), Lecturer.last_name, Lecturer.id
 
+    @classmethod
+    def current_rank(cls) -> ScalarSelect[int]:
+        """
+        Подзапрос с местом одного преподавателя по текущей `mark_weighted`
+
+        Место - 1 + число неудаленных преподавателей с большей оценкой, как у `rank()`: равные оценки делят место.
+        Считается по индексу ix_lecturer_mark_weighted за число преподавателей выше, поэтому подходит для запросов
+        одного преподавателя. Для списков места считает `ranking` один раз на запрос
+        """
+        higher = aliased(cls, name="higher")
+        return (
+            select(func.count() + 1)
+            .where(not_(higher.is_deleted), higher.mark_weighted > cls.mark_weighted)
+            .correlate(cls)
+            .scalar_subquery()
+        )
+
+    @classmethod
+    def ranking(cls) -> Subquery:
+        """
+        Места всех неудаленных преподавателей по текущей `mark_weighted`, `rank()` за один проход
+        по ix_lecturer_mark_weighted. Совпадают с `current_rank`, присоединяется к запросу списка по `id`
+        """
+        return (
+            select(cls.id, func.rank().over(order_by=cls.mark_weighted.desc()).label("rank"))
+            .where(not_(cls.is_deleted))
+            .subquery("ranking")
+        )
+
     @hybrid_method
     def order_by_name(
         self, query: str, asc_order: bool
     ) -> tuple[UnaryExpression[str] | InstrumentedAttribute, InstrumentedAttribute]:
         return (getattr(Lecturer, query) if asc_order else getattr(Lecturer, query).desc()), Lecturer.id
 
+    @hybrid_method
+    def order_by_relevance(
+        self, query: str, asc_order: bool
+    ) -> tuple[UnaryExpression[float] | ColumnElement[float], InstrumentedAttribute, InstrumentedAttribute]:
+        tokens = normalize_search_text(query).split()
+        if not tokens:
+            return self.order_by_name("last_name", asc_order)
+        # Сумма по словам запроса расстояний 1 - strict_word_similarity: чем меньше, тем ближе ФИО к запросу
+        distances = [1 - func.strict_word_similarity(token, Lecturer.search_name, type_=Float) for token in tokens]
+        expression = sum(distances[1:], distances[0])
+        return (expression if asc_order else expression.desc()), Lecturer.last_name, Lecturer.id
+
+    # Колонки, которые пишет импорт рейтинга из DWH. ФИО и остальные поля в выгрузке только для сверки
+    RATING_FIELDS = (
+        "mark_weighted",
+        "mark_kindness_weighted",
+        "mark_clarity_weighted",
+        "mark_freebie_weighted",
+        "rank",
+        "rank_update_ts",
+    )
+
+    @classmethod
+    async def bulk_update_rating(cls, ratings: list[dict[str, Any]], *, session: AsyncSession) -> set[int]:
+        """
+        Обновляет рейтинги пачки преподавателей одним `UPDATE ... FROM (VALUES ...)`
+
+        Пишутся только `RATING_FIELDS`, остальные поля игнорируются. Удаленные преподаватели не обновляются.
+        Возвращает id обновленных преподавателей
+        """
+        if not ratings:
+            return set()
+        fields = ["id", *(field for field in cls.RATING_FIELDS if field in ratings[0])]
+        rating = values(*[column(field, cls.__table__.c[field].type) for field in fields], name="rating").data(
+            [tuple(row[field] for field in fields) for row in ratings]
+        )
+        updated_ids = await session.scalars(
+            update(cls)
+            .where(cls.id == rating.c.id, not_(cls.is_deleted))
+            .values({field: rating.c[field] for field in fields if field != "id"})
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        )
+        return set(updated_ids)
+
+    @classmethod
+    async def update_weighted_marks(
+        cls, lecturer_ids: list[int] | None = None, *, session: AsyncSession
+    ) -> dict[int, float]:
+        """
+        Пересчитывает взвешенные оценки всех или указанных неудаленных преподавателей по lecturer_stats
+
+        Оценка по шкале - `calc_weighted_mark` от средней оценки преподавателя, числа его опубликованных отзывов
+        и средней оценки по всем опубликованным отзывам из lecturer_stats_total. Без `lecturer_ids` пересчитывает
+        всех одним UPDATE и заново записывает снимок `rank`, так раз в интервал оценки выравнивает
+        `WeightedMarksRefresher`. Возвращает новые `mark_weighted`
+        """
+        if lecturer_ids is not None and not lecturer_ids:
+            return {}
+        means = LecturerStatsTotal.means()
+        totals = select(*[func.coalesce(means.c[mark], 0).label(mark) for mark in cls.WEIGHTED_MARKS]).subquery(
+            "totals"
+        )
+        source = (
+            select(
+                cls.id,
+                func.coalesce(LecturerStats.comment_count, 0).label("comment_count"),
+                *[func.coalesce(getattr(LecturerStats, mark), 0).label(mark) for mark in cls.WEIGHTED_MARKS],
+                *[totals.c[mark].label(f"mean_{mark}") for mark in cls.WEIGHTED_MARKS],
+            )
+            .outerjoin(LecturerStats, LecturerStats.lecturer_id == cls.id)
+            .join(totals, true())
+            .where(not_(cls.is_deleted))
+        )
+        if lecturer_ids is not None:
+            source = source.where(cls.id.in_(lecturer_ids))
+        source = source.subquery("source")
+        updated = await session.execute(
+            update(cls)
+            .where(cls.id == source.c.id)
+            .values(
+                {
+                    weighted: calc_weighted_mark(source.c[mark], source.c.comment_count, source.c[f"mean_{mark}"])
+                    for mark, weighted in cls.WEIGHTED_MARKS.items()
+                }
+            )
+            .returning(cls.id, cls.mark_weighted)
+            .execution_options(synchronize_session=False)
+        )
+        marks = dict(updated.all())
+        if lecturer_ids is None:
+            ranked = (
+                select(cls.id, func.rank().over(order_by=cls.mark_weighted.desc()).label("rank"))
+                .where(not_(cls.is_deleted))
+                .subquery("ranked")
+            )
+            await session.execute(
+                update(cls)
+                .where(cls.id == ranked.c.id)
+                .values(rank=ranked.c.rank, rank_update_ts=datetime.datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+        return marks
+
+    @classmethod
+    async def version_stamp(cls, id: int, *, session: AsyncSession) -> Row | None:
+        """
+        Версия данных преподавателя и его опубликованных отзывов одним запросом по индексу
+
+        Меняется при изменении полей преподавателя, его рейтинга и места `current_rank`, при редактировании,
+        публикации и удалении отзывов и при изменении их реакций: ручки, меняющие отзыв, обновляют его `update_ts`.
+        Место доступно как `current_rank`. `None`, если преподаватель не найден
+        """
+        stamp = await session.execute(
+            select(
+                *cls.__table__.c,
+                cls.current_rank().label("current_rank"),
+                func.max(Comment.update_ts),
+                func.count(Comment.uuid),
+                func.sum(Comment.like_count),
+                func.sum(Comment.dislike_count),
+            )
+            .outerjoin(Comment, and_(Comment.lecturer_id == cls.id, Comment.is_approved))
+            .where(cls.id == id, not_(cls.is_deleted))
+            .group_by(cls.id)
+        )
+        return stamp.one_or_none()
+
 
 class Comment(BaseDbModel):
+    __table_args__ = (
+        Index("ix_comment_lecturer_id", "lecturer_id"),
+        Index(
+            "ix_comment_approved_lecturer_create_ts",
+            "lecturer_id",
+            "create_ts",
+            postgresql_where=APPROVED_COMMENT_CONDITION,
+        ),
+        Index("ix_comment_approved_create_ts", "create_ts", postgresql_where=APPROVED_COMMENT_CONDITION),
+        Index("ix_comment_user_id_create_ts", "user_id", "create_ts", postgresql_where=text("NOT is_deleted")),
+        Index(
+            "ix_comment_like_dislike_diff",
+            text("(like_count - dislike_count)"),
+            postgresql_where=text("NOT is_deleted"),
+        ),
+        Index("ix_comment_pending_create_ts", "create_ts", postgresql_where=PENDING_COMMENT_CONDITION),
+    )
+
     uuid: Mapped[uuid.UUID] = mapped_column(UUID, primary_key=True, default=uuid.uuid4)
     user_id: Mapped[int] = mapped_column(Integer, nullable=True)
     user_fullname: Mapped[str | None] = mapped_column(String, nullable=True)
@@ -154,12 +410,85 @@ class Comment(BaseDbModel):
     reactions: Mapped[list[CommentReaction]] = relationship(
         "CommentReaction", back_populates="comment", cascade="all, delete-orphan"
     )
+    like_count: Mapped[int] = mapped_column(
+        Integer, nullable=False, server_default='0', default=0, comment="Число лайков, обновляется в like_comment"
+    )
+    dislike_count: Mapped[int] = mapped_column(
+        Integer, nullable=False, server_default='0', default=0, comment="Число дизлайков, обновляется в like_comment"
+    )
     is_deleted: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    review_claimed_by: Mapped[int | None] = mapped_column(
+        Integer, nullable=True, comment="Модератор, которому отзыв выдан из очереди модерации"
+    )
+    review_claimed_until: Mapped[datetime.datetime | None] = mapped_column(
+        DateTime, nullable=True, comment="До какого времени отзыв закреплен за модератором"
+    )
 
     @hybrid_property
     def mark_general(self):
         return (self.mark_kindness + self.mark_freebie + self.mark_clarity) / 3
 
+    @hybrid_property
+    def is_approved(self) -> bool:
+        """Отзыв опубликован: одобрен модератором и не удален"""
+        return self.review_status is ReviewStatus.APPROVED and not self.is_deleted
+
+    @is_approved.expression
+    def is_approved(cls):
+        return and_(cls.review_status == ReviewStatus.APPROVED, not_(cls.is_deleted))
+
+    @hybrid_property
+    def is_pending(self) -> bool:
+        """Отзыв ждет модерации и не удален"""
+        return self.review_status is ReviewStatus.PENDING and not self.is_deleted
+
+    @is_pending.expression
+    def is_pending(cls):
+        return and_(cls.review_status == ReviewStatus.PENDING, not_(cls.is_deleted))
+
+    def is_claimed_by_other(self, moderator_id: int) -> bool:
+        """Отзыв закреплен за другим модератором, и закрепление не истекло"""
+        return (
+            self.review_claimed_until is not None
+            and self.review_claimed_until > datetime.datetime.utcnow()
+            and self.review_claimed_by != moderator_id
+        )
+
+    @classmethod
+    async def claim_for_review(
+        cls, moderator_id: int, limit: int, until: datetime.datetime, *, session: AsyncSession
+    ) -> list[Comment]:
+        """
+        Закрепляет за модератором до `until` самые старые отзывы из очереди модерации
+
+        Берутся отзывы, не закрепленные ни за кем, с истекшим закреплением или уже закрепленные за этим модератором.
+        Строки, которые в этот момент закрепляет другой модератор, пропускаются, а не ждут его коммита,
+        поэтому одновременные запросы получают разные отзывы
+        """
+        now = datetime.datetime.utcnow()
+        claimable = (
+            select(cls.uuid)
+            .where(
+                cls.is_pending,
+                or_(
+                    cls.review_claimed_until.is_(None),
+                    cls.review_claimed_until <= now,
+                    cls.review_claimed_by == moderator_id,
+                ),
+            )
+            .order_by(cls.create_ts)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        claimed = await session.scalars(
+            update(cls)
+            .where(cls.uuid.in_(claimable))
+            .values(review_claimed_by=moderator_id, review_claimed_until=until)
+            .returning(cls),
+            execution_options={"synchronize_session": False},
+        )
+        return sorted(claimed.all(), key=lambda comment: comment.create_ts)
+
     @hybrid_method
     def order_by_create_ts(
         self, query: str, asc_order: bool
@@ -184,71 +513,43 @@ class Comment(BaseDbModel):
 
     @hybrid_method
     def search_by_subject(self, query: str) -> bool:
+        query = normalize_search_text(query or "")
         if not query:
             return true()
-        return and_(Comment.review_status == ReviewStatus.APPROVED, func.lower(Comment.subject).contains(query))
-
-    @hybrid_property
-    def like_count(self):
-        """Python доступ к числу лайков"""
-        return sum(1 for reaction in self.reactions if reaction.reaction == Reaction.LIKE)
-
-    @like_count.expression
-    def like_count(cls):
-        """SQL выражение для подсчета лайков"""
-        return (
-            select(func.coalesce(func.count(CommentReaction.uuid), 0))
-            .where(and_(CommentReaction.comment_uuid == cls.uuid, CommentReaction.reaction == Reaction.LIKE))
-            .label('like_count')
-        )
-
-    @hybrid_property
-    def dislike_count(self):
-        """Python доступ к числу дизлайков"""
-        return sum(1 for reaction in self.reactions if reaction.reaction == Reaction.DISLIKE)
-
-    @dislike_count.expression
-    def dislike_count(cls):
-        """SQL выражение для подсчета дизлайков"""
-        return (
-            select(func.coalesce(func.count(CommentReaction.uuid), 0))
-            .where(and_(CommentReaction.comment_uuid == cls.uuid, CommentReaction.reaction == Reaction.DISLIKE))
-            .label('dislike_count')
+        return and_(
+            Comment.review_status == ReviewStatus.APPROVED,
+            tuple_(Comment.lecturer_id, Comment.subject).in_(
+                select(LecturerSubject.lecturer_id, LecturerSubject.subject).where(LecturerSubject.matches(query))
+            ),
         )
 
     @hybrid_property
     def like_dislike_diff(self):
-        """Python доступ к разнице лайков и дизлайков"""
-        if hasattr(self, '_like_dislike_diff'):
-            return self._like_dislike_diff
+        """Разница лайков и дизлайков, в SQL покрыта индексом ix_comment_like_dislike_diff"""
         return self.like_count - self.dislike_count
 
-    @like_dislike_diff.expression
-    def like_dislike_diff(cls):
-        """SQL выражение для вычисления разницы лайков/дизлайков"""
-        return (
-            select(
-                func.coalesce(
-                    func.sum(
-                        case(
-                            (CommentReaction.reaction == Reaction.LIKE, 1),
-                            (CommentReaction.reaction == Reaction.DISLIKE, -1),
-                            else_=0,
-                        )
-                    ),
-                    0,
-                )
-            )
-            .where(CommentReaction.comment_uuid == cls.uuid)
-            .label('like_dislike_diff')
-        )
-
     @hybrid_method
     def order_by_like_diff(cls, asc_order: bool = False):
         """Метод для сортировки по разнице лайков/дизлайков"""
-        # Primary ordering: like-dislike diff (coalesced to 0)
         return cls.like_dislike_diff.asc() if asc_order else cls.like_dislike_diff.desc()
 
+    async def update_reaction_counters(
+        self, *, like_delta: int = 0, dislike_delta: int = 0, session: AsyncSession
+    ) -> None:
+        """Атомарно сдвигает счетчики реакций, чтобы параллельные лайки не перетирали друг друга"""
+        like_count, dislike_count = (
+            await session.execute(
+                update(Comment)
+                .where(Comment.uuid == self.uuid)
+                .values(like_count=Comment.like_count + like_delta, dislike_count=Comment.dislike_count + dislike_delta)
+                .returning(Comment.like_count, Comment.dislike_count)
+                .execution_options(synchronize_session=False)
+            )
+        ).one()
+        # Значения уже в БД, сессия не должна записывать их повторно
+        set_committed_value(self, "like_count", like_count)
+        set_committed_value(self, "dislike_count", dislike_count)
+
     @hybrid_method
     def has_reaction(self, user_id: int, react: Reaction) -> bool:
         return any(reaction.user_id == user_id and reaction.reaction == react for reaction in self.reactions)
@@ -268,50 +569,587 @@ class Comment(BaseDbModel):
         )
 
     @classmethod
-    def reactions_for_comments(cls, user_id: int, session, comments):
-        if not user_id or not comments:
+    async def update_published(
+        cls,
+        removed: Iterable[PublishedComment | None] = (),
+        added: Iterable[PublishedComment | None] = (),
+        *,
+        session: AsyncSession,
+    ) -> None:
+        """
+        Обновляет данные, которые считаются по опубликованным отзывам: `removed` сняты с публикации
+        или изменены, `added` опубликованы. Снимки `PublishedComment.of` берутся до и после изменения отзыва
+        """
+        subjects, stats = Counter(), defaultdict(Counter)
+        for sign, comments in ((-1, removed), (1, added)):
+            for comment in comments:
+                if comment is None:
+                    continue
+                if comment.subject is not None:
+                    subjects[comment.lecturer_id, comment.subject] += sign
+                stats[comment.lecturer_id].update(
+                    comment_count=sign,
+                    mark_kindness_sum=sign * comment.mark_kindness,
+                    mark_freebie_sum=sign * comment.mark_freebie,
+                    mark_clarity_sum=sign * comment.mark_clarity,
+                )
+        await LecturerSubject.adjust(subjects, session=session)
+        changed = await LecturerStats.adjust(stats, session=session)
+        if changed:
+            await Lecturer.update_weighted_marks(changed, session=session)
+
+    @classmethod
+    def rebuild_published_statements(cls, lecturer_ids: Iterable[int] | None = None) -> list[Executable]:
+        """Запросы, заново собирающие все данные по опубликованным отзывам всех или указанных преподавателей"""
+        if lecturer_ids is not None:
+            lecturer_ids = list(lecturer_ids)
+        return LecturerSubject.rebuild_statements(lecturer_ids) + LecturerStats.rebuild_statements(lecturer_ids)
+
+    @classmethod
+    async def rebuild_published(cls, *, session: AsyncSession) -> None:
+        """
+        Пересобирает lecturer_subject, lecturer_stats и lecturer_stats_total по всем опубликованным отзывам
+
+        Таблицы блокируются от изменений до конца транзакции: параллельные ручки отзывов дождутся пересборки
+        и применят свои изменения поверх нее
+        """
+        await session.execute(
+            text("LOCK TABLE lecturer_subject, lecturer_stats, lecturer_stats_total IN SHARE ROW EXCLUSIVE MODE")
+        )
+        for statement in cls.rebuild_published_statements():
+            await session.execute(statement)
+
+    @classmethod
+    async def bulk_create(cls, comments: list[dict[str, Any]], *, session: AsyncSession) -> list[Comment]:
+        """Создает пачку комментариев одним `INSERT ... RETURNING`, без flush и refresh на каждую строку"""
+        if not comments:
+            return []
+        return list(await session.scalars(insert(cls).returning(cls), comments))
+
+    @classmethod
+    async def reactions_for_comments(cls, user_id: int, session, comments):
+        if user_id is None or not comments:
             return {}
         comments_uuid = [c.uuid for c in comments]
-        result = (
-            session.query(Comment.uuid, CommentReaction.reaction)
+        result = await session.execute(
+            select(Comment.uuid, CommentReaction.reaction)
             .join(
                 CommentReaction, and_(Comment.uuid == CommentReaction.comment_uuid, CommentReaction.user_id == user_id)
             )
-            .filter(Comment.uuid.in_(comments_uuid))
+            .where(Comment.uuid.in_(comments_uuid))
             .group_by(Comment.uuid, CommentReaction.reaction)
-            .all()
         )
-        return dict(result)
+        return dict(result.all())
+
+
+class PublishedComment(NamedTuple):
+    """Поля опубликованного отзыва, из которых считаются данные по преподавателю"""
+
+    lecturer_id: int
+    subject: str | None
+    mark_kindness: int
+    mark_freebie: int
+    mark_clarity: int
+
+    @classmethod
+    def of(cls, comment: Comment) -> PublishedComment | None:
+        """Снимок отзыва, если он опубликован, иначе `None`"""
+        if not comment.is_approved:
+            return None
+        return cls(
+            comment.lecturer_id, comment.subject, comment.mark_kindness, comment.mark_freebie, comment.mark_clarity
+        )
+
+
+class LecturerSubject(BaseDbModel):
+    """
+    Предметы преподавателя из его опубликованных отзывов с числом таких отзывов
+
+    Обновляется ручками отзывов через `Comment.update_published`, пересобирается `rebuild_statements`
+    """
+
+    __table_args__ = (
+        Index(
+            "ix_lecturer_subject_search_subject",
+            "search_subject",
+            postgresql_ops={"search_subject": "text_pattern_ops"},
+        ),
+        Index(
+            "ix_lecturer_subject_search_subject_trgm",
+            "search_subject",
+            postgresql_using="gin",
+            postgresql_ops={"search_subject": "gin_trgm_ops"},
+        ),
+    )
+
+    lecturer_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("lecturer.id", ondelete="CASCADE"), primary_key=True, comment="Идентификатор преподавателя"
+    )
+    subject: Mapped[str] = mapped_column(String, primary_key=True, comment="Предмет, как он указан в отзывах")
+    search_subject: Mapped[str] = mapped_column(
+        String,
+        Computed("translate(lower(subject), 'Ёё', 'ее')", persisted=True),
+        nullable=False,
+        comment="Предмет для поиска: в нижнем регистре, ё заменена на е",
+    )
+    comment_count: Mapped[int] = mapped_column(
+        Integer, nullable=False, comment="Число опубликованных отзывов к преподавателю с этим предметом"
+    )
+
+    @hybrid_method
+    def matches(self, query: str) -> bool:
+        """
+        Предмет содержит нормализованную строку `query`: подстрока ищется по триграммному индексу
+
+        В строке короче трех символов нет ни одной триграммы, такие строки ищутся как начало предмета
+        по индексу ix_lecturer_subject_search_subject
+        """
+        if len(query) < 3:
+            return self.search_subject.like(f"{query}%")
+        return self.search_subject.like(f"%{query}%")
+
+    @classmethod
+    def lecturer_subjects(cls):
+        """Подзапрос с массивом предметов преподавателя по алфавиту, добавляется колонкой к запросу преподавателей"""
+        return (
+            select(func.array_agg(aggregate_order_by(cls.subject, cls.subject)))
+            .where(cls.lecturer_id == Lecturer.id)
+            .correlate(Lecturer)
+            .scalar_subquery()
+        )
+
+    @classmethod
+    async def adjust(cls, deltas: dict[tuple[int, str], int], *, session: AsyncSession) -> None:
+        """Сдвигает счетчики отзывов пар (преподаватель, предмет), пары с нулевым счетчиком удаляются"""
+        # Порядок строк фиксирован, чтобы параллельные транзакции блокировали их в одном порядке
+        deltas = sorted((key, delta) for key, delta in deltas.items() if delta)
+        if not deltas:
+            return
+        statement = pg_insert(cls).values(
+            [
+                {"lecturer_id": lecturer_id, "subject": subject, "comment_count": delta}
+                for (lecturer_id, subject), delta in deltas
+            ]
+        )
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.lecturer_id, cls.subject],
+                set_={"comment_count": cls.comment_count + statement.excluded.comment_count},
+            )
+        )
+        decreased = [key for key, delta in deltas if delta < 0]
+        if decreased:
+            await session.execute(
+                delete(cls).where(tuple_(cls.lecturer_id, cls.subject).in_(decreased), cls.comment_count <= 0)
+            )
+
+    @classmethod
+    def rebuild_statements(cls, lecturer_ids: Iterable[int] | None = None) -> list[Executable]:
+        """Запросы, заново собирающие предметы из опубликованных отзывов всех или указанных преподавателей"""
+        clear = delete(cls)
+        published = (
+            select(Comment.lecturer_id, Comment.subject, func.count())
+            .where(Comment.is_approved, Comment.subject.is_not(None))
+            .group_by(Comment.lecturer_id, Comment.subject)
+        )
+        if lecturer_ids is not None:
+            lecturer_ids = list(lecturer_ids)
+            clear = clear.where(cls.lecturer_id.in_(lecturer_ids))
+            published = published.where(Comment.lecturer_id.in_(lecturer_ids))
+        return [clear, insert(cls).from_select(["lecturer_id", "subject", "comment_count"], published)]
+
+
+def _mark_average(*sums: str) -> Computed:
+    """Среднее по опубликованным отзывам из сумм оценок, NULL у преподавателя без отзывов"""
+    return Computed(f"({' + '.join(sums)})::float8 / NULLIF({len(sums)} * comment_count, 0)", persisted=True)
+
+
+class LecturerStats(BaseDbModel):
+    """
+    Число опубликованных отзывов преподавателя, суммы и средние оценок по ним
+
+    Строка есть только у преподавателей с опубликованными отзывами. Обновляется ручками отзывов
+    через `Comment.update_published` вместе с общими суммами в `LecturerStatsTotal`,
+    пересобирается `Comment.rebuild_published`
+    """
+
+    __table_args__ = (
+        Index("ix_lecturer_stats_mark_kindness", "mark_kindness"),
+        Index("ix_lecturer_stats_mark_freebie", "mark_freebie"),
+        Index("ix_lecturer_stats_mark_clarity", "mark_clarity"),
+        Index("ix_lecturer_stats_mark_general", "mark_general"),
+    )
+
+    lecturer_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("lecturer.id", ondelete="CASCADE"), primary_key=True, comment="Идентификатор преподавателя"
+    )
+    comment_count: Mapped[int] = mapped_column(Integer, nullable=False, comment="Число опубликованных отзывов")
+    mark_kindness_sum: Mapped[int] = mapped_column(Integer, nullable=False, comment="Сумма оценок доброты")
+    mark_freebie_sum: Mapped[int] = mapped_column(Integer, nullable=False, comment="Сумма оценок халявности")
+    mark_clarity_sum: Mapped[int] = mapped_column(Integer, nullable=False, comment="Сумма оценок понятности")
+    mark_kindness: Mapped[float | None] = mapped_column(
+        Float, _mark_average("mark_kindness_sum"), comment="Средняя оценка доброты"
+    )
+    mark_freebie: Mapped[float | None] = mapped_column(
+        Float, _mark_average("mark_freebie_sum"), comment="Средняя оценка халявности"
+    )
+    mark_clarity: Mapped[float | None] = mapped_column(
+        Float, _mark_average("mark_clarity_sum"), comment="Средняя оценка понятности"
+    )
+    mark_general: Mapped[float | None] = mapped_column(
+        Float,
+        _mark_average("mark_kindness_sum", "mark_freebie_sum", "mark_clarity_sum"),
+        comment="Средняя общая оценка",
+    )
+
+    SUMS = ("comment_count", "mark_kindness_sum", "mark_freebie_sum", "mark_clarity_sum")
+
+    @classmethod
+    async def adjust(cls, deltas: dict[int, Counter[str]], *, session: AsyncSession) -> list[int]:
+        """
+        Сдвигает счетчик и суммы оценок преподавателей и общие суммы, строки без опубликованных отзывов удаляются.
+        Возвращает id преподавателей, у которых что-то изменилось
+        """
+        # Порядок строк фиксирован, чтобы параллельные транзакции блокировали их в одном порядке
+        deltas = sorted((lecturer_id, delta) for lecturer_id, delta in deltas.items() if any(delta.values()))
+        if not deltas:
+            return []
+        statement = pg_insert(cls).values(
+            [
+                {"lecturer_id": lecturer_id, **{field: delta[field] for field in cls.SUMS}}
+                for lecturer_id, delta in deltas
+            ]
+        )
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.lecturer_id],
+                set_={field: getattr(cls, field) + statement.excluded[field] for field in cls.SUMS},
+            )
+        )
+        decreased = [lecturer_id for lecturer_id, delta in deltas if delta["comment_count"] < 0]
+        if decreased:
+            await session.execute(delete(cls).where(cls.lecturer_id.in_(decreased), cls.comment_count <= 0))
+        # Строки общих сумм блокируются после строк преподавателей, как и в `remove`.
+        # Counter.update, а не сложение: сложение Counter отбрасывает отрицательные значения
+        totals = defaultdict(Counter)
+        for lecturer_id, delta in deltas:
+            totals[LecturerStatsTotal.stripe(lecturer_id)].update(delta)
+        await LecturerStatsTotal.shift(totals, session=session)
+        return [lecturer_id for lecturer_id, _ in deltas]
+
+    @classmethod
+    async def remove(cls, lecturer_id: int, *, session: AsyncSession) -> None:
+        """Удаляет строку преподавателя и вычитает его отзывы из общих сумм"""
+        removed = (
+            await session.execute(
+                delete(cls)
+                .where(cls.lecturer_id == lecturer_id)
+                .returning(*[getattr(cls, field) for field in cls.SUMS])
+            )
+        ).one_or_none()
+        if removed is not None:
+            delta = Counter({field: -value for field, value in zip(cls.SUMS, removed)})
+            await LecturerStatsTotal.shift({LecturerStatsTotal.stripe(lecturer_id): delta}, session=session)
+
+    @classmethod
+    def rebuild_statements(cls, lecturer_ids: list[int] | None = None) -> list[Executable]:
+        """
+        Запросы, заново считающие строки всех или указанных преподавателей по опубликованным отзывам.
+        Общие суммы затем пересчитываются по всей таблице
+        """
+        clear = delete(cls)
+        published = (
+            select(
+                Comment.lecturer_id,
+                func.count(),
+                func.sum(Comment.mark_kindness),
+                func.sum(Comment.mark_freebie),
+                func.sum(Comment.mark_clarity),
+            )
+            .where(Comment.is_approved)
+            .group_by(Comment.lecturer_id)
+        )
+        if lecturer_ids is not None:
+            clear = clear.where(cls.lecturer_id.in_(lecturer_ids))
+            published = published.where(Comment.lecturer_id.in_(lecturer_ids))
+        stripe = (cls.lecturer_id % LecturerStatsTotal.STRIPES).label("id")
+        totals = select(stripe, *[func.sum(getattr(cls, field)) for field in cls.SUMS]).group_by(stripe)
+        return [
+            clear,
+            insert(cls).from_select(["lecturer_id", *cls.SUMS], published),
+            delete(LecturerStatsTotal),
+            insert(LecturerStatsTotal).from_select(["id", *cls.SUMS], totals),
+        ]
+
+
+class LecturerStatsTotal(BaseDbModel):
+    """
+    Число и суммы оценок всех опубликованных отзывов: сумма строк `LecturerStats`, разнесенная по `STRIPES` строкам
+
+    Из средних `means` считаются взвешенные оценки преподавателей. Обновляется вместе с `LecturerStats`,
+    чтобы не агрегировать всю lecturer_stats на каждый отзыв. Отзыв сдвигает строку `stripe` своего преподавателя,
+    поэтому отзывы к разным преподавателям не ждут друг друга на одной строке. Строка создается при первом сдвиге
+    """
+
+    STRIPES = 16
+
+    id: Mapped[int] = mapped_column(
+        Integer, primary_key=True, comment="Номер строки: id преподавателя по модулю STRIPES"
+    )
+    comment_count: Mapped[int] = mapped_column(Integer, nullable=False, comment="Число опубликованных отзывов")
+    mark_kindness_sum: Mapped[int] = mapped_column(Integer, nullable=False, comment="Сумма оценок доброты")
+    mark_freebie_sum: Mapped[int] = mapped_column(Integer, nullable=False, comment="Сумма оценок халявности")
+    mark_clarity_sum: Mapped[int] = mapped_column(Integer, nullable=False, comment="Сумма оценок понятности")
+
+    # Средняя оценка: суммы, из которых она считается
+    MEANS = {
+        "mark_kindness": ("mark_kindness_sum",),
+        "mark_freebie": ("mark_freebie_sum",),
+        "mark_clarity": ("mark_clarity_sum",),
+        "mark_general": ("mark_kindness_sum", "mark_freebie_sum", "mark_clarity_sum"),
+    }
+
+    @classmethod
+    def stripe(cls, lecturer_id: int) -> int:
+        return lecturer_id % cls.STRIPES
+
+    @classmethod
+    def means(cls) -> Subquery:
+        """Средние оценки по всем опубликованным отзывам одной строкой, NULL без отзывов"""
+        count = func.sum(cls.comment_count)
+        means = []
+        for mark, fields in cls.MEANS.items():
+            sums = [func.sum(getattr(cls, field)) for field in fields]
+            total = sum(sums[1:], sums[0])
+            means.append((cast(total, Float) / func.nullif(len(sums) * count, 0, type_=Float)).label(mark))
+        return select(*means).subquery("means")
+
+    @classmethod
+    async def shift(cls, deltas: dict[int, Counter[str]], *, session: AsyncSession) -> None:
+        """Сдвигает счетчик и суммы строк на `deltas`: по номеру строки сдвиг с ключами из `LecturerStats.SUMS`"""
+        # Порядок строк фиксирован, чтобы параллельные транзакции блокировали их в одном порядке
+        deltas = sorted((stripe, delta) for stripe, delta in deltas.items() if any(delta.values()))
+        if deltas:
+            statement = pg_insert(cls).values(
+                [{"id": stripe, **{field: delta[field] for field in LecturerStats.SUMS}} for stripe, delta in deltas]
+            )
+            await session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[cls.id],
+                    set_={field: getattr(cls, field) + statement.excluded[field] for field in LecturerStats.SUMS},
+                )
+            )
 
 
 class LecturerUserComment(BaseDbModel):
+    __table_args__ = (Index("ix_lecturer_user_comment_user_lecturer_update_ts", "user_id", "lecturer_id", "update_ts"),)
+
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     user_id: Mapped[int] = mapped_column(Integer, nullable=False)
     lecturer_id: Mapped[int] = mapped_column(Integer, ForeignKey("lecturer.id"))
-    create_ts: Mapped[datetime.datetime] = mapped_column(
-        DateTime, default=datetime.datetime.now(datetime.timezone.utc), nullable=False
-    )
-    update_ts: Mapped[datetime.datetime] = mapped_column(
-        DateTime, default=datetime.datetime.now(datetime.timezone.utc), nullable=False
-    )
+    create_ts: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    update_ts: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow, nullable=False)
     is_deleted: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
 
 
+class CommentLimitCounter(BaseDbModel):
+    """
+    Число отзывов пользователя за месяц: всем преподавателям (`lecturer_id` = `ALL_LECTURERS`) и каждому отдельно
+
+    Лимиты на отзывы проверяются по этим счетчикам, а не подсчетом `LecturerUserComment`:
+    на пользователя не больше одной строки на месяц окна лимита
+    """
+
+    ALL_LECTURERS = 0
+
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True, comment="Идентификатор пользователя")
+    lecturer_id: Mapped[int] = mapped_column(
+        Integer, primary_key=True, comment="Идентификатор преподавателя, 0 - все преподаватели"
+    )
+    month: Mapped[datetime.date] = mapped_column(Date, primary_key=True, comment="Первое число месяца")
+    count: Mapped[int] = mapped_column(Integer, nullable=False, comment="Число отзывов за месяц")
+
+    @classmethod
+    async def hit(
+        cls,
+        user_id: int,
+        lecturer_id: int,
+        month: datetime.date,
+        *,
+        total_since: datetime.date,
+        lecturer_since: datetime.date,
+        session: AsyncSession,
+    ) -> tuple[int, int]:
+        """
+        Засчитывает отзыв пользователя в `month` и возвращает число его отзывов, включая этот:
+        всем преподавателям с `total_since` и преподавателю `lecturer_id` с `lecturer_since`
+
+        Счетчики текущего месяца остаются заблокированы до конца транзакции, поэтому одновременные отзывы
+        одного пользователя проверяются по очереди. Если лимит превышен, транзакцию надо откатить
+        """
+        rows = [
+            {"user_id": user_id, "lecturer_id": id, "month": month, "count": 1}
+            for id in (cls.ALL_LECTURERS, lecturer_id)
+        ]
+        statement = pg_insert(cls).values(rows)
+        await session.execute(
+            statement.on_conflict_do_update(
+                index_elements=[cls.user_id, cls.lecturer_id, cls.month], set_={"count": cls.count + 1}
+            )
+        )
+        total, lecturer = (
+            await session.execute(
+                select(
+                    func.coalesce(
+                        func.sum(cls.count).filter(cls.lecturer_id == cls.ALL_LECTURERS, cls.month >= total_since), 0
+                    ),
+                    func.coalesce(
+                        func.sum(cls.count).filter(cls.lecturer_id == lecturer_id, cls.month >= lecturer_since), 0
+                    ),
+                ).where(
+                    cls.user_id == user_id,
+                    cls.lecturer_id.in_([cls.ALL_LECTURERS, lecturer_id]),
+                    cls.month >= min(total_since, lecturer_since),
+                )
+            )
+        ).one()
+        return total, lecturer
+
+    @classmethod
+    def forget_lecturer_statements(cls, lecturer_id: int) -> list[Executable]:
+        """Запросы, которые убирают отзывы удаленного преподавателя из счетчиков, как и из `LecturerUserComment`"""
+        lecturer_counter = aliased(cls)
+        return [
+            update(cls)
+            .where(
+                cls.lecturer_id == cls.ALL_LECTURERS,
+                cls.user_id == lecturer_counter.user_id,
+                cls.month == lecturer_counter.month,
+                lecturer_counter.lecturer_id == lecturer_id,
+            )
+            .values(count=cls.count - lecturer_counter.count),
+            delete(cls).where(cls.lecturer_id == lecturer_id),
+        ]
+
+
 class Reaction(str, Enum):
     LIKE: str = "like"
     DISLIKE: str = "dislike"
 
 
 class CommentReaction(BaseDbModel):
+    __table_args__ = (
+        Index("ix_comment_reaction_comment_uuid_reaction", "comment_uuid", "reaction"),
+        Index("ix_comment_reaction_user_id_comment_uuid", "user_id", "comment_uuid"),
+    )
+
     uuid: Mapped[uuid.UUID] = mapped_column(UUID, primary_key=True, default=uuid.uuid4)
     user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
     comment_uuid: Mapped[UUID] = mapped_column(UUID, ForeignKey("comment.uuid"), nullable=False)
     reaction: Mapped[Reaction] = mapped_column(
         DbEnum(Reaction, native_enum=False), nullable=False
     )  # 1 for like, -1 for dislike
-    created_at: Mapped[datetime.datetime] = mapped_column(
-        DateTime, default=datetime.datetime.now(datetime.timezone.utc)
-    )
-    edited_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now(datetime.timezone.utc))
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
+    edited_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow)
     user_id: Mapped[int] = mapped_column(Integer, nullable=False)
     comment = relationship("Comment", back_populates="reactions")
+
+
+class OutboxKind(str, Enum):
+    FIRST_COMMENT_ACHIEVEMENT: str = "first_comment_achievement"
+
+
+class OutboxStatus(str, Enum):
+    PENDING: str = "pending"
+    FAILED: str = "failed"
+
+
+# Условие частичного индекса событий outbox, которые еще надо выполнить. Enum хранится в БД по имени
+PENDING_OUTBOX_CONDITION = text("status = 'PENDING'")
+
+
+class OutboxEvent(BaseDbModel):
+    """
+    Побочный эффект ручки, который надо выполнить вне запроса, например выдать ачивку
+
+    Пишется в той же транзакции, что и данные ручки, поэтому не теряется при падении процесса.
+    Фоновый обработчик закрепляет события за собой через `claim` и коммитит, выполняет их вне транзакции,
+    затем выполненные удаляет, а неудачные откладывает через `reschedule`. После `max_attempts` неудач
+    событие переходит в статус FAILED и больше не выполняется.
+
+    События с одинаковым `key` повторяют друг друга: `enqueue` не добавляет событие, если такое же еще ждет выполнения
+    """
+
+    __table_args__ = (
+        Index("ix_outbox_event_pending_next_attempt_ts", "next_attempt_ts", postgresql_where=PENDING_OUTBOX_CONDITION),
+        Index(
+            "ix_outbox_event_pending_kind_key", "kind", "key", unique=True, postgresql_where=PENDING_OUTBOX_CONDITION
+        ),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    kind: Mapped[OutboxKind] = mapped_column(
+        DbEnum(OutboxKind, native_enum=False), nullable=False, comment="Что надо сделать"
+    )
+    payload: Mapped[dict[str, Any]] = mapped_column(JSONB, nullable=False, comment="Аргументы события")
+    key: Mapped[str | None] = mapped_column(
+        String,
+        nullable=True,
+        comment="Пока ждет выполнения событие того же вида с этим ключом, такое же не добавляется",
+    )
+    status: Mapped[OutboxStatus] = mapped_column(
+        DbEnum(OutboxStatus, native_enum=False),
+        nullable=False,
+        default=OutboxStatus.PENDING,
+        comment="PENDING - надо выполнить, FAILED - попытки исчерпаны",
+    )
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, comment="Число неудачных попыток")
+    last_error: Mapped[str | None] = mapped_column(String, nullable=True, comment="Ошибка последней попытки")
+    create_ts: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    next_attempt_ts: Mapped[datetime.datetime] = mapped_column(
+        DateTime, default=datetime.datetime.utcnow, nullable=False, comment="Время следующей попытки"
+    )
+
+    @classmethod
+    async def enqueue(cls, kind: OutboxKind, payload: dict[str, Any], key: str, *, session: AsyncSession) -> None:
+        """Добавляет событие, если событие того же вида с тем же `key` еще не выполнено"""
+        await session.execute(
+            pg_insert(cls)
+            .values(kind=kind, payload=payload, key=key)
+            .on_conflict_do_nothing(index_elements=[cls.kind, cls.key], index_where=PENDING_OUTBOX_CONDITION)
+        )
+
+    @classmethod
+    async def claim(cls, limit: int, lease: float, *, session: AsyncSession) -> list[OutboxEvent]:
+        """
+        Закрепляет за обработчиком до `limit` событий, время попытки которых наступило, на `lease` секунд
+
+        Закрепление - перенос времени попытки, поэтому после коммита блокировки не держатся, а другие обработчики
+        не берут событие, пока не истечет `lease`. Если обработчик упадет, событие выполнится после истечения.
+        Строки, которые в этот момент закрепляет другой обработчик, пропускаются
+        """
+        now = datetime.datetime.utcnow()
+        claimable = (
+            select(cls.id)
+            .where(cls.status == OutboxStatus.PENDING, cls.next_attempt_ts <= now)
+            .order_by(cls.next_attempt_ts)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+        claimed = await session.scalars(
+            update(cls)
+            .where(cls.id.in_(claimable))
+            .values(next_attempt_ts=now + datetime.timedelta(seconds=lease))
+            .returning(cls),
+            execution_options={"synchronize_session": False},
+        )
+        return list(claimed.all())
+
+    def reschedule(self, delay: float, error: str, max_attempts: int) -> None:
+        """Откладывает событие на `delay` секунд после неудачной попытки или переводит в FAILED"""
+        self.attempts += 1
+        self.last_error = error
+        if self.attempts >= max_attempts:
+            self.status = OutboxStatus.FAILED
+        else:
+            self.next_attempt_ts = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
@@ -1,15 +1,40 @@
+import asyncio
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_sqlalchemy import DBSessionMiddleware
 from logger_middleware import LoggerMiddleware
 
 from rating_api import __version__
 from rating_api.routes.comment import comment
 from rating_api.routes.lecturer import lecturer
 from rating_api.settings import Settings, get_settings
+from rating_api.utils.achievement import achievement_client
+from rating_api.utils.cache import cache
+from rating_api.utils.db import AsyncDBSessionMiddleware, db
+from rating_api.utils.metrics import MetricsMiddleware, metrics_response
+from rating_api.utils.outbox import outbox_worker
+from rating_api.utils.slow_query import log_slow_queries
+from rating_api.utils.weighted_marks import weighted_marks_refresher
 
 
 settings: Settings = get_settings()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    cache_listener = asyncio.create_task(cache.listen())
+    await achievement_client.start()
+    await outbox_worker.start()
+    await weighted_marks_refresher.start()
+    yield
+    await weighted_marks_refresher.stop()
+    await outbox_worker.stop()
+    await achievement_client.stop()
+    cache_listener.cancel()
+    await db.dispose()
+
+
 app = FastAPI(
     title='Рейтинг преподавателей',
     description='Хранение и работа с рейтингом преподавателей и отзывами на них.',
@@ -18,12 +43,13 @@ app = FastAPI(
     root_path=settings.ROOT_PATH if __version__ != 'dev' else '/',
     docs_url=None if __version__ != 'dev' else '/docs',
     redoc_url=None,
+    lifespan=lifespan,
 )
 
 app.add_middleware(
-    DBSessionMiddleware,
+    AsyncDBSessionMiddleware,
     db_url=str(settings.DB_DSN),
-    engine_args={"pool_pre_ping": True, "isolation_level": "AUTOCOMMIT"},
+    engine_args={"pool_pre_ping": True},
 )
 
 app.add_middleware(
@@ -34,8 +60,18 @@ app.add_middleware(
     allow_headers=settings.CORS_ALLOW_HEADERS,
 )
 
+app.add_middleware(MetricsMiddleware)
+log_slow_queries()
+
 app.include_router(lecturer)
 app.include_router(comment)
 
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Метрики запросов в формате Prometheus"""
+    return metrics_response()
+
+
 if __version__ != 'dev':
     app.add_middleware(LoggerMiddleware, service_id=settings.SERVICE_ID)
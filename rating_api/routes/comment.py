@@ -3,12 +3,12 @@ import re
 from typing import Literal, Union
 from uuid import UUID
 
-import aiohttp
 from auth_lib.fastapi import UnionAuth
-from fastapi import APIRouter, Depends, Query
-from fastapi_sqlalchemy import db
+from fastapi import APIRouter, Depends, Query, Request, Response
+from sqlalchemy import func
 
 from rating_api.exceptions import (
+    CommentClaimed,
     CommentTooLong,
     ForbiddenAction,
     ForbiddenSymbol,
@@ -16,7 +16,18 @@ from rating_api.exceptions import (
     TooManyCommentRequests,
     TooManyCommentsToLecturer,
 )
-from rating_api.models import Comment, CommentReaction, Lecturer, LecturerUserComment, Reaction, ReviewStatus
+from rating_api.models import (
+    Comment,
+    CommentLimitCounter,
+    CommentReaction,
+    Lecturer,
+    LecturerUserComment,
+    OutboxEvent,
+    OutboxKind,
+    PublishedComment,
+    Reaction,
+    ReviewStatus,
+)
 from rating_api.schemas.base import StatusResponseModel
 from rating_api.schemas.models import (
     CommentGet,
@@ -25,15 +36,43 @@ from rating_api.schemas.models import (
     CommentGetAllWithStatus,
     CommentGetWithAllInfo,
     CommentGetWithStatus,
+    CommentImport,
     CommentImportAll,
+    CommentImportResult,
     CommentPost,
+    CommentReviewClaim,
     CommentUpdate,
 )
 from rating_api.settings import Settings, get_settings
+from rating_api.utils.cache import COMMENT_LIST_TAG, cache, invalidate_lecturers, lecturer_tag
+from rating_api.utils.cursor import Keyset
+from rating_api.utils.db import db
+from rating_api.utils.etag import etag_matches, make_etag, not_modified
+from rating_api.utils.metrics import TimedRoute
+from rating_api.utils.ndjson import iter_ndjson_batches
+from rating_api.utils.outbox import outbox_worker
 
 
 settings: Settings = get_settings()
-comment = APIRouter(prefix="/comment", tags=["Comment"])
+comment = APIRouter(prefix="/comment", tags=["Comment"], route_class=TimedRoute)
+
+
+# Символы, разрешенные в тексте отзыва
+COMMENT_TEXT_PATTERN = re.compile(r"[a-zA-Zа-яА-Я\d!?,_\-.\"\'\[\]{}`~<>^@#№$%;:&*()+=\\\/ \n]*")
+
+
+def validate_comment_text(text: str) -> None:
+    """Проверки текста отзыва, которым не нужна БД: длина и запрещенные символы"""
+    if len(text) > settings.MAX_COMMENT_LENGTH:
+        raise CommentTooLong(settings.MAX_COMMENT_LENGTH)
+    if COMMENT_TEXT_PATTERN.fullmatch(text) is None:
+        raise ForbiddenSymbol()
+
+
+def _months_ago(month: datetime.date, months: int) -> datetime.date:
+    """Первое число месяца, который на `months` месяцев раньше `month`"""
+    index = month.year * 12 + month.month - 1 - months
+    return datetime.date(index // 12, index % 12 + 1, 1)
 
 
 @comment.post("", response_model=CommentGet)
@@ -55,57 +94,35 @@ async def create_comment(
 
     Исключение **ForbiddenSymbol**, если в комментарии использованы запрещенные символы
     """
+    # Оценки проверены при разборе тела запроса, текст проверяем до обращений к БД
+    validate_comment_text(comment_info.text)
+
     # Проверяем, что лектор с заданным id существует
-    Lecturer.get(session=db.session, id=lecturer_id)
+    await Lecturer.aget(session=db.session, id=lecturer_id)
 
     now = datetime.datetime.now(tz=datetime.timezone.utc)
-    # Определяем дату, до которой учитываем комментарии для проверки общего лимита.
-    cutoff_date_total = datetime.datetime(
-        now.year + (now.month - settings.COMMENT_FREQUENCY_IN_MONTH) // 12,
-        (now.month - settings.COMMENT_FREQUENCY_IN_MONTH - 1) % 12 + 1,
-        1,
-    )
-    total_user_comments_count = (
-        LecturerUserComment.query(session=db.session)
-        .filter(
-            LecturerUserComment.user_id == user.get("id"),
-            LecturerUserComment.update_ts >= cutoff_date_total,
-        )
-        .count()
+    month = datetime.date(now.year, now.month, 1)
+    # Засчитываем отзыв в счетчики до проверки: одновременные отзывы пользователя ждут друг друга на счетчиках,
+    # а при превышении лимита транзакция откатывается вместе с ними
+    total_user_comments_count, lecturer_user_comments_count = await CommentLimitCounter.hit(
+        user.get("id"),
+        lecturer_id,
+        month,
+        total_since=_months_ago(month, settings.COMMENT_FREQUENCY_IN_MONTH),
+        lecturer_since=_months_ago(month, settings.COMMENT_LECTURER_FREQUENCE_IN_MONTH),
+        session=db.session,
     )
-    if total_user_comments_count >= settings.COMMENT_LIMIT:
+    if total_user_comments_count > settings.COMMENT_LIMIT:
         raise TooManyCommentRequests(settings.COMMENT_FREQUENCY_IN_MONTH, settings.COMMENT_LIMIT)
-
-    # Дата, до которой учитываем комментарии для проверки лимита на комментарии конкретному лектору.
-    cutoff_date_lecturer = datetime.datetime(
-        now.year + (now.month - settings.COMMENT_LECTURER_FREQUENCE_IN_MONTH) // 12,
-        (now.month - settings.COMMENT_LECTURER_FREQUENCE_IN_MONTH) % 12,
-        1,
-    )
-    lecturer_user_comments_count = (
-        LecturerUserComment.query(session=db.session)
-        .filter(
-            LecturerUserComment.user_id == user.get("id"),
-            LecturerUserComment.lecturer_id == lecturer_id,
-            LecturerUserComment.update_ts >= cutoff_date_lecturer,
-        )
-        .count()
-    )
-    if lecturer_user_comments_count >= settings.COMMENT_TO_LECTURER_LIMIT:
+    if lecturer_user_comments_count > settings.COMMENT_TO_LECTURER_LIMIT:
         raise TooManyCommentsToLecturer(
             settings.COMMENT_LECTURER_FREQUENCE_IN_MONTH, settings.COMMENT_TO_LECTURER_LIMIT
         )
 
-    if len(comment_info.text) > settings.MAX_COMMENT_LENGTH:
-        raise CommentTooLong(settings.MAX_COMMENT_LENGTH)
-
-    if re.search(r"^[a-zA-Zа-яА-Я\d!?,_\-.\"\'\[\]{}`~<>^@#№$%;:&*()+=\\\/ \n]*$", comment_info.text) is None:
-        raise ForbiddenSymbol()
-
     # Сначала добавляем с user_id, который мы получили при авторизации,
     # в LecturerUserComment, чтобы нельзя было слишком быстро добавлять комментарии
     create_ts = datetime.datetime(now.year, now.month, 1)
-    LecturerUserComment.create(
+    await LecturerUserComment.acreate(
         session=db.session,
         lecturer_id=lecturer_id,
         user_id=user.get('id'),
@@ -121,7 +138,7 @@ async def create_comment(
         fullname_info = list(filter(lambda x: "Полное имя" == x['param'], userdata_info))
         fullname = fullname_info[0]["value"] if len(fullname_info) != 0 else None
 
-    new_comment = Comment.create(
+    new_comment = await Comment.acreate(
         session=db.session,
         **comment_info.model_dump(exclude={"is_anonymous"}),
         lecturer_id=lecturer_id,
@@ -129,32 +146,35 @@ async def create_comment(
         user_fullname=fullname,
         review_status=ReviewStatus.PENDING,
     )
-
-    # Выдача аччивки юзеру за первый комментарий
-    async with aiohttp.ClientSession() as session:
-        give_achievement = True
-        async with session.get(
-            settings.API_URL + f"achievement/user/{user.get('id'):}",
-            headers={"Accept": "application/json"},
-        ) as response:
-            if response.status == 200:
-                user_achievements = await response.json()
-                for achievement in user_achievements.get("achievement", []):
-                    if achievement.get("id") == settings.FIRST_COMMENT_ACHIEVEMENT_ID:
-                        give_achievement = False
-                        break
-            else:
-                give_achievement = False
-        if give_achievement:
-            session.post(
-                settings.API_URL
-                + f"achievement/achievement/{settings.FIRST_COMMENT_ACHIEVEMENT_ID}/reciever/{user.get('id'):}",
-                headers={"Accept": "application/json", "Authorization": settings.ACHIEVEMENT_GIVE_TOKEN},
-            )
+    # Выдача аччивки юзеру за первый комментарий: событие коммитится вместе с отзывом и выполняется в фоне.
+    # Пока событие для юзера ждет выполнения, следующие отзывы новых не добавляют
+    await OutboxEvent.enqueue(
+        OutboxKind.FIRST_COMMENT_ACHIEVEMENT,
+        {"user_id": user.get('id')},
+        key=str(user.get('id')),
+        session=db.session,
+    )
+    await db.session.commit()
+    outbox_worker.notify()
+    await invalidate_lecturers(lecturer_id)
 
     return CommentGet.model_validate(new_comment)
 
 
+def _comment_import_rows(comments_info: list[CommentImport]) -> list[dict]:
+    """Строки для INSERT: у всех одинаковый набор полей, чтобы пачка ушла одним запросом"""
+    now = datetime.datetime.utcnow()
+    return [
+        comment_info.model_dump()
+        | {
+            "create_ts": comment_info.create_ts or now,
+            "update_ts": comment_info.update_ts or now,
+            "review_status": ReviewStatus.APPROVED,
+        }
+        for comment_info in comments_info
+    ]
+
+
 @comment.post('/import', response_model=CommentGetAll)
 async def import_comments(
     comments_info: CommentImportAll, _=Depends(UnionAuth(scopes=["rating.comment.import"]))
@@ -163,16 +183,64 @@ async def import_comments(
     Scopes: `["rating.comment.import"]`
 
     Создает комментарии в базе данных
+
+    Комментарии вставляются пачками по `COMMENT_IMPORT_CHUNK_SIZE` одним запросом на пачку
     """
     number_of_comments = len(comments_info.comments)
     result = CommentGetAll(limit=number_of_comments, offset=number_of_comments, total=number_of_comments)
-    for comment_info in comments_info.comments:
-        new_comment = Comment.create(
-            session=db.session,
-            **comment_info.model_dump(),
-            review_status=ReviewStatus.APPROVED,
+    for start in range(0, number_of_comments, settings.COMMENT_IMPORT_CHUNK_SIZE):
+        result.comments.extend(
+            await Comment.bulk_create(
+                _comment_import_rows(comments_info.comments[start : start + settings.COMMENT_IMPORT_CHUNK_SIZE]),
+                session=db.session,
+            )
         )
-        result.comments.append(new_comment)
+    await Comment.update_published(added=map(PublishedComment.of, result.comments), session=db.session)
+    await db.session.commit()
+    await invalidate_lecturers(*{new_comment.lecturer_id for new_comment in result.comments})
+    return result
+
+
+@comment.post(
+    '/import/ndjson',
+    response_model=CommentImportResult,
+    openapi_extra={
+        "requestBody": {"content": {"application/x-ndjson": {"schema": {"$ref": "#/components/schemas/CommentImport"}}}}
+    },
+)
+async def import_comments_ndjson(
+    request: Request, _=Depends(UnionAuth(scopes=["rating.comment.import"]))
+) -> CommentImportResult:
+    """
+    Scopes: `["rating.comment.import"]`
+
+    Создает комментарии из потока NDJSON: одна строка - один `CommentImport`.
+    Для больших выгрузок тело можно сжать gzip и передать заголовок `Content-Encoding: gzip`.
+    Тело читается потоково, в памяти держится одна пачка из `COMMENT_IMPORT_CHUNK_SIZE` строк
+
+    Возвращает uuid созданных комментариев и номера строк, не прошедших валидацию
+
+    Исключение **WrongImportFormat**, если тело не удалось распаковать
+    """
+    result = CommentImportResult(imported=0, failed=0, imported_uuid=[], failed_lines=[])
+    lecturer_ids = set()
+    async for batch, failed_lines in iter_ndjson_batches(
+        request.stream(),
+        CommentImport,
+        settings.COMMENT_IMPORT_CHUNK_SIZE,
+        gzipped=request.headers.get("content-encoding") == "gzip",
+    ):
+        new_comments = await Comment.bulk_create(_comment_import_rows(batch), session=db.session)
+        await Comment.update_published(added=map(PublishedComment.of, new_comments), session=db.session)
+        result.imported += len(new_comments)
+        result.imported_uuid.extend(new_comment.uuid for new_comment in new_comments)
+        lecturer_ids.update(new_comment.lecturer_id for new_comment in new_comments)
+        result.failed += len(failed_lines)
+        result.failed_lines.extend(line_number for line_number, _ in failed_lines)
+        # Объекты пачки больше не нужны, не держим их в identity map сессии
+        db.session.expunge_all()
+    await db.session.commit()
+    await invalidate_lecturers(*lecturer_ids)
     return result
 
 
@@ -187,20 +255,30 @@ async def get_comment(uuid: UUID, user=Depends(UnionAuth(auto_error=False, allow
 
     Исключение **ObjectNotFound**, если `uuid` не найден
     """
-    comment: Comment = Comment.query(session=db.session).filter(Comment.uuid == uuid).one_or_none()
-    if comment is None:
-        raise ObjectNotFound(Comment, uuid)
-    base_data = CommentGet.model_validate(comment)
+    cache_key = f"comment:{uuid}"
+    if (cached := await cache.get(cache_key)) is not None:
+        base_data = CommentGet.model_validate_json(cached)
+    else:
+        comment: Comment = (await db.session.scalars(Comment.aquery().where(Comment.uuid == uuid))).one_or_none()
+        if comment is None:
+            raise ObjectNotFound(Comment, uuid)
+        base_data = CommentGet.model_validate(comment)
+        await cache.set(cache_key, base_data.model_dump_json(), tags=[lecturer_tag(comment.lecturer_id)])
     if user:
-        base_data.is_liked = comment.has_reaction(user.get("id"), Reaction.LIKE)
-        base_data.is_disliked = comment.has_reaction(user.get("id"), Reaction.DISLIKE)
+        # Реакция пользователя в кэш не попадает, она своя у каждого
+        user_reactions = await Comment.reactions_for_comments(user.get("id"), db.session, [base_data])
+        base_data.is_liked = user_reactions.get(base_data.uuid) == Reaction.LIKE
+        base_data.is_disliked = user_reactions.get(base_data.uuid) == Reaction.DISLIKE
     return base_data
 
 
 @comment.get("", response_model=Union[CommentGetAll, CommentGetAllWithAllInfo, CommentGetAllWithStatus])
 async def get_comments(
+    request: Request,
+    response: Response,
     limit: int = 10,
     offset: int = 0,
+    cursor: str | None = None,
     lecturer_id: int | None = None,
     user_id: int | None = None,
     subject: str | None = None,
@@ -221,6 +299,10 @@ async def get_comments(
      Если без смещения возвращается комментарий с условным номером N,
      то при значении offset = X будет возвращаться комментарий с номером N + X
 
+     `cursor` - курсор следующей страницы из `next_cursor` предыдущего ответа с теми же параметрами.
+     Если передан, то `offset` не учитывается, а страница выбирается сразу после последнего комментария предыдущей.
+     Стоимость такого запроса не зависит от глубины страницы
+
     `order_by` - возможные значения `"create_ts", "mark_kindness", "mark_freebie", "mark_clarity", "mark_general", "like_diff"`.
      Если передано `'create_ts'` - возвращается список комментариев, отсортированных по времени
      Если передано `'mark_...'` - возвращается список комментариев, отсортированных по конкретной оценке
@@ -232,6 +314,8 @@ async def get_comments(
 
      `unreviewed` - вернет все непроверенные комментарии, если True. По дефолту False.
 
+     `total` в ответе - количество всех комментариев, подходящих под фильтры, а не только на текущей странице
+
      `asc_order` -Если передано true, сортировать в порядке возрастания. Иначе - в порядке убывания
 
      Разные модели ответа в зависимости от прав пользователя:
@@ -239,56 +323,85 @@ async def get_comments(
      CommentGetAllWithStatus: для авторов комментариев (со статусом);
      CommentGetAll: для всех остальных (только одобренные комментарии)
 
+     Для одобренных комментариев преподавателя (`lecturer_id`) в ответе есть заголовок `ETag`.
+     Если он передан в `If-None-Match` и комментарии не изменились, возвращается 304 без тела
+
      Исключение **ObjectNotFound**, если комментарий с введенными параметрами не найден
 
      Исключение **ForbiddenAction**, если пользователь пытается получить непроверенный комментарий
     """
-    comments_query = (
-        Comment.query(session=db.session)
-        .filter(Comment.search_by_lectorer_id(lecturer_id))
-        .filter(Comment.search_by_user_id(user_id))
-        .filter(Comment.search_by_subject(subject))
-        .order_by(
-            Comment.order_by_mark(order_by, asc_order)
-            if "mark" in order_by
-            else (
-                Comment.order_by_like_diff(asc_order)
-                if order_by == "like_diff"
-                else Comment.order_by_create_ts(order_by, asc_order)
-            )
+    is_reviewer = bool(user) and "rating.comment.review" in [scope['name'] for scope in user.get('session_scopes')]
+    if unreviewed and not is_reviewer:
+        raise ForbiddenAction(Comment)
+    body_version = None
+    if lecturer_id is not None and not unreviewed:
+        version = await Lecturer.version_stamp(lecturer_id, session=db.session)
+        if version is not None:
+            body_version = make_etag(*(value for name, value in version._mapping.items() if name != "current_rank"))
+            params = [limit, offset, cursor, user_id, subject, order_by, asc_order]
+            etag = make_etag("comments", lecturer_id, *params, user.get("id") if user else None, is_reviewer, *version)
+            if etag_matches(request, etag):
+                return not_modified(etag)
+            response.headers["ETag"] = etag
+    # Ответ без пользователя одинаков для всех, поэтому кэшируется целиком. Ключ включает версию данных,
+    # от которой посчитан ETag, чтобы старое тело не ушло с новым ETag
+    cache_key = None
+    if not user:
+        cache_key = (
+            f"comments:{limit}:{offset}:{cursor}:{lecturer_id}:{user_id}:{subject}:{order_by}:{asc_order}"
+            f":{body_version}"
         )
+        if (cached := await cache.get(cache_key)) is not None:
+            return CommentGetAll.model_validate_json(cached)
+    # Статус фильтруется до LIMIT, чтобы страница была полной, а total - честным
+    comments_query = (
+        Comment.aquery()
+        .where(Comment.review_status == (ReviewStatus.PENDING if unreviewed else ReviewStatus.APPROVED))
+        .where(Comment.search_by_lectorer_id(lecturer_id))
+        .where(Comment.search_by_user_id(user_id))
+        .where(Comment.search_by_subject(subject))
+    )
+    total = await db.session.scalar(comments_query.with_only_columns(func.count()))
+    keyset = Keyset(
+        (
+            (
+                Comment.order_by_mark(order_by, asc_order)
+                if "mark" in order_by
+                else (
+                    Comment.order_by_like_diff(asc_order)
+                    if order_by == "like_diff"
+                    else Comment.order_by_create_ts(order_by, asc_order)
+                )
+            ),
+            # uuid делает порядок однозначным, без него курсор может пропускать комментарии с равными ключами
+            Comment.uuid if asc_order else Comment.uuid.desc(),
+        ),
+        f"{order_by}:{'asc' if asc_order else 'desc'}",
     )
-    comments = comments_query.limit(limit).offset(offset).all()
+    comments_query = keyset.paginate(comments_query, cursor, limit)
+    if cursor is None:
+        comments_query = comments_query.offset(offset)
+    rows, next_cursor = keyset.page((await db.session.execute(comments_query)).all(), limit)
+    comments = [row.Comment for row in rows]
     if not comments:
         raise ObjectNotFound(Comment, 'all')
-    if user and "rating.comment.review" in [scope['name'] for scope in user.get('session_scopes')]:
-        result = CommentGetAllWithAllInfo(limit=limit, offset=offset, total=len(comments))
+    if is_reviewer:
+        result = CommentGetAllWithAllInfo(limit=limit, offset=offset, total=total, next_cursor=next_cursor)
         comment_validator = CommentGetWithAllInfo
     elif user and user.get('id') == user_id:
-        result = CommentGetAllWithStatus(limit=limit, offset=offset, total=len(comments))
+        result = CommentGetAllWithStatus(limit=limit, offset=offset, total=total, next_cursor=next_cursor)
         comment_validator = CommentGetWithStatus
     else:
-        result = CommentGetAll(limit=limit, offset=offset, total=len(comments))
+        result = CommentGetAll(limit=limit, offset=offset, total=total, next_cursor=next_cursor)
         comment_validator = CommentGet
 
     result.comments = comments
 
-    if unreviewed:
-        if not user:
-            raise ForbiddenAction(Comment)
-        if "rating.comment.review" in [scope['name'] for scope in user.get('session_scopes')]:
-            result.comments = [comment for comment in result.comments if comment.review_status is ReviewStatus.PENDING]
-        else:
-            raise ForbiddenAction(Comment)
-    else:
-        result.comments = [comment for comment in result.comments if comment.review_status is ReviewStatus.APPROVED]
-
-    result.total = len(result.comments)
     comments_with_like = []
     current_user_id = user.get("id") if user else None
 
     if current_user_id and result.comments:
-        user_reactions = Comment.reactions_for_comments(current_user_id, db.session, result.comments)
+        user_reactions = await Comment.reactions_for_comments(current_user_id, db.session, result.comments)
     else:
         user_reactions = {}
 
@@ -301,9 +414,39 @@ async def get_comments(
         comments_with_like.append(base_data)
 
     result.comments = comments_with_like
+    if cache_key is not None:
+        tag = lecturer_tag(lecturer_id) if lecturer_id is not None else COMMENT_LIST_TAG
+        await cache.set(cache_key, result.model_dump_json(), tags=[tag])
     return result
 
 
+@comment.post("/review-queue/claim", response_model=CommentReviewClaim)
+async def claim_review_queue(
+    n: int = Query(default=10, ge=1, le=settings.REVIEW_CLAIM_LIMIT),
+    user=Depends(UnionAuth(scopes=["rating.comment.review"], auto_error=True, allow_none=True)),
+) -> CommentReviewClaim:
+    """
+    Scopes: `["rating.comment.review"]`
+
+    Выдает модератору до `n` самых старых отзывов со статусом PENDING и закрепляет их за ним
+    на `REVIEW_CLAIM_LEASE` секунд
+
+    Закрепленные за другим модератором отзывы не выдаются, пока не истечет закрепление:
+    несколько модераторов разбирают очередь параллельно и не проверяют одни и те же отзывы.
+    Повторный запрос модератора снова выдает его еще не проверенные отзывы и продлевает закрепление
+
+    Проверить закрепленный отзыв через `PATCH /comment/{uuid}/review` может только модератор, за которым он закреплен
+
+    `claimed_until` в ответе - время окончания закрепления
+    """
+    claimed_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.REVIEW_CLAIM_LEASE)
+    claimed = await Comment.claim_for_review(user.get("id"), n, claimed_until, session=db.session)
+    await db.session.commit()
+    return CommentReviewClaim(
+        comments=[CommentGetWithAllInfo.model_validate(comment) for comment in claimed], claimed_until=claimed_until
+    )
+
+
 @comment.patch("/{uuid}/review", response_model=CommentGetWithAllInfo)
 async def review_comment(
     uuid: UUID,
@@ -323,15 +466,36 @@ async def review_comment(
     Отклоненные комментарии не отображаются в обычных GET-запросах(можно посмотреть только через `uuid`)
 
     Исключение **ObjectNotFound**, если `uuid` не найден
+
+    Исключение **CommentClaimed**, если отзыв закреплен за другим модератором через `/comment/review-queue/claim`
     """
-    check_comment: Comment = Comment.query(session=db.session).filter(Comment.uuid == uuid).one_or_none()
+    # Строка блокируется до коммита: параллельная проверка того же отзыва не посчитает публикацию дважды
+    check_comment: Comment = (
+        await db.session.scalars(Comment.aquery().where(Comment.uuid == uuid).with_for_update())
+    ).one_or_none()
 
     if not check_comment:
         raise ObjectNotFound(Comment, uuid)
+    if check_comment.is_claimed_by_other(user.get("id")):
+        raise CommentClaimed(check_comment.review_claimed_by, check_comment.review_claimed_until)
 
-    return CommentGetWithAllInfo.model_validate(
-        Comment.update(session=db.session, id=uuid, review_status=review_status, approved_by=user.get("id"))
+    published_before = PublishedComment.of(check_comment)
+    # update_ts входит в версию данных преподавателя для ETag: без него замена одного опубликованного отзыва
+    # другим с теми же оценками не меняет версию
+    reviewed_comment = await Comment.aupdate(
+        session=db.session,
+        id=uuid,
+        review_status=review_status,
+        approved_by=user.get("id"),
+        update_ts=datetime.datetime.utcnow(),
     )
+    # Проверенный отзыв ушел из очереди модерации, закрепление больше не нужно
+    reviewed_comment.review_claimed_by = None
+    reviewed_comment.review_claimed_until = None
+    await Comment.update_published([published_before], [PublishedComment.of(reviewed_comment)], session=db.session)
+    await db.session.commit()
+    await invalidate_lecturers(reviewed_comment.lecturer_id)
+    return CommentGetWithAllInfo.model_validate(reviewed_comment)
 
 
 @comment.patch("/{uuid}", response_model=CommentGet)
@@ -347,7 +511,7 @@ async def update_comment(uuid: UUID, comment_update: CommentUpdate, user=Depends
 
     Исключение **ForbiddenAction** при попытке отредактировать анонимный комментарий
     """
-    comment: Comment = Comment.get(session=db.session, id=uuid)  # Ошибка, если не найден
+    comment: Comment = await Comment.aget(session=db.session, id=uuid, for_update=True)  # Ошибка, если не найден
 
     if comment.user_id != user.get("id") or comment.user_id is None:
         raise ForbiddenAction(Comment)
@@ -356,17 +520,22 @@ async def update_comment(uuid: UUID, comment_update: CommentUpdate, user=Depends
     update_data = comment_update.model_dump(exclude_unset=True)
 
     # Обновляем комментарий
-    updated_comment = Comment.update(
+    published_before = PublishedComment.of(comment)
+    updated_comment = await Comment.aupdate(
         session=db.session,
         id=uuid,
         **update_data,
         update_ts=datetime.datetime.utcnow(),
         review_status=ReviewStatus.PENDING,
     )
+    await Comment.update_published([published_before], session=db.session)
+    await db.session.commit()
+    await invalidate_lecturers(comment.lecturer_id)
 
+    user_reactions = await Comment.reactions_for_comments(user.get("id"), db.session, [comment])
     updated_comment = CommentGet.model_validate(updated_comment)
-    updated_comment.is_liked = comment.has_reaction(user.get("id"), Reaction.LIKE)
-    updated_comment.is_disliked = comment.has_reaction(user.get("id"), Reaction.DISLIKE)
+    updated_comment.is_liked = user_reactions.get(comment.uuid) == Reaction.LIKE
+    updated_comment.is_disliked = user_reactions.get(comment.uuid) == Reaction.DISLIKE
     return updated_comment
 
 
@@ -390,7 +559,7 @@ async def delete_comment(
 
     Исключение **ForbiddenAction** при попытке удалить комментарий пользователем без прав
     """
-    comment = Comment.get(uuid, session=db.session)
+    comment = await Comment.aget(uuid, session=db.session, for_update=True)
     if comment is None:
         raise ObjectNotFound(Comment, uuid)
     # Наличие скоупа для удаления любых комментариев
@@ -399,7 +568,11 @@ async def delete_comment(
     # Если нет привилегии - проверяем права обычного пользователя
     if not has_delete_scope and (comment.user_id == None or comment.user_id != user.get('id')):
         raise ForbiddenAction(Comment)
-    Comment.delete(session=db.session, id=uuid)
+    published_before = PublishedComment.of(comment)
+    await Comment.adelete(session=db.session, id=uuid)
+    await Comment.update_published([published_before], session=db.session)
+    await db.session.commit()
+    await invalidate_lecturers(comment.lecturer_id)
 
     return StatusResponseModel(
         status="Success", message="Comment has been deleted", ru="Комментарий удален из RatingAPI"
@@ -426,28 +599,44 @@ async def like_comment(
 
     Исключение **ObjectNotFound**, если `uuid` не найден
     """
-    comment = Comment.get(session=db.session, id=uuid)
+    # Строка отзыва блокируется до конца транзакции, чтобы параллельные нажатия одного пользователя
+    # видели реакцию друг друга и не сдвигали счетчики дважды
+    comment = await Comment.aget(session=db.session, id=uuid, for_update=True)
     if not comment:
         raise ObjectNotFound(Comment, uuid)
 
     existing_reaction = (
-        CommentReaction.query(session=db.session)
-        .filter(
-            CommentReaction.user_id == user.get("id"),
-            CommentReaction.comment_uuid == comment.uuid,
+        await db.session.scalars(
+            CommentReaction.aquery().where(
+                CommentReaction.user_id == user.get("id"),
+                CommentReaction.comment_uuid == comment.uuid,
+            )
         )
-        .first()
-    )
+    ).first()
 
     comment.is_liked = reaction == Reaction.LIKE
     comment.is_disliked = reaction == Reaction.DISLIKE
+    # Изменение счетчиков лайков и дизлайков, пишется в той же транзакции, что и реакция
+    deltas = {Reaction.LIKE: 0, Reaction.DISLIKE: 0}
 
     if existing_reaction and existing_reaction.reaction != reaction:
-        new_reaction = CommentReaction.update(session=db.session, id=existing_reaction.uuid, reaction=reaction)
+        deltas[existing_reaction.reaction] -= 1
+        deltas[reaction] += 1
+        new_reaction = await CommentReaction.aupdate(session=db.session, id=existing_reaction.uuid, reaction=reaction)
     elif not existing_reaction:
-        CommentReaction.create(session=db.session, user_id=user.get("id"), comment_uuid=comment.uuid, reaction=reaction)
+        await CommentReaction.acreate(
+            session=db.session, user_id=user.get("id"), comment_uuid=comment.uuid, reaction=reaction
+        )
+        deltas[reaction] += 1
     else:
         comment.is_disliked = False
         comment.is_liked = False
-        CommentReaction.delete(session=db.session, id=existing_reaction.uuid)
+        await CommentReaction.adelete(session=db.session, id=existing_reaction.uuid)
+        deltas[reaction] -= 1
+    await comment.update_reaction_counters(
+        like_delta=deltas[Reaction.LIKE], dislike_delta=deltas[Reaction.DISLIKE], session=db.session
+    )
+    await db.session.commit()
+    # Счетчики реакций входят в кэшированный ответ преподавателя
+    await invalidate_lecturers(comment.lecturer_id)
     return CommentGet.model_validate(comment)
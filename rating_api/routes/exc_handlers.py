@@ -3,13 +3,16 @@ from starlette.responses import JSONResponse
 
 from rating_api.exceptions import (
     AlreadyExists,
+    CommentClaimed,
     CommentTooLong,
     ForbiddenAction,
     ForbiddenSymbol,
+    InvalidCursor,
     ObjectNotFound,
     TooManyCommentRequests,
     TooManyCommentsToLecturer,
     UpdateError,
+    WrongImportFormat,
     WrongMark,
 )
 from rating_api.schemas.base import StatusResponseModel
@@ -78,3 +81,24 @@ async def update_error_handler(req: starlette.requests.Request, exc: UpdateError
     return JSONResponse(
         content=StatusResponseModel(status="Error", message=exc.eng, ru=exc.ru).model_dump(), status_code=409
     )
+
+
+@app.exception_handler(CommentClaimed)
+async def comment_claimed_handler(req: starlette.requests.Request, exc: CommentClaimed):
+    return JSONResponse(
+        content=StatusResponseModel(status="Error", message=exc.eng, ru=exc.ru).model_dump(), status_code=409
+    )
+
+
+@app.exception_handler(InvalidCursor)
+async def invalid_cursor_handler(req: starlette.requests.Request, exc: InvalidCursor):
+    return JSONResponse(
+        content=StatusResponseModel(status="Error", message=exc.eng, ru=exc.ru).model_dump(), status_code=400
+    )
+
+
+@app.exception_handler(WrongImportFormat)
+async def wrong_import_format_handler(req: starlette.requests.Request, exc: WrongImportFormat):
+    return JSONResponse(
+        content=StatusResponseModel(status="Error", message=exc.eng, ru=exc.ru).model_dump(), status_code=400
+    )
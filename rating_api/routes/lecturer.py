@@ -2,28 +2,45 @@ import datetime
 from typing import Literal
 
 from auth_lib.fastapi import UnionAuth
-from fastapi import APIRouter, Depends, Query
-from fastapi.exceptions import ValidationException
+from fastapi import APIRouter, Depends, Query, Request, Response
 from fastapi_filter import FilterDepends
-from fastapi_sqlalchemy import db
-from sqlalchemy import and_
+from sqlalchemy import and_, delete, func, not_, select, update
+from sqlalchemy.orm import selectinload
 
 from rating_api.exceptions import AlreadyExists, ObjectNotFound
-from rating_api.models import Comment, Lecturer, LecturerUserComment, ReviewStatus
+from rating_api.models import (
+    Comment,
+    CommentLimitCounter,
+    Lecturer,
+    LecturerStats,
+    LecturerSubject,
+    LecturerUserComment,
+)
 from rating_api.schemas.base import StatusResponseModel
 from rating_api.schemas.models import (
+    CacheStats,
     CommentGet,
     LecturerGet,
     LecturerGetAll,
     LecturerPatch,
     LecturerPost,
     LecturersFilter,
+    LecturerSuggest,
     LecturerUpdateRatingPatch,
     LecturerWithRank,
 )
+from rating_api.settings import Settings, get_settings
+from rating_api.utils.cache import cache, invalidate_lecturers, lecturer_tag
+from rating_api.utils.cursor import Keyset
+from rating_api.utils.db import db
+from rating_api.utils.etag import etag_matches, make_etag, not_modified
+from rating_api.utils.metrics import TimedRoute
+from rating_api.utils.ndjson import iter_ndjson_batches
+from rating_api.utils.suggest import suggest_index
 
 
-lecturer = APIRouter(prefix="/lecturer", tags=["Lecturer"])
+settings: Settings = get_settings()
+lecturer = APIRouter(prefix="/lecturer", tags=["Lecturer"], route_class=TimedRoute)
 
 
 @lecturer.post("", response_model=LecturerGet)
@@ -39,15 +56,35 @@ async def create_lecturer(
     Исключение **AlreadyExists**, если преподаватель с введеным `timetable_id` уже существует
     """
     get_lecturer: Lecturer = (
-        Lecturer.query(session=db.session).filter(Lecturer.timetable_id == lecturer_info.timetable_id).one_or_none()
-    )
+        await db.session.scalars(Lecturer.aquery().where(Lecturer.timetable_id == lecturer_info.timetable_id))
+    ).one_or_none()
     if get_lecturer is None:
-        new_lecturer: Lecturer = Lecturer.create(session=db.session, **lecturer_info.model_dump())
-        db.session.commit()
+        new_lecturer: Lecturer = await Lecturer.acreate(session=db.session, **lecturer_info.model_dump())
+        await db.session.commit()
+        suggest_index.upsert(new_lecturer)
         return LecturerGet.model_validate(new_lecturer)
     raise AlreadyExists(Lecturer, lecturer_info.timetable_id)
 
 
+async def _import_rating_batch(
+    lecturer_rank_info: list[LecturerWithRank],
+    response: LecturerUpdateRatingPatch,
+    rank_update_ts: datetime.datetime,
+) -> None:
+    """Обновляет пачку рейтингов и дописывает результат в `response`"""
+    updated_ids = await Lecturer.bulk_update_rating(
+        [lecturer_rank.model_dump() | {"rank_update_ts": rank_update_ts} for lecturer_rank in lecturer_rank_info],
+        session=db.session,
+    )
+    for lecturer_rank in lecturer_rank_info:
+        if lecturer_rank.id in updated_ids:
+            response.updated += 1
+            response.updated_id.append(lecturer_rank.id)
+        else:
+            response.failed += 1
+            response.failed_id.append(lecturer_rank.id)
+
+
 @lecturer.patch("/import_rating", response_model=LecturerUpdateRatingPatch)
 async def update_lecturer_rating(
     lecturer_rank_info: list[LecturerWithRank],
@@ -57,40 +94,82 @@ async def update_lecturer_rating(
     Scopes: `["rating.lecturer.update_rating"]`
 
     Обновляет рейтинг преподавателя в базе данных
+
+    Рейтинги обновляются пачками по `RATING_IMPORT_CHUNK_SIZE` одним запросом на пачку.
+    Не найденные и удаленные преподаватели попадают в `failed_id`
     """
-    updated_lecturers = []
-    response = {
-        "updated": 0,
-        "failed": 0,
-        "updated_id": [],
-        "failed_id": [],
-    }
-    for lecturer_rank in lecturer_rank_info:
-        success_fl = True
-        try:
-            LecturerWithRank.model_validate(lecturer_rank)
-        except ValidationException:
-            success_fl = False
+    response = LecturerUpdateRatingPatch(updated=0, failed=0, updated_id=[], failed_id=[])
+    rank_update_ts = datetime.datetime.utcnow()
+    for start in range(0, len(lecturer_rank_info), settings.RATING_IMPORT_CHUNK_SIZE):
+        await _import_rating_batch(
+            lecturer_rank_info[start : start + settings.RATING_IMPORT_CHUNK_SIZE], response, rank_update_ts
+        )
+    await db.session.commit()
+    await invalidate_lecturers(*response.updated_id)
+    return response
+
+
+@lecturer.patch(
+    "/import_rating/ndjson",
+    response_model=LecturerUpdateRatingPatch,
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/x-ndjson": {"schema": {"$ref": "#/components/schemas/LecturerWithRank"}}}
+        }
+    },
+)
+async def update_lecturer_rating_ndjson(
+    request: Request,
+    _=Depends(UnionAuth(scopes=["rating.lecturer.update_rating"], allow_none=False, auto_error=True)),
+) -> LecturerUpdateRatingPatch:
+    """
+    Scopes: `["rating.lecturer.update_rating"]`
 
-        lecturer_rank_dumped = lecturer_rank.model_dump()
-        lecturer_rank_dumped["rank_update_ts"] = datetime.datetime.now(tz=datetime.timezone.utc)
+    Обновляет рейтинг преподавателей из потока NDJSON: одна строка - один `LecturerWithRank`.
+    Для больших выгрузок тело можно сжать gzip и передать заголовок `Content-Encoding: gzip`.
+    Тело читается потоково, в памяти держится одна пачка из `RATING_IMPORT_CHUNK_SIZE` строк
 
-        lecturer_id = lecturer_rank_dumped.pop("id")
+    Строки, не прошедшие валидацию, попадают в `failed` (и в `failed_id`, если в строке есть `id`)
 
-        if Lecturer.get(id=lecturer_id, session=db.session):
-            updated_lecturers.append(Lecturer.update(id=lecturer_id, session=db.session, **lecturer_rank_dumped))
-        else:
-            success_fl = False
+    Исключение **WrongImportFormat**, если тело не удалось распаковать
+    """
+    response = LecturerUpdateRatingPatch(updated=0, failed=0, updated_id=[], failed_id=[])
+    rank_update_ts = datetime.datetime.utcnow()
+    async for batch, failed_ids in iter_ndjson_batches(
+        request.stream(),
+        LecturerWithRank,
+        settings.RATING_IMPORT_CHUNK_SIZE,
+        gzipped=request.headers.get("content-encoding") == "gzip",
+    ):
+        await _import_rating_batch(batch, response, rank_update_ts)
+        response.failed += len(failed_ids)
+        response.failed_id.extend(failed_id for _, failed_id in failed_ids if isinstance(failed_id, int))
+    await db.session.commit()
+    await invalidate_lecturers(*response.updated_id)
+    return response
+
+
+@lecturer.post("/recompute_rating", response_model=StatusResponseModel)
+async def recompute_lecturer_rating(
+    _=Depends(UnionAuth(scopes=["rating.lecturer.update_rating"], allow_none=False, auto_error=True)),
+) -> StatusResponseModel:
+    """
+    Scopes: `["rating.lecturer.update_rating"]`
 
-        if success_fl:
-            response["updated"] += 1
-            response["updated_id"].append(lecturer_id)
-        else:
-            response["failed"] += 1
-            response["failed_id"].append(lecturer_id)
-    response_validated = LecturerUpdateRatingPatch.model_validate(response)
+    Пересчитывает взвешенные оценки и места всех преподавателей по опубликованным отзывам
 
-    return response_validated
+    Ручки отзывов пересчитывают оценки только затронутых преподавателей, а средняя оценка по всем отзывам,
+    с которой они взвешиваются, у остальных остается прежней до фонового пересчета
+    раз в `WEIGHTED_MARKS_REFRESH_INTERVAL` секунд. Ручка выравнивает всех сразу
+    """
+    marks = await Lecturer.update_weighted_marks(session=db.session)
+    await db.session.commit()
+    await invalidate_lecturers(*marks)
+    return StatusResponseModel(
+        status="Success",
+        message=f"Rating of {len(marks)} lecturers has been recomputed",
+        ru=f"Рейтинг {len(marks)} преподавателей пересчитан",
+    )
 
 
 @lecturer.get("/timetable-id/{timetable_id}", response_model=LecturerGet)
@@ -100,14 +179,58 @@ async def get_lecturer_by_timetable_id(timetable_id: int) -> LecturerGet:
 
     Исключение **ObjectNotFound**, если `timetable_id` не найден
     """
-    lecturer: Lecturer = Lecturer.query(session=db.session).filter(Lecturer.timetable_id == timetable_id).one_or_none()
-    if lecturer is None:
+    cache_key = f"lecturer:timetable_id:{timetable_id}"
+    if (cached := await cache.get(cache_key)) is not None:
+        result = LecturerGet.model_validate_json(cached)
+        # Место меняется вместе с оценками других преподавателей, поэтому не кэшируется
+        result.rank = await db.session.scalar(
+            select(Lecturer.current_rank()).where(Lecturer.id == result.id, not_(Lecturer.is_deleted))
+        )
+        return result
+    row = (
+        await db.session.execute(
+            Lecturer.aquery()
+            .where(Lecturer.timetable_id == timetable_id)
+            .add_columns(Lecturer.current_rank().label("rank"))
+            .options(selectinload(Lecturer.approved_comments))
+        )
+    ).one_or_none()
+    if row is None:
         raise ObjectNotFound(Lecturer, timetable_id)
-    return LecturerGet.model_validate(lecturer)
+    result = LecturerGet.model_validate(row.Lecturer)
+    result.comments = [CommentGet.model_validate(comment) for comment in row.Lecturer.approved_comments] or None
+    await cache.set(cache_key, result.model_dump_json(), tags=[lecturer_tag(row.Lecturer.id)])
+    result.rank = row.rank
+    return result
+
+
+@lecturer.get("/cache/stats", response_model=CacheStats)
+async def get_lecturer_cache_stats() -> CacheStats:
+    """
+    Возвращает счетчики попаданий и промахов кэша ответов GET ручек преподавателей и отзывов
+
+    Счетчики свои у каждого процесса приложения, размер - общий для кэша в Redis
+    """
+    return CacheStats(**await cache.stats())
+
+
+@lecturer.get("/suggest", response_model=list[LecturerSuggest])
+async def suggest_lecturers(
+    q: str = Query(min_length=1, max_length=100), limit: int = Query(default=10, ge=1, le=50)
+) -> list[LecturerSuggest]:
+    """
+    Подсказки для строки поиска преподавателя: id, ФИО и аватар
+
+    Возвращает до `limit` преподавателей, у которых каждое слово `q` является началом одного из слов ФИО.
+    Регистр и ё/е не учитываются. Отвечает из индекса в памяти, без запросов к БД
+    """
+    return await suggest_index.search(q, limit)
 
 
 @lecturer.get("/{id}", response_model=LecturerGet)
-async def get_lecturer(id: int, info: list[Literal["comments"]] = Query(default=[])) -> LecturerGet:
+async def get_lecturer(
+    id: int, request: Request, response: Response, info: list[Literal["comments"]] = Query(default=[])
+) -> LecturerGet:
     """
     Scopes: `["rating.lecturer.read"]`
 
@@ -117,23 +240,43 @@ async def get_lecturer(id: int, info: list[Literal["comments"]] = Query(default=
     Если передано `'comments'`, то возвращаются одобренные комментарии к преподавателю.
     Subject лектора возвращается либо из базы данных, либо из любого аппрувнутого комментария
 
+    `rank` - место по текущей `mark_weighted`: 1 + число преподавателей с большей оценкой
+
+    В ответе есть заголовок `ETag`. Если он передан в `If-None-Match` и данные не изменились,
+    возвращается 304 без тела
+
     Исключение **ObjectNotFound**, если `id` не найден
     """
-    lecturer: Lecturer = Lecturer.query(session=db.session).filter(Lecturer.id == id).one_or_none()
-    if lecturer is None:
+    version = await Lecturer.version_stamp(id, session=db.session)
+    if version is None:
         raise ObjectNotFound(Lecturer, id)
-    result = LecturerGet.model_validate(lecturer)
-    result.comments = None
-    if lecturer.comments:
-        approved_comments: list[CommentGet] = [
-            CommentGet.model_validate(comment)
-            for comment in lecturer.comments
-            if comment.review_status is ReviewStatus.APPROVED
-        ]
-        if "comments" in info and approved_comments:
-            result.comments = sorted(approved_comments, key=lambda comment: comment.create_ts, reverse=True)
-        if approved_comments:
-            result.subjects = list({comment.subject for comment in approved_comments})
+    # Место меняется вместе с оценками других преподавателей, поэтому берется из версии и не кэшируется
+    etag = make_etag("lecturer", id, "comments" in info, *version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    # Тело кэшируется под версией данных, от которой посчитан ETag, чтобы старое тело не ушло с новым ETag.
+    # Место в тело не входит, поэтому и в ключ тоже
+    body_version = make_etag(*(value for name, value in version._mapping.items() if name != "current_rank"))
+    cache_key = f"lecturer:id:{id}:{'comments' in info}:{body_version}"
+    if (cached := await cache.get(cache_key)) is not None:
+        result = LecturerGet.model_validate_json(cached)
+    else:
+        lecturer_query = (
+            Lecturer.aquery()
+            .where(Lecturer.id == id)
+            .add_columns(LecturerSubject.lecturer_subjects().label("subjects"))
+        )
+        if "comments" in info:
+            lecturer_query = lecturer_query.options(selectinload(Lecturer.approved_comments))
+        row = (await db.session.execute(lecturer_query)).one_or_none()
+        if row is None:
+            raise ObjectNotFound(Lecturer, id)
+        result = LecturerGet.model_validate(row.Lecturer)
+        result.subjects = row.subjects
+        result.comments = [CommentGet.model_validate(comment) for comment in row.Lecturer.approved_comments] or None
+        await cache.set(cache_key, result.model_dump_json(), tags=[lecturer_tag(id)])
+    result.rank = version.current_rank
     return result
 
 
@@ -142,6 +285,7 @@ async def get_lecturers(
     lecturer_filter=FilterDepends(LecturersFilter),
     limit: int = 10,
     offset: int = 0,
+    cursor: str | None = None,
     info: list[Literal["comments"]] = Query(default=[]),
     mark: float = Query(default=None, ge=-2, le=2),
 ) -> LecturerGetAll:
@@ -150,8 +294,13 @@ async def get_lecturers(
 
     `offset` - нижняя граница получения преподавателей, т.е. если по дефолту первым возвращается преподаватель с условным номером N, то при наличии ненулевого offset будет возвращаться преподаватель с номером N + offset
 
-    `order_by` - возможные значения `"mark_weighted", "mark_kindness", "mark_freebie", "mark_clarity", "mark_general", "last_name"`.
+    `cursor` - курсор следующей страницы из `next_cursor` предыдущего ответа с теми же параметрами.
+    Если передан, то `offset` не учитывается, а страница выбирается сразу после последнего преподавателя предыдущей.
+    Стоимость такого запроса не зависит от глубины страницы
+
+    `order_by` - возможные значения `"mark_weighted", "mark_kindness", "mark_freebie", "mark_clarity", "mark_general", "last_name", "relevance"`.
     Если передано `'last_name'` - возвращается список преподавателей отсортированных по алфавиту по фамилиям
+    Если передано `'relevance'` - сначала идут преподаватели, ФИО которых больше всего похоже на `name`
     Если передано `'mark_...'` - возвращается список преподавателей отсортированных по конкретной оценке
     Если передано просто так (или с '+' в начале параметра), то сортирует по возрастанию
     С '-' в начале -- по убыванию.
@@ -164,12 +313,15 @@ async def get_lecturers(
     `info` - возможные значения `'comments'`.
     Если передано `'comments'`, то возвращаются одобренные комментарии к преподавателю.
 
+    `rank` в ответе - место по текущей `mark_weighted`, как в `GET /lecturer/{id}`
+
     `subject`
     Если передано `subject` - возвращает всех преподавателей, для которых переданное значение совпадает с одним из их предметов преподавания.
     Также возвращает всех преподавателей, у которых есть комментарий с совпадающим с данным subject.
 
     `name`
-    Поле для ФИО. Если передано `name` - возвращает всех преподователей, для которых нашлись совпадения с переданной строкой
+    Поле для ФИО. Если передано `name` - возвращает всех преподователей, для которых нашлись совпадения с переданной строкой.
+    Каждое слово должно встречаться в ФИО или отличаться от слова ФИО опечаткой, регистр и ё/е не учитываются
 
     `mark`
     Поле для оценки. Если передано, то возвращает только тех преподавателей, для которых средняя общая оценка ('general_mark')
@@ -177,35 +329,38 @@ async def get_lecturers(
 
     Исключение **ObjectNotFound**, если преподаватель с введенными параметрами не найден
     """
-    lecturers_query = lecturer_filter.filter(
-        Lecturer.query(session=db.session).outerjoin(Lecturer.comments).group_by(Lecturer.id)
+    # Предметы берутся из lecturer_subject подзапросом, который выполняется только для лекторов страницы
+    subjects = LecturerSubject.lecturer_subjects()
+    lecturers_query = lecturer_filter.filter(Lecturer.aquery().where(Lecturer.search_by_mark(mark)))
+    keyset = Keyset(lecturer_filter.order_by_clauses() or (Lecturer.id,), ",".join(lecturer_filter.order_by))
+    # Места всех преподавателей считаются одним проходом по индексу оценок, а не подзапросом на каждую строку
+    ranking = Lecturer.ranking()
+    page_query = keyset.paginate(
+        lecturers_query.add_columns(subjects.label("subjects"), ranking.c.rank).join(
+            ranking, ranking.c.id == Lecturer.id
+        ),
+        cursor,
+        limit,
     )
-    lecturers_query = lecturer_filter.sort(lecturers_query)
-    lecturers = lecturers_query.offset(offset).limit(limit).all()
-    lecturers_count = lecturers_query.group_by(Lecturer.id).count()
-
-    result = LecturerGetAll(limit=limit, offset=offset, total=lecturers_count)
-    for db_lecturer in lecturers:
+    if "comments" in info:
+        page_query = page_query.options(selectinload(Lecturer.approved_comments))
+    if cursor is None:
+        page_query = page_query.offset(offset)
+    lecturers, next_cursor = keyset.page((await db.session.execute(page_query)).all(), limit)
+    # total не зависит от сортировки, поэтому считается без ORDER BY и без подзапроса предметов
+    lecturers_count = await db.session.scalar(lecturers_query.with_only_columns(func.count()))
+
+    result = LecturerGetAll(limit=limit, offset=offset, total=lecturers_count, next_cursor=next_cursor)
+    for row in lecturers:
+        db_lecturer = row.Lecturer
         lecturer_to_result: LecturerGet = LecturerGet.model_validate(db_lecturer)
+        lecturer_to_result.subjects = row.subjects
+        lecturer_to_result.rank = row.rank
         lecturer_to_result.comments = None
-        if db_lecturer.comments:
-            approved_comments: list[CommentGet] = [
-                CommentGet.model_validate(comment)
-                for comment in db_lecturer.comments
-                if comment.review_status is ReviewStatus.APPROVED
+        if db_lecturer.approved_comments:
+            lecturer_to_result.comments = [
+                CommentGet.model_validate(comment) for comment in db_lecturer.approved_comments
             ]
-            if (
-                mark is not None
-                and approved_comments
-                and sum(comment.mark_general for comment in approved_comments) / len(approved_comments) <= mark
-            ):
-                continue
-            if "comments" in info and approved_comments:
-                lecturer_to_result.comments = sorted(
-                    approved_comments, key=lambda comment: comment.create_ts, reverse=True
-                )
-            if approved_comments:
-                lecturer_to_result.subjects = list({comment.subject for comment in approved_comments})
         result.lecturers.append(lecturer_to_result)
     if len(result.lecturers) == 0:
         raise ObjectNotFound(Lecturer, 'all')
@@ -225,21 +380,25 @@ async def update_lecturer(
 
     Исключение **ObjectNotFound**, если `id` не найден
     """
-    lecturer = Lecturer.get(id, session=db.session)
+    lecturer = await Lecturer.aget(id, session=db.session)
     if lecturer is None:
         raise ObjectNotFound(Lecturer, id)
 
     check_timetable_id = (
-        Lecturer.query(session=db.session)
-        .filter(and_(Lecturer.timetable_id == lecturer_info.timetable_id, Lecturer.id != id))
-        .one_or_none()
-    )
+        await db.session.scalars(
+            Lecturer.aquery().where(and_(Lecturer.timetable_id == lecturer_info.timetable_id, Lecturer.id != id))
+        )
+    ).one_or_none()
     if check_timetable_id:
         raise AlreadyExists(Lecturer, lecturer_info.timetable_id)
 
-    result = LecturerGet.model_validate(
-        Lecturer.update(lecturer.id, **lecturer_info.model_dump(exclude_unset=True), session=db.session)
+    updated_lecturer = await Lecturer.aupdate(
+        lecturer.id, **lecturer_info.model_dump(exclude_unset=True), session=db.session
     )
+    result = LecturerGet.model_validate(updated_lecturer)
+    await db.session.commit()
+    await invalidate_lecturers(id)
+    suggest_index.upsert(updated_lecturer)
     result.comments = None
     return result
 
@@ -255,17 +414,28 @@ async def delete_lecturer(
 
     Исключение **ObjectNotFound**, если `id` не найден
     """
-    check_lecturer = Lecturer.get(session=db.session, id=id)
+    check_lecturer = await Lecturer.aget(session=db.session, id=id)
     if check_lecturer is None:
         raise ObjectNotFound(Lecturer, id)
-    for comment in check_lecturer.comments:
-        Comment.delete(id=comment.uuid, session=db.session)
+    # Мягко удаляем все связанные записи одним запросом на таблицу
+    await db.session.execute(
+        update(Comment).where(Comment.lecturer_id == id, not_(Comment.is_deleted)).values(is_deleted=True)
+    )
+    await db.session.execute(
+        update(LecturerUserComment)
+        .where(LecturerUserComment.lecturer_id == id, not_(LecturerUserComment.is_deleted))
+        .values(is_deleted=True)
+    )
 
-    lecturer_user_comments = LecturerUserComment.query(session=db.session).filter(LecturerUserComment.lecturer_id == id)
-    for lecturer_user_comment in lecturer_user_comments:
-        LecturerUserComment.delete(lecturer_user_comment.id, session=db.session)
+    for statement in CommentLimitCounter.forget_lecturer_statements(id):
+        await db.session.execute(statement)
+    await db.session.execute(delete(LecturerSubject).where(LecturerSubject.lecturer_id == id))
+    await LecturerStats.remove(id, session=db.session)
 
-    Lecturer.delete(session=db.session, id=id)
+    await Lecturer.adelete(session=db.session, id=id)
+    await db.session.commit()
+    await invalidate_lecturers(id)
+    suggest_index.remove(id)
     return StatusResponseModel(
         status="Success", message="Lecturer has been deleted", ru="Преподаватель удален из RatingAPI"
     )
@@ -39,6 +39,10 @@ class CommentGetWithAllInfo(CommentGet):
     approved_by: int | None = None
 
 
+# Допустимые оценки отзыва
+MARK_VALUES = frozenset({-2, -1, 0, 1, 2})
+
+
 class CommentUpdate(Base):
     subject: str = None
     text: str = None
@@ -49,32 +53,52 @@ class CommentUpdate(Base):
     @field_validator('mark_kindness', 'mark_freebie', 'mark_clarity')
     @classmethod
     def validate_mark(cls, value):
-        if value not in [-2, -1, 0, 1, 2]:
+        if value not in MARK_VALUES:
             raise WrongMark()
         return value
 
 
-class CommentPost(CommentUpdate):
+class CommentTimestamps(CommentUpdate):
     create_ts: datetime.datetime | None = None
     update_ts: datetime.datetime | None = None
+
+    @field_validator('create_ts', 'update_ts')
+    @classmethod
+    def drop_tzinfo(cls, value: datetime.datetime | None) -> datetime.datetime | None:
+        """
+        В БД время хранится в UTC без часового пояса, asyncpg не принимает aware datetime для таких колонок.
+        Время с часовым поясом сначала переводится в UTC
+        """
+        if value is not None and value.tzinfo is not None:
+            return value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value
+
+
+class CommentPost(CommentTimestamps):
     is_anonymous: bool = True
 
 
-class CommentImport(CommentUpdate):
+class CommentImport(CommentTimestamps):
     lecturer_id: int
-    create_ts: datetime.datetime | None = None
-    update_ts: datetime.datetime | None = None
 
 
 class CommentImportAll(Base):
     comments: list[CommentImport]
 
 
+class CommentImportResult(Base):
+    imported: int
+    failed: int
+    imported_uuid: list[UUID]
+    failed_lines: list[int]
+
+
 class CommentGetAll(Base):
     comments: list[CommentGet] = []
     limit: int
     offset: int
     total: int
+    next_cursor: str | None = None
 
 
 class CommentGetAllWithStatus(Base):
@@ -82,6 +106,7 @@ class CommentGetAllWithStatus(Base):
     limit: int
     offset: int
     total: int
+    next_cursor: str | None = None
 
 
 class CommentGetAllWithAllInfo(Base):
@@ -89,6 +114,12 @@ class CommentGetAllWithAllInfo(Base):
     limit: int
     offset: int
     total: int
+    next_cursor: str | None = None
+
+
+class CommentReviewClaim(Base):
+    comments: list[CommentGetWithAllInfo] = []
+    claimed_until: datetime.datetime
 
 
 class LecturerUserCommentPost(Base):
@@ -128,11 +159,24 @@ class LecturerWithRank(Base):
     update_ts: datetime.datetime | None = None
 
 
+class LecturerSuggest(Base):
+    id: int
+    full_name: str
+    avatar_link: str | None = None
+
+
+class CacheStats(Base):
+    hits: int
+    misses: int
+    size: int
+
+
 class LecturerGetAll(Base):
     lecturers: list[LecturerGet] = []
     limit: int
     offset: int
     total: int
+    next_cursor: str | None = None
 
 
 class LecturerPost(Base):
@@ -170,6 +214,7 @@ class LecturersFilter(Filter):
             "mark_clarity",
             "mark_general",
             "last_name",
+            "relevance",
         }
         cleaned_value = value.replace("+", "").replace("-", "")
         if cleaned_value in allowed_ordering:
@@ -184,22 +229,26 @@ class LecturersFilter(Filter):
             query = query.filter(self.Constants.model.search_by_name(self.name))
         return query
 
-    def sort(self, query: Query) -> Query:
+    def order_by_clauses(self) -> tuple:
+        """Выражения ORDER BY для переданного `order_by`, последним идет уникальный ключ"""
         if not self.ordering_values:
-            return query
+            return ()
         elif len(self.ordering_values) > 1:
             raise ValueError('order_by (хотя бы пока что) поддерживает лишь один параметр для сортировки!')
 
-        for field_name in self.ordering_values:
-            direction = True
-            if field_name.startswith("-"):
-                direction = False
-            field_name = field_name.replace("-", "").replace("+", "")
-            if field_name.startswith('mark_'):
-                query = query.order_by(*self.Constants.model.order_by_mark(field_name, direction))
-            else:
-                query = query.order_by(*self.Constants.model.order_by_name(field_name, direction))
-            return query
+        field_name = self.ordering_values[0]
+        direction = True
+        if field_name.startswith("-"):
+            direction = False
+        field_name = field_name.replace("-", "").replace("+", "")
+        if field_name.startswith('mark_'):
+            return self.Constants.model.order_by_mark(field_name, direction)
+        if field_name == 'relevance':
+            return self.Constants.model.order_by_relevance(self.name, direction)
+        return self.Constants.model.order_by_name(field_name, direction)
+
+    def sort(self, query: Query) -> Query:
+        return query.order_by(*self.order_by_clauses())
 
     class Constants(Filter.Constants):
         model = Lecturer
@@ -1,7 +1,8 @@
 import os
 from functools import lru_cache
+from typing import Literal
 
-from pydantic import ConfigDict, PostgresDsn
+from pydantic import ConfigDict, PostgresDsn, RedisDsn
 from pydantic_settings import BaseSettings
 
 
@@ -21,6 +22,29 @@ class Settings(BaseSettings):
     CORS_ALLOW_METHODS: list[str] = ['*']
     CORS_ALLOW_HEADERS: list[str] = ['*']
     MAX_COMMENT_LENGTH: int = 3000
+    RATING_IMPORT_CHUNK_SIZE: int = 1000  # Строк на один UPDATE при импорте рейтинга
+    COMMENT_IMPORT_CHUNK_SIZE: int = 1000  # Строк на один INSERT при импорте комментариев
+    CACHE_BACKEND: Literal['memory', 'redis'] = 'memory'  # Где хранить кэш ответов GET ручек
+    CACHE_REDIS_DSN: RedisDsn | None = None  # Для memory - канал событий сброса кэша между процессами
+    CACHE_SIZE: int = 4096  # Записей в кэше в памяти процесса, 0 - кэш выключен
+    CACHE_TTL: int = 60  # Время жизни записи в кэше, секунды
+    SLOW_QUERY_THRESHOLD_MS: float = 0  # Логировать SQL запросы дольше порога, 0 - выключено
+    SLOW_QUERY_SAMPLE_RATE: float = 1.0  # Доля медленных запросов, попадающих в лог
+    SLOW_QUERY_EXPLAIN: bool = True  # Добавлять в лог план запроса, это еще один запрос к БД
+    SUGGEST_INDEX_TTL: int = 300  # Через сколько секунд индекс подсказок перечитывается из БД
+    ACHIEVEMENT_TIMEOUT: float = 5  # Таймаут одного запроса к API ачивок, секунды
+    ACHIEVEMENT_POOL_SIZE: int = 10  # Одновременных соединений с API ачивок
+    ACHIEVEMENT_BREAKER_THRESHOLD: int = 5  # Неудач подряд, после которых API ачивок считается недоступным
+    ACHIEVEMENT_BREAKER_COOLDOWN: float = 30  # Сколько секунд не обращаться к недоступному API ачивок
+    OUTBOX_BATCH_SIZE: int = 100  # Событий outbox за одну транзакцию обработчика
+    OUTBOX_POLL_INTERVAL: float = 5  # Как часто обработчик проверяет outbox без новых событий, секунды
+    OUTBOX_RETRY_BACKOFF: float = 1  # Задержка перед первым повтором события, дальше удваивается, секунды
+    OUTBOX_MAX_BACKOFF: float = 3600  # Наибольшая задержка между повторами события, секунды
+    OUTBOX_MAX_ATTEMPTS: int = 10  # Неудачных попыток, после которых событие переходит в FAILED
+    OUTBOX_LEASE: float = 60  # На сколько секунд событие закрепляется за обработчиком, дольше попытка не длится
+    REVIEW_CLAIM_LEASE: int = 900  # На сколько секунд отзывы из очереди модерации закрепляются за модератором
+    REVIEW_CLAIM_LIMIT: int = 100  # Наибольшее число отзывов, выдаваемых модератору за раз
+    WEIGHTED_MARKS_REFRESH_INTERVAL: float = 600  # Как часто все оценки пересчитываются с новой средней, секунды
 
     '''Temp settings'''
 
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import time
+import weakref
+
+import aiohttp
+
+from rating_api.settings import Settings, get_settings
+
+
+settings: Settings = get_settings()
+logger = logging.getLogger(__name__)
+
+
+class AchievementUnavailable(Exception):
+    """API ачивок не ответило или ответило ошибкой сервера, запрос стоит повторить"""
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего API
+
+    После `threshold` неудач подряд размыкается: запросы не отправляются `cooldown` секунд.
+    Затем пропускает ровно один пробный запрос, остальные отклоняются, пока проба не завершится.
+    Успех пробы замыкает предохранитель, неудача снова размыкает его на `cooldown` секунд
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._opened_at: float | None = None
+        self._probing = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос. В полуоткрытом состоянии `True` получает только один вызывающий"""
+        if self._opened_at is None:
+            return True
+        if self._probing or time.monotonic() - self._opened_at < self.cooldown:
+            return False
+        self._probing = True
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probing or self.failures >= self.threshold:
+            self._opened_at = time.monotonic()
+        self._probing = False
+
+
+class AchievementClient:
+    """
+    Клиент API ачивок с одним пулом соединений на все приложение
+
+    Запросы ограничены таймаутом. При недоступности API срабатывает `CircuitBreaker`: до конца паузы
+    запросы не отправляются, а сразу падают с `AchievementUnavailable`. Повторы делает вызывающий код,
+    выдачи ачивок идут через `OutboxEvent`. Проверка и выдача ачивки одному юзеру идут под блокировкой,
+    поэтому одновременные вызовы не выдают ее дважды.
+
+    Пул живет между `start` и `stop`, их вызывает lifespan приложения
+    """
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(settings.ACHIEVEMENT_BREAKER_THRESHOLD, settings.ACHIEVEMENT_BREAKER_COOLDOWN)
+        self._session: aiohttp.ClientSession | None = None
+        self._user_locks: weakref.WeakValueDictionary[int, asyncio.Lock] = weakref.WeakValueDictionary()
+
+    async def start(self) -> None:
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings.ACHIEVEMENT_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(total=settings.ACHIEVEMENT_TIMEOUT),
+            headers={"Accept": "application/json"},
+        )
+        self.breaker = CircuitBreaker(settings.ACHIEVEMENT_BREAKER_THRESHOLD, settings.ACHIEVEMENT_BREAKER_COOLDOWN)
+
+    async def stop(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def give_first_comment(self, user_id: int) -> None:
+        """Выдает ачивку за первый отзыв, если ее еще нет. Ошибки сети и сервера пробрасываются"""
+        if self._session is None:
+            raise AchievementUnavailable("client is not started")
+        if not self.breaker.allow():
+            raise AchievementUnavailable("circuit is open")
+        try:
+            await self._give_first_comment(user_id)
+        except BaseException:
+            # Любой незавершенный вызов, в том числе отмененный, освобождает пробу полуоткрытого предохранителя
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+
+    async def _give_first_comment(self, user_id: int) -> None:
+        # Блокировка живет, пока ее кто-то держит или ждет
+        lock = self._user_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            async with self._session.get(settings.API_URL + f"achievement/user/{user_id}") as response:
+                _raise_for_server_error(response)
+                if response.status != 200:
+                    return
+                user_achievements = await response.json()
+            for achievement in user_achievements.get("achievement", []):
+                if achievement.get("id") == settings.FIRST_COMMENT_ACHIEVEMENT_ID:
+                    return
+            async with self._session.post(
+                settings.API_URL
+                + f"achievement/achievement/{settings.FIRST_COMMENT_ACHIEVEMENT_ID}/reciever/{user_id}",
+                headers={"Authorization": settings.ACHIEVEMENT_GIVE_TOKEN},
+            ) as response:
+                _raise_for_server_error(response)
+                # Отказ, например если ачивку уже выдали, не повторяется: повтор получит тот же ответ
+                if response.status >= 400:
+                    logger.warning("Achievement API refused grant for user %d: %d", user_id, response.status)
+
+
+def _raise_for_server_error(response: aiohttp.ClientResponse) -> None:
+    if response.status >= 500:
+        raise AchievementUnavailable(response.status)
+
+
+# Выдача ачивок из обработчика OutboxEvent
+achievement_client = AchievementClient()
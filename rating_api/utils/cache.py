@@ -0,0 +1,235 @@
+import asyncio
+import json
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+from typing import Iterable
+
+from redis import RedisError
+from redis.asyncio import Redis
+
+from rating_api.settings import Settings, get_settings
+
+
+settings: Settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Сбрасывается любой записью в отзывы: под него попадают списки без фильтра по преподавателю
+COMMENT_LIST_TAG = "comments"
+
+
+def lecturer_tag(lecturer_id: int) -> str:
+    return f"lecturer:{lecturer_id}"
+
+
+class CacheBackend(ABC):
+    """
+    Кэш ответов GET ручек. Значения - JSON строки, ключи и теги - строки
+
+    Каждая запись помечается тегами, например id преподавателя. Ручки, меняющие данные,
+    сбрасывают все записи с нужным тегом через `invalidate`, а не перечисляют ключи.
+    Счетчики попаданий и промахов свои у каждого процесса.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> str | None:
+        value = await self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    @abstractmethod
+    async def _get(self, key: str) -> str | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, tags: Iterable[str] = ()) -> None:
+        ...
+
+    @abstractmethod
+    async def invalidate(self, *tags: str) -> None:
+        """Удаляет все записи, помеченные хотя бы одним из тегов"""
+
+    @abstractmethod
+    async def clear(self) -> None:
+        ...
+
+    @abstractmethod
+    async def size(self) -> int:
+        ...
+
+    async def listen(self) -> None:
+        """Слушает события сброса кэша от других процессов. Запускается фоновой задачей на время жизни приложения"""
+
+    async def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "size": await self.size()}
+
+
+class MemoryCache(CacheBackend):
+    """
+    Кэш в памяти процесса с вытеснением давно не использованных записей (LRU) и временем жизни (TTL)
+
+    Если передан `bus`, сброс по тегам публикуется в канал Redis, и остальные процессы,
+    слушающие канал через `listen`, удаляют у себя те же записи
+    """
+
+    def __init__(self, maxsize: int, ttl: float, bus: Redis | None = None, channel: str = "rating_api:cache"):
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.bus = bus
+        self.channel = channel
+        self._data: OrderedDict[str, tuple[float, str, tuple[str, ...]]] = OrderedDict()
+        self._keys_by_tag: defaultdict[str, set[str]] = defaultdict(set)
+
+    async def _get(self, key: str) -> str | None:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._pop(key)
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    async def set(self, key: str, value: str, tags: Iterable[str] = ()) -> None:
+        if self.maxsize <= 0:
+            return
+        self._pop(key)
+        tags = tuple(tags)
+        self._data[key] = (time.monotonic() + self.ttl, value, tags)
+        for tag in tags:
+            self._keys_by_tag[tag].add(key)
+        while len(self._data) > self.maxsize:
+            self._pop(next(iter(self._data)))
+
+    async def invalidate(self, *tags: str) -> None:
+        self._invalidate_local(tags)
+        if self.bus is not None and tags:
+            try:
+                await self.bus.publish(self.channel, json.dumps(tags))
+            except RedisError:
+                logger.warning("Failed to publish cache invalidation for %s", tags, exc_info=True)
+
+    async def clear(self) -> None:
+        self._data.clear()
+        self._keys_by_tag.clear()
+
+    async def size(self) -> int:
+        return len(self._data)
+
+    async def listen(self) -> None:
+        if self.bus is None:
+            return
+        while True:
+            try:
+                async with self.bus.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._invalidate_local(json.loads(message["data"]))
+            except RedisError:
+                # Пока подписки не было, события могли потеряться, поэтому локальный кэш больше не доверяем
+                logger.warning("Cache invalidation channel is unavailable, retrying", exc_info=True)
+                await self.clear()
+                await asyncio.sleep(1)
+
+    def _invalidate_local(self, tags: Iterable[str]) -> None:
+        for tag in tags:
+            for key in list(self._keys_by_tag.get(tag, ())):
+                self._pop(key)
+
+    def _pop(self, key: str) -> None:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+
+class RedisCache(CacheBackend):
+    """
+    Общий для всех процессов кэш в Redis. Запись удаляется сразу у всех, поэтому событий сброса не нужно
+
+    Для каждого тега хранится множество ключей записей с этим тегом. Вытеснение при нехватке памяти
+    делает сам Redis (`maxmemory-policy allkeys-lru`). Ошибки Redis не ломают ручки: чтение считается промахом
+    """
+
+    def __init__(self, client: Redis, ttl: int, prefix: str = "rating_api:cache:"):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}key:{key}"
+
+    def _tag(self, tag: str) -> str:
+        return f"{self.prefix}tag:{tag}"
+
+    async def _get(self, key: str) -> str | None:
+        try:
+            return await self.client.get(self._key(key))
+        except RedisError:
+            logger.warning("Failed to read cache key %s", key, exc_info=True)
+            return None
+
+    async def set(self, key: str, value: str, tags: Iterable[str] = ()) -> None:
+        try:
+            async with self.client.pipeline(transaction=True) as pipe:
+                pipe.set(self._key(key), value, ex=self.ttl)
+                for tag in tags:
+                    pipe.sadd(self._tag(tag), self._key(key))
+                    pipe.expire(self._tag(tag), self.ttl)
+                await pipe.execute()
+        except RedisError:
+            logger.warning("Failed to write cache key %s", key, exc_info=True)
+
+    async def invalidate(self, *tags: str) -> None:
+        if not tags:
+            return
+        try:
+            tag_keys = [self._tag(tag) for tag in tags]
+            keys = await self.client.sunion(tag_keys)
+            await self.client.delete(*keys, *tag_keys)
+        except RedisError:
+            logger.warning("Failed to invalidate cache tags %s", tags, exc_info=True)
+
+    async def clear(self) -> None:
+        keys = [key async for key in self.client.scan_iter(match=f"{self.prefix}*")]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def size(self) -> int:
+        try:
+            return len([key async for key in self.client.scan_iter(match=self._key("*"))])
+        except RedisError:
+            return 0
+
+
+def create_cache(settings: Settings) -> CacheBackend:
+    redis = Redis.from_url(str(settings.CACHE_REDIS_DSN), decode_responses=True) if settings.CACHE_REDIS_DSN else None
+    if settings.CACHE_BACKEND == "redis":
+        if redis is None:
+            raise ValueError("CACHE_REDIS_DSN is required for CACHE_BACKEND=redis")
+        return RedisCache(redis, ttl=settings.CACHE_TTL)
+    return MemoryCache(maxsize=settings.CACHE_SIZE, ttl=settings.CACHE_TTL, bus=redis)
+
+
+# Ответы GET ручек преподавателей и отзывов
+cache = create_cache(settings)
+
+
+async def invalidate_lecturers(*lecturer_ids: int) -> None:
+    """Сбрасывает кэш преподавателей и их отзывов. Вызывается после коммита изменений"""
+    await cache.invalidate(*map(lecturer_tag, lecturer_ids), COMMENT_LIST_TAG)
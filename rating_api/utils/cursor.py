@@ -0,0 +1,164 @@
+import base64
+import binascii
+import datetime
+import decimal
+import json
+import uuid
+from typing import Any, Sequence
+
+from sqlalchemy import (
+    BinaryExpression,
+    BindParameter,
+    Column,
+    ColumnElement,
+    Row,
+    Select,
+    UnaryExpression,
+    and_,
+    false,
+    literal,
+    or_,
+    tuple_,
+)
+from sqlalchemy.sql import operators
+
+from rating_api.exceptions import InvalidCursor
+
+
+def _unwrap_order_by(clause: ColumnElement) -> tuple[ColumnElement, bool, bool]:
+    """Раскладывает элемент ORDER BY на выражение, направление и положение NULL"""
+    asc_order, nulls_last = True, None
+    while isinstance(clause, UnaryExpression) and clause.modifier in (
+        operators.asc_op,
+        operators.desc_op,
+        operators.nulls_first_op,
+        operators.nulls_last_op,
+    ):
+        if clause.modifier is operators.desc_op:
+            asc_order = False
+        elif clause.modifier is operators.nulls_last_op:
+            nulls_last = True
+        elif clause.modifier is operators.nulls_first_op:
+            nulls_last = False
+        clause = clause.element
+    if hasattr(clause, "__clause_element__"):
+        clause = clause.__clause_element__()
+    # В Postgres по умолчанию NULL больше любого значения
+    return clause, asc_order, asc_order if nulls_last is None else nulls_last
+
+
+def _not_null(clause: ColumnElement) -> bool:
+    """Известно ли, что выражение не бывает NULL: колонка NOT NULL или арифметика над такими"""
+    if isinstance(clause, Column):
+        return not clause.nullable
+    if isinstance(clause, BindParameter):
+        return clause.value is not None
+    if isinstance(clause, BinaryExpression) and clause.operator in (operators.add, operators.sub, operators.mul):
+        return _not_null(clause.left) and _not_null(clause.right)
+    return False
+
+
+def _dump_value(value: Any) -> Any:
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, (decimal.Decimal, uuid.UUID)):
+        return str(value)
+    return value
+
+
+def _load_value(value: Any, key: ColumnElement) -> Any:
+    try:
+        python_type = key.type.python_type
+    except NotImplementedError:
+        return value
+    if value is None:
+        return None
+    if python_type is datetime.datetime:
+        return datetime.datetime.fromisoformat(value)
+    return python_type(value)
+
+
+class Keyset:
+    """
+    Пагинация по курсору для запроса с сортировкой `order_by`
+
+    Курсор - base64 от значений ключей сортировки последней строки страницы. Следующая страница
+    выбирается условием "строго после курсора", поэтому ее стоимость не зависит от глубины.
+    Последний ключ сортировки должен быть уникальным (`uuid`, `id`), иначе строки с равными ключами потеряются.
+    """
+
+    def __init__(self, order_by: Sequence[ColumnElement], sort_name: str):
+        self.order_by = list(order_by)
+        self.keys = [_unwrap_order_by(clause) for clause in self.order_by]
+        self.sort_name = sort_name
+
+    def encode(self, row: Row) -> str:
+        values = [_dump_value(row._mapping[f"cursor_{i}"]) for i in range(len(self.keys))]
+        payload = json.dumps([self.sort_name, *values], ensure_ascii=False)
+        return base64.urlsafe_b64encode(payload.encode()).decode()
+
+    def decode(self, cursor: str) -> list[Any]:
+        try:
+            sort_name, *values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if sort_name != self.sort_name or len(values) != len(self.keys):
+                raise InvalidCursor()
+            return [_load_value(value, key) for value, (key, _, _) in zip(values, self.keys)]
+        except (ValueError, TypeError, binascii.Error) as e:
+            raise InvalidCursor() from e
+
+    def _after(self, values: list[Any]) -> ColumnElement[bool]:
+        """
+        Условие "строка идет после курсора" для произвольных направлений и NULLS FIRST/LAST
+
+        Если ключи NOT NULL и сортируются в одну сторону, условие - сравнение строк `(a, b) > (x, y)`,
+        из которого Postgres берет в Index Cond столько ключей, сколько есть в индексе. Иначе перед разложением по ключам идет условие
+        `a >= x` по первому ключу, чтобы индекс по нему начинал чтение с курсора, а не с начала
+        """
+        directions = {asc_order for _, asc_order, _ in self.keys}
+        if (
+            len(directions) == 1
+            and all(value is not None for value in values)
+            and all(_not_null(key) for key, _, _ in self.keys)
+        ):
+            keys = tuple_(*[key for key, _, _ in self.keys])
+            cursor = tuple_(*[literal(value, key.type) for (key, _, _), value in zip(self.keys, values)])
+            return keys > cursor if directions.pop() else keys < cursor
+        conditions, equal_prefix = [], []
+        for (key, asc_order, nulls_last), value in zip(self.keys, values):
+            if value is None:
+                after = key.is_not(None) if not nulls_last else false()
+                equal = key.is_(None)
+            else:
+                after = key > value if asc_order else key < value
+                if nulls_last and not _not_null(key):
+                    after = or_(after, key.is_(None))
+                equal = key == value
+            conditions.append(and_(*equal_prefix, after))
+            equal_prefix.append(equal)
+        return and_(*self._leading_bound(values[0]), or_(*conditions))
+
+    def _leading_bound(self, value: Any) -> list[ColumnElement[bool]]:
+        """Условие "не раньше курсора" по первому ключу, которое подходит для Index Cond"""
+        key, asc_order, nulls_last = self.keys[0]
+        if value is None:
+            # NULL идут последними - после курсора только NULL, первыми - подходит любая строка
+            return [key.is_(None)] if nulls_last else []
+        bound = key >= value if asc_order else key <= value
+        if nulls_last and not _not_null(key):
+            bound = or_(bound, key.is_(None))
+        return [bound]
+
+    def paginate(self, query: Select, cursor: str | None, limit: int) -> Select:
+        """Добавляет к запросу сортировку, ключи курсора и условие по курсору.
+        Выбирается `limit + 1` строк, чтобы понять, есть ли следующая страница"""
+        query = query.add_columns(*[key.label(f"cursor_{i}") for i, (key, _, _) in enumerate(self.keys)])
+        if cursor is not None:
+            query = query.where(self._after(self.decode(cursor)))
+        return query.order_by(*self.order_by).limit(limit + 1)
+
+    def page(self, rows: Sequence[Row], limit: int) -> tuple[Sequence[Row], str | None]:
+        """Отрезает лишнюю строку и возвращает страницу и курсор следующей страницы"""
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        return rows, self.encode(rows[-1])
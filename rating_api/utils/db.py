@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+from contextvars import ContextVar, Token
+from typing import Any
+
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+_engine: AsyncEngine | None = None
+_Session: async_sessionmaker[AsyncSession] | None = None
+_session: ContextVar[AsyncSession | None] = ContextVar("_session", default=None)
+
+
+class MissingSessionError(Exception):
+    """Обращение к `db.session` вне `AsyncDBSessionMiddleware` или контекста `async with db()`"""
+
+    def __init__(self):
+        super().__init__("No session found in context. Use AsyncDBSessionMiddleware or `async with db():`")
+
+
+def async_url(db_url: str | URL) -> URL:
+    """Подменяет синхронный драйвер postgresql на asyncpg"""
+    url = make_url(str(db_url))
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return url
+
+
+class AsyncDBSessionMiddleware:
+    """Открывает `AsyncSession` на каждый HTTP запрос, доступную через `db.session`
+
+    Сессия не коммитит изменения сама: ручки, которые пишут в БД, вызывают `await db.session.commit()`
+    до формирования ответа. Незакоммиченные изменения откатываются при закрытии сессии.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        db_url: str | URL,
+        engine_args: dict[str, Any] | None = None,
+        session_args: dict[str, Any] | None = None,
+    ):
+        self.app = app
+        db.configure(db_url, engine_args=engine_args, session_args=session_args)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        async with db():
+            await self.app(scope, receive, send)
+
+
+class AsyncDBSession:
+    """Контекст, в котором `db.session` указывает на новую `AsyncSession`"""
+
+    _token: Token | None = None
+
+    async def __aenter__(self) -> AsyncSession:
+        if _Session is None:
+            raise MissingSessionError()
+        session = _Session()
+        self._token = _session.set(session)
+        return session
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        session = _session.get()
+        try:
+            if exc_type is not None:
+                await session.rollback()
+        finally:
+            await session.close()
+            _session.reset(self._token)
+
+
+class DBSessionMeta(type):
+    @property
+    def session(cls) -> AsyncSession:
+        session = _session.get()
+        if session is None:
+            raise MissingSessionError()
+        return session
+
+    @property
+    def engine(cls) -> AsyncEngine:
+        if _engine is None:
+            raise MissingSessionError()
+        return _engine
+
+
+class db(metaclass=DBSessionMeta):
+    """Аналог `fastapi_sqlalchemy.db` для асинхронных сессий
+
+    `db.session` - сессия текущего запроса, `async with db():` - новая сессия вне запроса
+    """
+
+    def __new__(cls) -> AsyncDBSession:
+        return AsyncDBSession()
+
+    @staticmethod
+    def configure(
+        db_url: str | URL,
+        *,
+        engine_args: dict[str, Any] | None = None,
+        session_args: dict[str, Any] | None = None,
+    ) -> None:
+        global _engine, _Session
+        _engine = create_async_engine(async_url(db_url), **(engine_args or {}))
+        _Session = async_sessionmaker(_engine, expire_on_commit=False, **(session_args or {}))
+
+    @staticmethod
+    async def dispose() -> None:
+        if _engine is not None:
+            await _engine.dispose()
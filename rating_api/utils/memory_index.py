@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import time
+from typing import Any, Sequence
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from rating_api.utils.db import db
+
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryIndex:
+    """
+    Структура в памяти процесса, построенная по данным из БД
+
+    Первый запрос ждет загрузки. Раз в `ttl` секунд структура перечитывается в фоне, запросы в это время
+    отвечают по текущей. Изменения своего процесса применяются сразу через `_change`, изменения
+    из других процессов видны после перечитывания.
+
+    Наследники реализуют `_load` (запрос к БД), `_build` (построение по строкам запроса),
+    `_apply` (одно изменение по ключу) и `_reset` (пустая структура)
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+        self._reload_task: asyncio.Task | None = None
+        # Изменения, сделанные во время перечитывания: снимок БД мог их не увидеть
+        self._changed_during_reload: dict[Any, Any] | None = None
+        self._reset()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded_at is not None
+
+    def clear(self) -> None:
+        """Сбрасывает структуру, следующий запрос перечитает ее из БД"""
+        self._reset()
+        self._loaded_at = None
+        self._reload_task = None
+
+    async def reload(self) -> None:
+        """Перечитывает структуру из БД и подменяет ей текущую"""
+        self._changed_during_reload = {}
+        try:
+            async with db():
+                rows = await self._load(db.session)
+            changed = self._changed_during_reload
+        finally:
+            self._changed_during_reload = None
+        self._build(rows)
+        self._loaded_at = time.monotonic()
+        for key, value in changed.items():
+            self._apply(key, value)
+
+    def _change(self, key: Any, value: Any) -> None:
+        """Применяет изменение записи `key` и запоминает его, если сейчас идет перечитывание"""
+        if self._changed_during_reload is not None:
+            self._changed_during_reload[key] = value
+        if self.loaded:
+            self._apply(key, value)
+
+    async def _ensure_fresh(self) -> None:
+        if self._loaded_at is None:
+            # Одновременные первые запросы не грузят структуру повторно
+            async with self._lock:
+                if self._loaded_at is None:
+                    await self.reload()
+        elif time.monotonic() - self._loaded_at > self.ttl and (self._reload_task is None or self._reload_task.done()):
+            self._reload_task = asyncio.create_task(self._background_reload())
+
+    async def _background_reload(self) -> None:
+        try:
+            await self.reload()
+        except Exception:
+            logger.warning("Failed to reload %s", type(self).__name__, exc_info=True)
+
+    async def _load(self, session: AsyncSession) -> Sequence[Any]:
+        raise NotImplementedError()
+
+    def _build(self, rows: Sequence[Any]) -> None:
+        raise NotImplementedError()
+
+    def _apply(self, key: Any, value: Any) -> None:
+        raise NotImplementedError()
+
+    def _reset(self) -> None:
+        raise NotImplementedError()
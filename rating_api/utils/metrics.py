@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import functools
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+from fastapi.routing import APIRoute
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Histogram, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+REQUEST_LATENCY = Histogram(
+    "rating_api_request_duration_seconds", "Время обработки запроса", ["method", "route", "status"]
+)
+REQUEST_DB_TIME = Histogram(
+    "rating_api_request_db_seconds",
+    "Время выполнения SQL запросов за запрос",
+    ["method", "route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+REQUEST_SERIALIZATION_TIME = Histogram(
+    "rating_api_request_serialization_seconds",
+    "Время от возврата из ручки до начала ответа: валидация и сериализация response_model",
+    ["method", "route"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "rating_api_request_sql_statements",
+    "Число SQL запросов за запрос",
+    ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100),
+)
+
+
+@dataclass
+class RequestStats:
+    """Статистика текущего запроса, собирается событиями SQLAlchemy и оберткой ручки"""
+
+    scope: Scope
+    start: float = field(default_factory=time.perf_counter)
+    statements: int = 0
+    db_time: float = 0.0
+    endpoint_end: float | None = None
+    serialization: float | None = None
+
+    @property
+    def route(self) -> str:
+        # Шаблон пути, а не сам путь, иначе у метрик будет по метке на каждый id
+        route = self.scope.get("route")
+        return route.path if route is not None else "unmatched"
+
+
+_request_stats: ContextVar[RequestStats | None] = ContextVar("_request_stats", default=None)
+
+
+def current_request_stats() -> RequestStats | None:
+    """Статистика HTTP запроса, в котором выполняется код, или `None` вне запроса"""
+    return _request_stats.get()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_time += elapsed
+
+
+def instrument_engine(engine: Engine | type[Engine] = Engine) -> None:
+    """Подключает подсчет SQL запросов и времени БД к движку, по умолчанию ко всем. Повторный вызов ничего не меняет"""
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs) -> Any:
+        try:
+            return await endpoint(*args, **kwargs)
+        finally:
+            if (stats := _request_stats.get()) is not None:
+                stats.endpoint_end = time.perf_counter()
+
+    return wrapper
+
+
+class TimedRoute(APIRoute):
+    """Отмечает момент возврата из ручки, чтобы отделить время сериализации ответа от времени ручки"""
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+
+class MetricsMiddleware:
+    """
+    Собирает по каждому запросу число SQL запросов, время в БД, время сериализации и полное время
+
+    Значения добавляются в заголовок `Server-Timing` и в гистограммы Prometheus с метками метода и шаблона пути.
+    Время сериализации считается только для ручек роутеров с `route_class=TimedRoute`
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        instrument_engine()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = _request_stats.set(stats)
+        status = 500
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                now = time.perf_counter()
+                if stats.endpoint_end is not None:
+                    stats.serialization = now - stats.endpoint_end
+                MutableHeaders(scope=message).append(
+                    "Server-Timing",
+                    f'db;dur={stats.db_time * 1000:.1f};desc="{stats.statements} statements", '
+                    f"serialize;dur={(stats.serialization or 0) * 1000:.1f}, "
+                    f"total;dur={(now - stats.start) * 1000:.1f}",
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_stats.reset(token)
+            labels = {"method": scope["method"], "route": stats.route}
+            REQUEST_LATENCY.labels(**labels, status=status).observe(time.perf_counter() - stats.start)
+            REQUEST_DB_TIME.labels(**labels).observe(stats.db_time)
+            REQUEST_SQL_STATEMENTS.labels(**labels).observe(stats.statements)
+            if stats.serialization is not None:
+                REQUEST_SERIALIZATION_TIME.labels(**labels).observe(stats.serialization)
+
+
+def metrics_response() -> Response:
+    """Метрики в формате Prometheus. Под gunicorn с PROMETHEUS_MULTIPROC_DIR собираются со всех воркеров"""
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,58 @@
+import json
+import zlib
+from typing import Any, AsyncIterator, TypeVar
+
+from pydantic import BaseModel, ValidationError
+
+from rating_api.exceptions import RatingAPIError, WrongImportFormat
+
+
+ModelT = TypeVar("ModelT", bound=BaseModel)
+
+
+async def iter_ndjson_lines(chunks: AsyncIterator[bytes], *, gzipped: bool = False) -> AsyncIterator[bytes]:
+    """Построчно читает NDJSON из потока байт, распаковывая gzip на лету. Тело целиком в память не загружается"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    buffer = b""
+    try:
+        async for chunk in chunks:
+            buffer += decompressor.decompress(chunk) if decompressor else chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if decompressor:
+            buffer += decompressor.flush()
+    except zlib.error as e:
+        raise WrongImportFormat() from e
+    for line in buffer.split(b"\n"):
+        if line.strip():
+            yield line
+
+
+async def iter_ndjson_batches(
+    chunks: AsyncIterator[bytes], model: type[ModelT], batch_size: int, *, gzipped: bool = False
+) -> AsyncIterator[tuple[list[ModelT], list[tuple[int, Any]]]]:
+    """
+    Читает NDJSON пачками по `batch_size` валидных строк
+
+    Для каждой пачки возвращает провалидированные объекты и строки, не прошедшие валидацию,
+    в виде пар (номер непустой строки с 1, `id` из строки или `None`)
+    """
+    batch, failed = [], []
+    line_number = 0
+    async for line in iter_ndjson_lines(chunks, gzipped=gzipped):
+        line_number += 1
+        try:
+            batch.append(model.model_validate_json(line))
+        except (ValidationError, RatingAPIError):
+            # RatingAPIError бросают валидаторы схем, например WrongMark
+            try:
+                failed.append((line_number, json.loads(line).get("id")))
+            except (ValueError, AttributeError):
+                failed.append((line_number, None))
+        if len(batch) >= batch_size:
+            yield batch, failed
+            batch, failed = [], []
+    if batch or failed:
+        yield batch, failed
@@ -0,0 +1,128 @@
+import asyncio
+import contextlib
+import logging
+from collections import defaultdict
+from typing import Any, Awaitable, Callable
+
+from sqlalchemy import delete
+
+from rating_api.models import OutboxEvent, OutboxKind, OutboxStatus
+from rating_api.settings import Settings, get_settings
+from rating_api.utils.achievement import achievement_client
+from rating_api.utils.db import db
+
+
+settings: Settings = get_settings()
+logger = logging.getLogger(__name__)
+
+OutboxHandler = Callable[[dict[str, Any]], Awaitable[None]]
+
+
+class OutboxWorker:
+    """
+    Фоновый обработчик `OutboxEvent`
+
+    Закрепляет пачку событий короткой транзакцией, выполняет их без открытой транзакции (с разными `key`
+    параллельно, с одинаковым по очереди), затем второй короткой транзакцией удаляет выполненные,
+    а неудачные откладывает с экспоненциальной задержкой. Попытка ограничена временем закрепления, чтобы событие не взял второй обработчик.
+    Пока события есть, пачки идут подряд, иначе обработчик ждет `poll_interval` секунд
+    или `notify` от ручки, записавшей событие.
+
+    Задача живет между `start` и `stop`, их вызывает lifespan приложения
+    """
+
+    def __init__(self, handlers: dict[OutboxKind, OutboxHandler]):
+        self.handlers = handlers
+        self.batch_size = settings.OUTBOX_BATCH_SIZE
+        self.poll_interval = settings.OUTBOX_POLL_INTERVAL
+        self.retry_backoff = settings.OUTBOX_RETRY_BACKOFF
+        self.max_backoff = settings.OUTBOX_MAX_BACKOFF
+        self.max_attempts = settings.OUTBOX_MAX_ATTEMPTS
+        self.lease = settings.OUTBOX_LEASE
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # Ждем отмены, чтобы пачка не продолжила работу после закрытия пула БД и клиента ачивок.
+            # Закрепленные ей события выполнятся после истечения закрепления
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        self._wakeup = None
+
+    def notify(self) -> None:
+        """Будит обработчик после коммита новых событий"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def drain(self) -> int:
+        """Обрабатывает одну пачку событий, возвращает ее размер"""
+        async with db():
+            events = await OutboxEvent.claim(self.batch_size, self.lease, session=db.session)
+            await db.session.commit()
+            if not events:
+                return 0
+            groups: dict[tuple[OutboxKind, str], list[OutboxEvent]] = defaultdict(list)
+            for event in events:
+                groups[event.kind, event.key if event.key is not None else str(event.id)].append(event)
+            results: dict[int, Exception | None] = {}
+            await asyncio.gather(*(self._handle_group(group, results) for group in groups.values()))
+            done = []
+            for event in events:
+                result = results[event.id]
+                if result is None:
+                    done.append(event.id)
+                    continue
+                event.reschedule(
+                    min(self.retry_backoff * 2**event.attempts, self.max_backoff), repr(result), self.max_attempts
+                )
+                if event.status is OutboxStatus.FAILED:
+                    logger.error("Outbox event %d (%s) failed permanently: %r", event.id, event.kind.value, result)
+                else:
+                    logger.warning("Outbox event %d (%s) failed: %r", event.id, event.kind.value, result)
+            if done:
+                await db.session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_(done)))
+            await db.session.commit()
+        return len(events)
+
+    async def _handle_group(self, events: list[OutboxEvent], results: dict[int, Exception | None]) -> None:
+        """Выполняет события с одним `key` по очереди, чтобы повторы не выполнялись одновременно"""
+        for event in events:
+            try:
+                await self._handle(event)
+            except Exception as exc:
+                results[event.id] = exc
+            else:
+                results[event.id] = None
+
+    async def _handle(self, event: OutboxEvent) -> None:
+        await asyncio.wait_for(self.handlers[event.kind](event.payload), self.lease)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                processed = await self.drain()
+            except Exception:
+                logger.error("Failed to process outbox", exc_info=True)
+                processed = 0
+            if processed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+async def give_first_comment_achievement(payload: dict[str, Any]) -> None:
+    await achievement_client.give_first_comment(payload["user_id"])
+
+
+# Побочные эффекты ручек, записанные в outbox
+outbox_worker = OutboxWorker({OutboxKind.FIRST_COMMENT_ACHIEVEMENT: give_first_comment_achievement})
@@ -0,0 +1,91 @@
+import json
+import logging
+import random
+import time
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from rating_api.settings import Settings, get_settings
+from rating_api.utils.metrics import current_request_stats
+
+
+settings: Settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Длинные параметры (текст отзыва) обрезаются, чтобы не раздувать лог
+MAX_PARAMETER_LENGTH = 200
+EXPLAINABLE = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def _short(value: Any) -> Any:
+    if isinstance(value, (str, bytes)) and len(value) > MAX_PARAMETER_LENGTH:
+        return value[:MAX_PARAMETER_LENGTH] + ("..." if isinstance(value, str) else b"...")
+    if isinstance(value, (list, tuple)):
+        return [_short(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _short(item) for key, item in value.items()}
+    return value
+
+
+def _explain(conn, statement: str, parameters: Any) -> Any:
+    """
+    План запроса без выполнения. Отдельный курсор: у исходного еще не прочитан результат.
+    Ошибка EXPLAIN не должна ломать транзакцию запроса, поэтому он выполняется в savepoint
+    """
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}", parameters)
+            plan = cursor.fetchone()[0]
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            raise
+        cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+    finally:
+        cursor.close()
+    return json.loads(plan) if isinstance(plan, str) else plan
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - conn.info["slow_query_start"].pop()) * 1000
+    if not settings.SLOW_QUERY_THRESHOLD_MS or duration_ms < settings.SLOW_QUERY_THRESHOLD_MS:
+        return
+    if random.random() >= settings.SLOW_QUERY_SAMPLE_RATE:
+        return
+    stats = current_request_stats()
+    plan = None
+    if settings.SLOW_QUERY_EXPLAIN and not executemany and statement.split(None, 1)[0].upper() in EXPLAINABLE:
+        try:
+            plan = _explain(conn, statement, parameters)
+        except Exception:
+            logger.warning("Failed to explain slow query", exc_info=True)
+    logger.warning(
+        "Slow query",
+        extra={
+            "duration": round(duration_ms, 1),
+            "route": stats.route if stats is not None else None,
+            "method": stats.scope["method"] if stats is not None else None,
+            "statement": statement,
+            "parameters": _short(parameters),
+            "plan": plan,
+        },
+    )
+
+
+def log_slow_queries(engine: Engine | type[Engine] = Engine) -> None:
+    """
+    Логирует запросы дольше `SLOW_QUERY_THRESHOLD_MS` с параметрами, ручкой и планом `EXPLAIN (FORMAT JSON)`
+
+    Логируется доля `SLOW_QUERY_SAMPLE_RATE` медленных запросов: план - это еще один запрос к БД.
+    Настройки читаются при каждом запросе, порог 0 выключает лог
+    """
+    if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
@@ -0,0 +1,118 @@
+from bisect import bisect_left, insort
+from typing import Sequence
+
+from sqlalchemy import not_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from rating_api.models import Lecturer
+from rating_api.models.db import normalize_search_text
+from rating_api.schemas.models import LecturerSuggest
+from rating_api.settings import Settings, get_settings
+from rating_api.utils.memory_index import MemoryIndex
+
+
+settings: Settings = get_settings()
+
+
+class LecturerSuggestIndex(MemoryIndex):
+    """
+    Индекс подсказок по ФИО неудаленных преподавателей в памяти процесса
+
+    Отсортированный массив пар (слово ФИО, id): преподаватели, у которых есть слово с заданным префиксом,
+    лежат в нем подряд и находятся бинарным поиском. Слова приводятся к виду `normalize_search_text`.
+
+    Ручки, меняющие преподавателей, обновляют индекс своего процесса через `upsert` и `remove`.
+    Изменения из других процессов видны после перечитывания индекса из БД раз в `ttl` секунд
+    """
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    async def search(self, query: str, limit: int) -> list[LecturerSuggest]:
+        """Подсказки по запросу, при первом вызове индекс загружается из БД"""
+        await self._ensure_fresh()
+        return self.lookup(query, limit)
+
+    def lookup(self, query: str, limit: int) -> list[LecturerSuggest]:
+        """
+        Преподаватели, у которых для каждого слова запроса есть слово ФИО с таким префиксом
+
+        Кандидаты берутся по самому длинному слову запроса, остальные слова проверяются по словам ФИО.
+        Порядок - по алфавиту слова ФИО, совпавшего с самым длинным словом запроса
+        """
+        tokens = normalize_search_text(query).split()
+        if not tokens:
+            return []
+        longest = max(tokens, key=len)
+        rest = list(tokens)
+        rest.remove(longest)
+        result, seen = [], set()
+        position = bisect_left(self._keys, (longest,))
+        while position < len(self._keys) and len(result) < limit:
+            word, lecturer_id = self._keys[position]
+            if not word.startswith(longest):
+                break
+            position += 1
+            if lecturer_id in seen:
+                continue
+            words = self._words[lecturer_id]
+            if all(any(word.startswith(token) for word in words) for token in rest):
+                seen.add(lecturer_id)
+                result.append(self._items[lecturer_id])
+        return result
+
+    def upsert(self, lecturer: Lecturer) -> None:
+        """Добавляет или обновляет преподавателя. Удаленный преподаватель убирается из индекса"""
+        self._change(lecturer.id, lecturer)
+
+    def remove(self, lecturer_id: int) -> None:
+        self._change(lecturer_id, None)
+
+    async def _load(self, session: AsyncSession) -> Sequence[Lecturer]:
+        return (
+            await session.execute(
+                select(
+                    Lecturer.id,
+                    Lecturer.first_name,
+                    Lecturer.last_name,
+                    Lecturer.middle_name,
+                    Lecturer.avatar_link,
+                ).where(not_(Lecturer.is_deleted))
+            )
+        ).all()
+
+    def _reset(self) -> None:
+        self._keys: list[tuple[str, int]] = []
+        self._words: dict[int, tuple[str, ...]] = {}
+        self._items: dict[int, LecturerSuggest] = {}
+
+    def _build(self, lecturers: Sequence[Lecturer]) -> None:
+        self._reset()
+        for lecturer in lecturers:
+            self._keys.extend((word, lecturer.id) for word in self._index(lecturer))
+        self._keys.sort()
+
+    def _index(self, lecturer: Lecturer) -> tuple[str, ...]:
+        """Запоминает подсказку и слова ФИО преподавателя, возвращает слова для массива ключей"""
+        full_name = f"{lecturer.last_name} {lecturer.first_name} {lecturer.middle_name}"
+        words = tuple(dict.fromkeys(normalize_search_text(full_name).split()))
+        self._words[lecturer.id] = words
+        self._items[lecturer.id] = LecturerSuggest(
+            id=lecturer.id, full_name=full_name, avatar_link=lecturer.avatar_link
+        )
+        return words
+
+    def _apply(self, lecturer_id: int, lecturer: Lecturer | None) -> None:
+        for word in self._words.pop(lecturer_id, ()):
+            position = bisect_left(self._keys, (word, lecturer_id))
+            if position < len(self._keys) and self._keys[position] == (word, lecturer_id):
+                del self._keys[position]
+        self._items.pop(lecturer_id, None)
+        if lecturer is None or lecturer.is_deleted:
+            return
+        for word in self._index(lecturer):
+            insort(self._keys, (word, lecturer_id))
+
+
+# Подсказки GET /lecturer/suggest
+suggest_index = LecturerSuggestIndex(ttl=settings.SUGGEST_INDEX_TTL)
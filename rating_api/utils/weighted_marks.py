@@ -0,0 +1,74 @@
+import asyncio
+import contextlib
+import logging
+
+from sqlalchemy import func, select
+
+from rating_api.models import Lecturer, LecturerStatsTotal
+from rating_api.settings import Settings, get_settings
+from rating_api.utils.cache import invalidate_lecturers
+from rating_api.utils.db import db
+
+
+settings: Settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# Ключ блокировки, под которой один из процессов приложения пересчитывает оценки
+REFRESH_LOCK_KEY = 0x7261_7469
+
+
+class WeightedMarksRefresher:
+    """
+    Фоновый полный пересчет взвешенных оценок и снимка мест
+
+    Ручки отзывов пересчитывают оценки только затронутых преподавателей, а средняя по всем отзывам,
+    с которой взвешиваются оценки, меняется с каждым отзывом. Раз в `interval` секунд, если средние изменились
+    с прошлого пересчета, все оценки пересчитываются одним UPDATE. Из процессов приложения пересчитывает тот,
+    кто взял advisory lock, остальные пропускают интервал.
+
+    Задача живет между `start` и `stop`, их вызывает lifespan приложения
+    """
+
+    def __init__(self):
+        self.interval = settings.WEIGHTED_MARKS_REFRESH_INTERVAL
+        self._means: tuple | None = None
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def refresh(self) -> int:
+        """Пересчитывает оценки всех преподавателей, если средние изменились. Возвращает число пересчитанных"""
+        async with db():
+            if not await db.session.scalar(select(func.pg_try_advisory_xact_lock(REFRESH_LOCK_KEY))):
+                return 0
+            means = tuple((await db.session.execute(select(LecturerStatsTotal.means()))).one())
+            if means == self._means:
+                return 0
+            marks = await Lecturer.update_weighted_marks(session=db.session)
+            await db.session.commit()
+        self._means = means
+        await invalidate_lecturers(*marks)
+        return len(marks)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                refreshed = await self.refresh()
+            except Exception:
+                logger.error("Failed to refresh weighted marks", exc_info=True)
+            else:
+                if refreshed:
+                    logger.info("Refreshed weighted marks of %d lecturers", refreshed)
+
+
+# Пересчет оценок со свежей средней по всем отзывам
+weighted_marks_refresher = WeightedMarksRefresher()
@@ -1,21 +1,33 @@
+import asyncio
 import importlib
+import math
 import sys
+import threading
+import time
 import uuid
+from contextlib import contextmanager
 from functools import lru_cache
 from pathlib import Path
+from typing import Any, Callable
 
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
+from aiohttp import web
 from alembic import command
 from alembic.config import Config as AlembicConfig
+from fakeredis import FakeAsyncRedis
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, delete, event, text
 from sqlalchemy.orm import sessionmaker
 from testcontainers.postgres import PostgresContainer
 
 from rating_api.models.db import *
 from rating_api.routes import app
 from rating_api.settings import Settings, get_settings
+from rating_api.utils.cache import MemoryCache, RedisCache, cache
+from rating_api.utils.db import db
+from rating_api.utils.outbox import outbox_worker
+from rating_api.utils.suggest import suggest_index
 
 
 class PostgresConfig:
@@ -35,6 +47,58 @@ class PostgresConfig:
         return f'postgresql://{cls.username}@{cls.host}:{cls.external_port}/postgres'
 
 
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", default=False, help="Запускать бенчмарки на больших данных")
+
+
+def pytest_collection_modifyitems(config, items):
+    """Бенчмарки долго наполняют БД, поэтому запускаются только с флагом --benchmark."""
+    if config.getoption("--benchmark"):
+        return
+    skip_benchmark = pytest.mark.skip(reason="Нужен флаг --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
+# Строки замеров бенчмарков для раздела benchmarks в итогах прогона
+BENCHMARK_REPORT = pytest.StashKey[list[str]]()
+
+
+def pytest_configure(config):
+    config.stash[BENCHMARK_REPORT] = []
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    """Замеры бенчмарков выводятся в конце прогона отдельным разделом, без -s"""
+    if config.stash[BENCHMARK_REPORT]:
+        terminalreporter.section("benchmarks")
+        for line in config.stash[BENCHMARK_REPORT]:
+            terminalreporter.write_line(line)
+
+
+class Latency:
+    """Задержки замера в секундах и результат последнего вызова. `str` - p50 и p95 в миллисекундах"""
+
+    def __init__(self, samples: list[float], result: Any):
+        self.samples = sorted(samples)
+        self.result = result
+
+    def percentile(self, q: float) -> float:
+        return self.samples[max(math.ceil(q * len(self.samples)) - 1, 0)]
+
+    @property
+    def p50(self) -> float:
+        return self.percentile(0.5)
+
+    @property
+    def p95(self) -> float:
+        return self.percentile(0.95)
+
+    def __str__(self) -> str:
+        return f"p50 {self.p50 * 1000:.3f} ms, p95 {self.p95 * 1000:.3f} ms"
+
+
 @pytest.fixture(scope="session")
 def session_mp():
     """Аналог monkeypatch, но с session-scope."""
@@ -91,6 +155,52 @@ def dbsession(db_container):
     yield session
 
 
+@contextmanager
+def _capture_sql():
+    """Собирает SQL запросы приложения вместе с параметрами"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture
+def explain(dbsession):
+    """
+    Возвращает планы SQL запросов, которые приложение выполнило внутри `with explain() as plans:`
+
+    Запросы объясняются с параметрами приложения через PREPARE, настройки планировщика не меняются.
+    Чтобы план был таким же, как в проде, тесты берут данные из `planner_dataset`
+    """
+
+    @contextmanager
+    def _explain():
+        plans = []
+        with _capture_sql() as statements:
+            yield plans
+        cursor = dbsession.connection().connection.cursor()
+        try:
+            for statement, parameters in statements:
+                args = [cursor.mogrify("%s", (str(arg) if isinstance(arg, uuid.UUID) else arg,)) for arg in parameters]
+                cursor.execute(f"PREPARE explained AS {statement}")
+                cursor.execute(
+                    f"EXPLAIN EXECUTE explained({b', '.join(args).decode()})" if args else "EXPLAIN EXECUTE explained"
+                )
+                plans.append("\n".join(row for row, in cursor.fetchall()))
+                cursor.execute("DEALLOCATE explained")
+        finally:
+            cursor.close()
+            dbsession.rollback()
+
+    return _explain
+
+
 @pytest.fixture
 def client(mocker):
     user_mock = mocker.patch('auth_lib.fastapi.UnionAuth.__call__')
@@ -102,8 +212,152 @@ def client(mocker):
         "id": 0,
         "email": "string",
     }
-    client = TestClient(app)
-    return client
+    # Фикстуры переиспользуют id преподавателей, поэтому кэш ответов не должен переживать тест
+    asyncio.run(cache.clear())
+    suggest_index.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+class AchievementStub:
+    """
+    Заглушка API ачивок на локальном порту
+
+    `achievements` - выданные ачивки по id пользователя, `granted` - пары (id ачивки, id пользователя)
+    из запросов на выдачу. Первые `failures` запросов получают 503, каждый ответ задерживается на `delay` секунд
+    """
+
+    def __init__(self):
+        self.achievements: dict[int, list[int]] = {}
+        self.granted: list[tuple[int, int]] = []
+        self.tokens: list[str | None] = []
+        self.failures = 0
+        self.delay = 0.0
+        self.requests = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/achievement/user/{user_id}', self._get_user)
+        app.router.add_post('/achievement/achievement/{achievement_id}/reciever/{user_id}', self._give)
+        return app
+
+    def wait_granted(self, n: int, timeout: float = 5) -> list[tuple[int, int]]:
+        """Ждет `n` выдач: ачивки выдаются в фоне после ответа ручки"""
+        deadline = time.monotonic() + timeout
+        while len(self.granted) < n and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.granted
+
+    async def _respond(self) -> web.Response | None:
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        if self.failures > 0:
+            self.failures -= 1
+            return web.Response(status=503)
+        return None
+
+    async def _get_user(self, request: web.Request) -> web.Response:
+        if (error := await self._respond()) is not None:
+            return error
+        user_id = int(request.match_info['user_id'])
+        return web.json_response({"achievement": [{"id": id} for id in self.achievements.get(user_id, [])]})
+
+    async def _give(self, request: web.Request) -> web.Response:
+        if (error := await self._respond()) is not None:
+            return error
+        achievement_id, user_id = int(request.match_info['achievement_id']), int(request.match_info['user_id'])
+        self.tokens.append(request.headers.get('Authorization'))
+        self.achievements.setdefault(user_id, []).append(achievement_id)
+        self.granted.append((achievement_id, user_id))
+        return web.json_response({})
+
+
+@pytest.fixture
+def achievement_api(dbsession, mocker):
+    """Поднимает `AchievementStub` в отдельном потоке и направляет на нее клиент ачивок"""
+    # События прошлых тестов не должны дойти до заглушки
+    dbsession.execute(delete(OutboxEvent))
+    dbsession.commit()
+    stub = AchievementStub()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(stub.app())
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    loop.run_until_complete(site.start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    mocker.patch('rating_api.utils.achievement.settings.API_URL', f'http://127.0.0.1:{port}/')
+    mocker.patch.object(outbox_worker, 'retry_backoff', 0.01)
+    mocker.patch.object(outbox_worker, 'poll_interval', 0.01)
+    try:
+        yield stub
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+        dbsession.execute(delete(OutboxEvent))
+        dbsession.commit()
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def cache_backend(request, mocker):
+    """Подменяет кэш ответов на пустой MemoryCache или RedisCache поверх fakeredis"""
+    if request.param == 'redis':
+        backend = RedisCache(FakeAsyncRedis(decode_responses=True), ttl=60)
+    else:
+        backend = MemoryCache(maxsize=100, ttl=60)
+    for module in ('rating_api.utils.cache', 'rating_api.routes.lecturer', 'rating_api.routes.comment'):
+        mocker.patch(f'{module}.cache', backend)
+    return backend
+
+
+@pytest.fixture
+def sql_budget():
+    """
+    Считает SQL запросы приложения. `with sql_budget(n):` падает, если внутри выполнено больше `n` запросов,
+    и показывает их, чтобы было видно, откуда N+1
+    """
+
+    @contextmanager
+    def _sql_budget(budget: int):
+        with _capture_sql() as statements:
+            yield statements
+        assert len(statements) <= budget, "\n\n".join(statement for statement, _ in statements)
+
+    return _sql_budget
+
+
+def _forget_published(dbsession, lecturer_ids) -> None:
+    """
+    Пересобирает данные по опубликованным отзывам удаленных фикстурой преподавателей. Фикстуры удаляют
+    отзывы в обход ручек, а общие суммы в lecturer_stats_total не должны переходить в следующий тест
+    """
+    dbsession.flush()
+    for statement in Comment.rebuild_published_statements(lecturer_ids):
+        dbsession.execute(statement)
+    dbsession.commit()
+
+
+@pytest.fixture
+def timeit(request):
+    """
+    `timeit(title, func, repeat)` вызывает `func` `repeat` раз и возвращает `Latency`.
+    Строка с перцентилями попадает в раздел benchmarks итогов прогона
+    """
+
+    def _timeit(title: str, func: Callable[[], Any], repeat: int = 20) -> Latency:
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            samples.append(time.perf_counter() - start)
+        latency = Latency(samples, result)
+        request.config.stash[BENCHMARK_REPORT].append(f"{request.node.name}: {title}: {latency}")
+        return latency
+
+    return _timeit
 
 
 @pytest.fixture
@@ -114,7 +368,7 @@ def lecturer(dbsession):
     yield _lecturer
     dbsession.refresh(_lecturer)
     dbsession.delete(_lecturer)
-    dbsession.commit()
+    _forget_published(dbsession, [_lecturer.id])
 
 
 @pytest.fixture
@@ -219,14 +473,42 @@ def lecturers(dbsession):
     dbsession.commit()
     yield lecturers
 
+    # Отзывы могли создать через API, поэтому ищем их запросом, а не по связи из фикстуры
+    dbsession.expire_all()
     for lecturer in lecturers:
-        for row in lecturer.comments:
+        for row in dbsession.query(Comment).filter(Comment.lecturer_id == lecturer.id):
             dbsession.delete(row)
         lecturer_user_comments = dbsession.query(LecturerUserComment).filter(
             LecturerUserComment.lecturer_id == lecturer.id
         )
         for row in lecturer_user_comments:
             dbsession.delete(row)
+        # У lecturer_user_comment нет связи с lecturer в ORM, поэтому порядок удаления задаем сами
+        dbsession.flush()
+        dbsession.delete(lecturer)
+    # Счетчики лимитов отзывов общие для всех тестов пользователя 0
+    dbsession.execute(delete(CommentLimitCounter))
+    _forget_published(dbsession, [lecturer.id for lecturer in lecturers])
+
+
+@pytest.fixture
+def lecturers_for_search(dbsession):
+    """
+    Преподаватели для поиска по ФИО. Кириллица в нижнем регистре: lower() в локали C тестовой БД ее не меняет
+    """
+    lecturers_data = [
+        (11, "ivan", "kuznetsov", "petrovich"),
+        (12, "petr", "ivanov", "sergeevich"),
+        (13, "пётр", "семёнов", "алексеевич"),
+    ]
+    lecturers = [
+        Lecturer(id=lecturer_id, first_name=fname, last_name=lname, middle_name=mname, timetable_id=9800 + lecturer_id)
+        for lecturer_id, fname, lname, mname in lecturers_data
+    ]
+    dbsession.add_all(lecturers)
+    dbsession.commit()
+    yield lecturers
+    for lecturer in lecturers:
         dbsession.delete(lecturer)
     dbsession.commit()
 
@@ -282,8 +564,110 @@ def lecturers_with_comments(dbsession, lecturers):
 
     dbsession.add_all(comments)
     dbsession.commit()
+    # Отзывы добавлены в обход ручек, поэтому данные по опубликованным отзывам собираем заново
+    for statement in Comment.rebuild_published_statements(lecturer.id for lecturer in lecturers):
+        dbsession.execute(statement)
+    dbsession.commit()
     yield lecturers, comments
     for comment in comments:
         dbsession.refresh(comment)
         dbsession.delete(comment)
     dbsession.commit()
+
+
+def _seed_dataset(dbsession, first_id: int, lecturers_count: int, comments_count: int) -> None:
+    """
+    Наполняет БД преподавателями с id после `first_id` и отзывами к ним: примерно 80% отзывов одобрены,
+    у двух третей отзывов есть реакция. Предметы начинаются с одной из 32 букв, как настоящие,
+    поэтому поиск по началу предмета избирателен
+    """
+    params = {"first_id": first_id, "lecturers_count": lecturers_count, "comments_count": comments_count}
+    dbsession.execute(
+        text(
+            """
+            INSERT INTO lecturer (id, first_name, last_name, middle_name, timetable_id, is_deleted)
+            SELECT :first_id + i, 'Firstname' || i, 'Lastname' || i, 'Middlename' || i, :first_id + i, false
+            FROM generate_series(1, :lecturers_count) AS i
+            """
+        ),
+        params,
+    )
+    dbsession.execute(
+        text(
+            """
+            INSERT INTO comment (
+                uuid, user_id, create_ts, update_ts, subject, text, mark_kindness, mark_freebie, mark_clarity,
+                lecturer_id, review_status, is_deleted, like_count, dislike_count
+            )
+            SELECT
+                gen_random_uuid(), i % 5000, now() - i * interval '1 minute', now() - i * interval '1 minute',
+                chr(1072 + i % 32) || 'subject' || (i % 300), 'Comment ' || i, i % 5 - 2, (i / 5) % 5 - 2, (i / 25) % 5 - 2,
+                :first_id + 1 + i % :lecturers_count,
+                CASE WHEN i % 10 < 8 THEN 'APPROVED' WHEN i % 10 = 8 THEN 'PENDING' ELSE 'DISMISSED' END,
+                false, i % 3, i % 2
+            FROM generate_series(1, :comments_count) AS i
+            """
+        ),
+        params,
+    )
+    dbsession.execute(
+        text(
+            """
+            INSERT INTO comment_reaction (uuid, user_id, comment_uuid, reaction, created_at, edited_at)
+            SELECT gen_random_uuid(), (user_id + 1) % 5000, uuid, CASE WHEN like_count > 0 THEN 'LIKE' ELSE 'DISLIKE' END, now(), now()
+            FROM comment
+            WHERE lecturer_id > :first_id AND lecturer_id <= :first_id + :lecturers_count AND like_count <> 1
+            """
+        ),
+        params,
+    )
+    lecturer_ids = range(first_id + 1, first_id + lecturers_count + 1)
+    for statement in Comment.rebuild_published_statements(lecturer_ids):
+        dbsession.execute(statement)
+    dbsession.commit()
+    # VACUUM переносит строки из списка ожидания GIN индексов в сами индексы, как autovacuum в проде.
+    # Без этого планировщик считает триграммные индексы дорогими
+    with dbsession.bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM ANALYZE lecturer, comment, comment_reaction, lecturer_subject, lecturer_stats"))
+
+
+def _drop_dataset(dbsession, first_id: int, lecturers_count: int) -> None:
+    params = {"first_id": first_id, "last_id": first_id + lecturers_count}
+    dbsession.execute(
+        text(
+            """
+            DELETE FROM comment_reaction USING comment
+            WHERE comment_reaction.comment_uuid = comment.uuid AND comment.lecturer_id BETWEEN :first_id AND :last_id
+            """
+        ),
+        params,
+    )
+    dbsession.execute(text("DELETE FROM comment WHERE lecturer_id BETWEEN :first_id AND :last_id"), params)
+    dbsession.execute(text("DELETE FROM lecturer WHERE id BETWEEN :first_id AND :last_id"), params)
+    _forget_published(dbsession, range(first_id, first_id + lecturers_count + 1))
+
+
+@pytest.fixture(scope='module')
+def large_dataset(db_container):
+    """
+    Наполняет БД для бенчмарков: 10 000 преподавателей и 500 000 отзывов к ним
+    """
+    dbsession = sessionmaker(bind=create_engine(str(db_container)))()
+    lecturers_count, comments_count = 10_000, 500_000
+    _seed_dataset(dbsession, 1_000_000, lecturers_count, comments_count)
+    yield lecturers_count, comments_count
+    _drop_dataset(dbsession, 1_000_000, lecturers_count)
+    dbsession.close()
+
+
+@pytest.fixture(scope='module')
+def planner_dataset(db_container):
+    """
+    Данные, на которых планировщик выбирает планы как в проде: 2 000 преподавателей и 40 000 отзывов к ним.
+    Возвращает id первого преподавателя
+    """
+    dbsession = sessionmaker(bind=create_engine(str(db_container)))()
+    _seed_dataset(dbsession, 2_000_000, 20_000, 60_000)
+    yield 2_000_001
+    _drop_dataset(dbsession, 2_000_000, 20_000)
+    dbsession.close()
@@ -1,12 +1,20 @@
+import asyncio
+import gzip
+import json
 import logging
 
 import pytest
-from fastapi_sqlalchemy import db
-from sqlalchemy import and_, func, select
+from fakeredis import FakeAsyncRedis, FakeServer
+from sqlalchemy import and_, func, select, update
 from starlette import status
 
 from rating_api.models import Comment, Lecturer, ReviewStatus
 from rating_api.settings import get_settings
+from rating_api.utils import slow_query
+from rating_api.utils.cache import MemoryCache, lecturer_tag
+from rating_api.utils.mark import calc_weighted_mark
+from rating_api.utils.suggest import suggest_index
+from rating_api.utils.weighted_marks import WeightedMarksRefresher
 
 
 logger = logging.getLogger(__name__)
@@ -78,10 +86,129 @@ def test_get_lecturer(client, dbsession, lecturers, lecturer_n, response_status)
         assert json_response["mark_freebie_weighted"] == 0.0
         assert json_response["mark_clarity_weighted"] == 0.0
         assert json_response["mark_weighted"] == 0.0
-        assert json_response["rank"] == 0
+        # Без отзывов у всех преподавателей одинаковая оценка и общее первое место
+        assert json_response["rank"] == 1
         assert json_response["comments"] is None
 
 
+def test_get_lecturer_cache(client, cache_backend, lecturers_with_comments):
+    lecturers, comments = lecturers_with_comments
+    lecturer_id = lecturers[0].id
+    first = client.get(f'{url}/{lecturer_id}', params={"info": "comments"})
+    assert first.status_code == status.HTTP_200_OK
+    assert len(first.json()["comments"]) == 4
+    second = client.get(f'{url}/{lecturer_id}', params={"info": "comments"})
+    assert second.json() == first.json()
+    assert client.get(f'{url}/cache/stats').json() == {"hits": 1, "misses": 1, "size": 1}
+
+    # Одобрение отзыва сбрасывает кэш преподавателя
+    response = client.patch(f'/comment/{comments[3].uuid}/review', params={"review_status": "approved"})
+    assert response.status_code == status.HTTP_200_OK
+    assert client.get(f'{url}/cache/stats').json()["size"] == 0
+    third = client.get(f'{url}/{lecturer_id}', params={"info": "comments"})
+    assert len(third.json()["comments"]) == 5
+
+
+def test_get_lecturer_etag(client, lecturers_with_comments):
+    lecturers, comments = lecturers_with_comments
+    first = client.get(f'{url}/{lecturers[0].id}', params={"info": "comments"})
+    etag = first.headers["ETag"]
+    not_modified = client.get(f'{url}/{lecturers[0].id}', params={"info": "comments"}, headers={"If-None-Match": etag})
+    assert not_modified.status_code == status.HTTP_304_NOT_MODIFIED
+    assert not_modified.content == b''
+    assert not_modified.headers["ETag"] == etag
+    # Ответ без комментариев - другое представление, у него свой ETag
+    assert client.get(f'{url}/{lecturers[0].id}').headers["ETag"] != etag
+
+    client.patch(f'/comment/{comments[3].uuid}/review', params={"review_status": "approved"})
+    modified = client.get(f'{url}/{lecturers[0].id}', params={"info": "comments"}, headers={"If-None-Match": etag})
+    assert modified.status_code == status.HTTP_200_OK
+    assert modified.headers["ETag"] != etag
+
+
+def test_get_lecturer_etag_matches_body(client, dbsession, lecturers_with_comments):
+    """Изменение, прошедшее мимо сброса кэша, не отдает старое тело с новым ETag"""
+    lecturers, _ = lecturers_with_comments
+    first = client.get(f'{url}/{lecturers[0].id}')
+    dbsession.execute(update(Lecturer).where(Lecturer.id == lecturers[0].id).values(first_name='Changed'))
+    dbsession.commit()
+    second = client.get(f'{url}/{lecturers[0].id}')
+    assert second.headers["ETag"] != first.headers["ETag"]
+    assert second.json()["first_name"] == 'Changed'
+
+
+@pytest.mark.parametrize(
+    'path, budget',
+    [
+        ('/{id}', 2),
+        ('/{id}?info=comments', 3),
+        ('/timetable-id/{timetable_id}', 2),
+        ('?info=comments', 3),
+    ],
+)
+def test_lecturer_sql_budget(client, lecturers_with_comments, sql_budget, path, budget):
+    """Число запросов не зависит от числа отзывов: отзывы грузятся одним selectin запросом, предметы - подзапросом"""
+    lecturers, _ = lecturers_with_comments
+    with sql_budget(budget):
+        response = client.get(url + path.format(id=lecturers[0].id, timetable_id=lecturers[0].timetable_id))
+    assert response.status_code == status.HTTP_200_OK
+
+
+def test_request_metrics(client, lecturers_with_comments):
+    lecturers, _ = lecturers_with_comments
+    response = client.get(f'{url}/{lecturers[0].id}')
+    server_timing = response.headers["Server-Timing"]
+    assert 'db;dur=' in server_timing and 'desc="2 statements"' in server_timing
+    assert 'serialize;dur=' in server_timing and 'total;dur=' in server_timing
+
+    metrics = client.get('/metrics')
+    assert metrics.status_code == status.HTTP_200_OK
+    # Метка - шаблон пути, а не путь с конкретным id
+    assert 'rating_api_request_sql_statements_count{method="GET",route="/lecturer/{id}"}' in metrics.text
+    assert 'rating_api_request_duration_seconds_bucket{' in metrics.text
+
+
+@pytest.mark.parametrize('sample_rate, logged', [(1.0, True), (0.0, False)])
+def test_slow_query_log(client, lecturers_with_comments, mocker, caplog, sample_rate, logged):
+    mocker.patch.object(settings, 'SLOW_QUERY_THRESHOLD_MS', 0.001)
+    mocker.patch.object(settings, 'SLOW_QUERY_SAMPLE_RATE', sample_rate)
+    # Логгеры приложения выключает fileConfig из alembic в фикстуре БД
+    mocker.patch.object(slow_query.logger, 'disabled', False)
+    with caplog.at_level(logging.WARNING, logger=slow_query.logger.name):
+        response = client.get(url, params={"subject": "test_subject", "order_by": "mark_general"})
+    assert response.status_code == status.HTTP_200_OK
+    records = [record for record in caplog.records if record.getMessage() == "Slow query"]
+    assert bool(records) is logged
+    if logged:
+        page_query = next(record for record in records if "ORDER BY" in record.statement)
+        assert page_query.route == url
+        assert page_query.method == "GET"
+        assert page_query.parameters
+        assert "Plan" in page_query.plan[0]
+
+
+def test_cache_invalidation_event():
+    """Сброс кэша в одном процессе доходит до кэша в памяти другого через канал Redis"""
+
+    async def scenario() -> str | None:
+        server = FakeServer()
+        publisher, subscriber = (
+            MemoryCache(maxsize=10, ttl=60, bus=FakeAsyncRedis(server=server, decode_responses=True)) for _ in range(2)
+        )
+        listener = asyncio.create_task(subscriber.listen())
+        await asyncio.sleep(0.1)
+        await subscriber.set("lecturer:id:1:False", "{}", tags=[lecturer_tag(1)])
+        await publisher.invalidate(lecturer_tag(1))
+        for _ in range(100):
+            if await subscriber.size() == 0:
+                break
+            await asyncio.sleep(0.01)
+        listener.cancel()
+        return await subscriber.get("lecturer:id:1:False")
+
+    assert asyncio.run(scenario()) is None
+
+
 @pytest.mark.parametrize(
     'lecturer_n,mark_kindness_weighted,mark_freebie_weighted,mark_clarity_weighted,mark_weighted',
     [(0, 1.5, 1.5, 1.5, 1.5), (1, 0, 0, 0, 0), (2, 0.5, 0.5, 0.5, 0.5)],
@@ -124,6 +251,87 @@ def test_get_lecturers_by_name(client, lecturers, query, total, response_status)
         assert json_response["lecturers"][0]["first_name"] == lecturers[0].first_name
 
 
+@pytest.mark.parametrize(
+    'name, expected_ids',
+    [
+        ('Kuznetsov', [11]),
+        ('семенов', [13]),
+        ('пётр семёнов', [13]),
+        ('kuznetsow', [11]),
+        ('ivan petrovih', [11]),
+        ('ivan', [11, 12]),
+        ('smirnov', []),
+    ],
+    ids=['case', 'yo_in_name', 'yo_in_query', 'typo', 'two_words_with_typo', 'substring', 'not_found'],
+)
+def test_get_lecturers_by_name_fuzzy(client, lecturers_for_search, name, expected_ids):
+    """Поиск не учитывает регистр и ё/е и находит ФИО с опечаткой в слове"""
+    response = client.get(url, params={'name': name, 'order_by': 'last_name'})
+    if not expected_ids:
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+        return
+    assert response.status_code == status.HTTP_200_OK
+    assert sorted(lecturer['id'] for lecturer in response.json()['lecturers']) == expected_ids
+
+
+@pytest.mark.parametrize('order_by, expected_ids', [('relevance', [11, 12]), ('-relevance', [12, 11])])
+def test_get_lecturers_by_name_relevance(client, lecturers_for_search, order_by, expected_ids):
+    """Имя Ivan совпадает со словом целиком, фамилия Ivanov - только частично"""
+    response = client.get(url, params={'name': 'ivan', 'order_by': order_by})
+    assert response.status_code == status.HTTP_200_OK
+    assert [lecturer['id'] for lecturer in response.json()['lecturers']] == expected_ids
+    cursor = client.get(url, params={'name': 'ivan', 'order_by': order_by, 'limit': 1}).json()['next_cursor']
+    response = client.get(url, params={'name': 'ivan', 'order_by': order_by, 'limit': 1, 'cursor': cursor})
+    assert [lecturer['id'] for lecturer in response.json()['lecturers']] == expected_ids[1:]
+
+
+@pytest.mark.usefixtures('lecturers_for_search')
+@pytest.mark.parametrize(
+    'q, expected_ids',
+    [
+        ('kuz', [11]),
+        ('IVA', [11, 12]),
+        ('ivan pet', [11, 12]),
+        ('ivan k', [11]),
+        ('Семе', [13]),
+        ('пётр алекс', [13]),
+        ('xyz', []),
+    ],
+    ids=['prefix', 'case', 'two_words', 'short_second_word', 'yo', 'yo_in_query', 'not_found'],
+)
+def test_suggest_lecturers(client, q, expected_ids):
+    response = client.get(f'{url}/suggest', params={'q': q})
+    assert response.status_code == status.HTTP_200_OK
+    assert [lecturer['id'] for lecturer in response.json()] == expected_ids
+
+
+@pytest.mark.usefixtures('lecturers_for_search')
+def test_suggest_lecturers_response(client, sql_budget):
+    response = client.get(f'{url}/suggest', params={'q': 'kuz'})
+    assert response.json() == [{'id': 11, 'full_name': 'kuznetsov ivan petrovich', 'avatar_link': None}]
+    assert len(client.get(f'{url}/suggest', params={'q': 'i', 'limit': 1}).json()) == 1
+    # Индекс загружен первым запросом, дальше подсказки не ходят в БД
+    with sql_budget(0):
+        client.get(f'{url}/suggest', params={'q': 'ivan'})
+
+
+def test_suggest_lecturers_follows_changes(client, dbsession):
+    """Создание, изменение и удаление преподавателя сразу видны в подсказках"""
+    client.get(f'{url}/suggest', params={'q': 'a'})
+    body = {"first_name": 'Anna', "last_name": 'Suggestova', "middle_name": 'Petrovna', "timetable_id": 9850}
+    lecturer_id = client.post(url, json=body).json()['id']
+    try:
+        assert [item['id'] for item in client.get(f'{url}/suggest', params={'q': 'sugg'}).json()] == [lecturer_id]
+        client.patch(f'{url}/{lecturer_id}', json={'last_name': 'Renamed', 'timetable_id': 9850})
+        assert client.get(f'{url}/suggest', params={'q': 'sugg'}).json() == []
+        assert client.get(f'{url}/suggest', params={'q': 'renamed anna'}).json()[0]['id'] == lecturer_id
+        client.delete(f'{url}/{lecturer_id}')
+        assert client.get(f'{url}/suggest', params={'q': 'renamed'}).json() == []
+    finally:
+        dbsession.delete(dbsession.get(Lecturer, lecturer_id))
+        dbsession.commit()
+
+
 @pytest.mark.usefixtures('lecturers_with_comments')
 @pytest.mark.parametrize(
     'query, response_status',
@@ -259,14 +467,13 @@ def test_get_lecturers_order_by(client, dbsession, query, response_status):
         else:
             field_name = query['order_by']
             asc_order = True
-        with db():
-            db_res = (
-                Lecturer.query(session=dbsession)
-                .join(Comment, and_(Comment.review_status == ReviewStatus.APPROVED, Lecturer.id == Comment.lecturer_id))
-                .group_by(Lecturer.id)
-                .order_by(*Lecturer.order_by_mark(field_name, asc_order))
-                .all()
-            )
+        db_res = (
+            Lecturer.query(session=dbsession)
+            .join(Comment, and_(Comment.review_status == ReviewStatus.APPROVED, Lecturer.id == Comment.lecturer_id))
+            .group_by(Lecturer.id)
+            .order_by(*Lecturer.order_by_mark(field_name, asc_order))
+            .all()
+        )
         db_lecturers = [lecturer.id for lecturer in db_res]
         resp_lecturers = [lecturer['id'] for lecturer in resp.json()['lecturers']]
         assert resp_lecturers == db_lecturers
@@ -382,3 +589,280 @@ def test_lecturer_rating_update(client, dbsession, body, response_status):
         assert isinstance(response_dict, dict)
 
         assert response_dict["failed"] == 0
+
+
+def _rating(lecturer: Lecturer, rank: int) -> dict:
+    return {
+        "id": lecturer.id,
+        "first_name": lecturer.first_name,
+        "last_name": lecturer.last_name,
+        "middle_name": lecturer.middle_name,
+        "timetable_id": lecturer.timetable_id,
+        "mark_weighted": rank / 10,
+        "mark_kindness_weighted": 1.0,
+        "mark_clarity_weighted": 1.5,
+        "mark_freebie_weighted": -1.0,
+        "rank": rank,
+    }
+
+
+@pytest.mark.parametrize('chunk_size', [1, 1000])
+def test_lecturer_rating_update_bulk(client, dbsession, lecturers, mocker, chunk_size):
+    """Несуществующие и удаленные преподаватели попадают в failed, остальные обновляются"""
+    mocker.patch.object(settings, 'RATING_IMPORT_CHUNK_SIZE', chunk_size)
+    missing = Lecturer(id=999, first_name='a', last_name='b', middle_name='c', timetable_id=1)
+    body = [_rating(lecturer, rank) for rank, lecturer in enumerate(lecturers + [missing], start=1)]
+    first_name = lecturers[0].first_name
+    body[0]["first_name"] = "renamed"
+    response = client.patch('/lecturer/import_rating', json=body)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"updated": 3, "failed": 2, "updated_id": [1, 2, 3], "failed_id": [4, 999]}
+    dbsession.expire_all()
+    assert [lecturer.rank for lecturer in lecturers[:3]] == [1, 2, 3]
+    assert lecturers[0].mark_weighted == 0.1
+    # Импорт пишет только рейтинг: ФИО из выгрузки не меняют преподавателя
+    assert lecturers[0].first_name == first_name
+
+
+@pytest.mark.parametrize('gzipped', [False, True])
+def test_lecturer_rating_update_ndjson(client, dbsession, lecturers, gzipped):
+    lines = [json.dumps(_rating(lecturer, rank)) for rank, lecturer in enumerate(lecturers[:3], start=5)]
+    lines.insert(1, json.dumps({"id": 2, "rank": "not a number"}))
+    lines.append("not json")
+    body = "\n".join(lines).encode()
+    headers = {"Content-Type": "application/x-ndjson"}
+    if gzipped:
+        body, headers["Content-Encoding"] = gzip.compress(body), "gzip"
+    response = client.patch('/lecturer/import_rating/ndjson', content=body, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {"updated": 3, "failed": 2, "updated_id": [1, 2, 3], "failed_id": [2]}
+    dbsession.expire_all()
+    assert [lecturer.rank for lecturer in lecturers[:3]] == [5, 6, 7]
+
+
+def test_lecturer_rating_update_ndjson_broken_gzip(client, lecturers):
+    response = client.patch('/lecturer/import_rating/ndjson', content=b'not gzip', headers={"Content-Encoding": "gzip"})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+def test_weighted_marks_follow_reviews(client, dbsession, lecturers):
+    """Публикация отзыва сразу пересчитывает взвешенные оценки и места, полный пересчет выравнивает всех"""
+    good, bad, unrated = lecturers[:3]
+    comments = [
+        Comment(
+            lecturer_id=lecturer.id,
+            subject="test_subject",
+            text="test_comment",
+            mark_kindness=mark,
+            mark_freebie=mark,
+            mark_clarity=mark,
+            review_status=ReviewStatus.PENDING,
+        )
+        for lecturer, mark in ((good, 2), (bad, -1))
+    ]
+    dbsession.add_all(comments)
+    dbsession.commit()
+
+    def rating(lecturer: Lecturer) -> tuple[float, int]:
+        response = client.get(f'{url}/{lecturer.id}').json()
+        return response['mark_weighted'], response['rank']
+
+    client.patch(f'/comment/{comments[0].uuid}/review', params={'review_status': 'approved'})
+    # Единственный опубликованный отзыв и есть средняя оценка
+    assert rating(good) == (pytest.approx(2), 1)
+    client.patch(f'/comment/{comments[1].uuid}/review', params={'review_status': 'approved'})
+    mean = (2 - 1) / 2
+    assert rating(bad) == (pytest.approx(calc_weighted_mark(-1, 1, mean)), 3)
+    # Оценки остальных преподавателей считались с прежней средней
+    assert rating(good) == (pytest.approx(2), 1)
+    assert rating(unrated) == (0, 2)
+
+    response = client.post(f'{url}/recompute_rating')
+    assert response.status_code == status.HTTP_200_OK
+    assert rating(good) == (pytest.approx(calc_weighted_mark(2, 1, mean)), 1)
+    assert rating(unrated) == (pytest.approx(mean), 2)
+    assert rating(bad) == (pytest.approx(calc_weighted_mark(-1, 1, mean)), 3)
+    dbsession.expire_all()
+    assert [lecturer.rank for lecturer in (good, unrated, bad)] == [1, 2, 3]
+
+
+def test_weighted_marks_refresh(client, dbsession, lecturers):
+    """Фоновый пересчет выравнивает оценки всех преподавателей по новой средней, только если она изменилась"""
+    good, bad, unrated = lecturers[:3]
+    comments = [
+        Comment(
+            lecturer_id=lecturer.id,
+            subject="test_subject",
+            text="test_comment",
+            mark_kindness=mark,
+            mark_freebie=mark,
+            mark_clarity=mark,
+            review_status=ReviewStatus.PENDING,
+        )
+        for lecturer, mark in ((good, 2), (bad, -1))
+    ]
+    dbsession.add_all(comments)
+    dbsession.commit()
+    for comment in comments:
+        client.patch(f'/comment/{comment.uuid}/review', params={'review_status': 'approved'})
+    mean = (2 - 1) / 2
+    assert client.get(f'{url}/{unrated.id}').json()['mark_weighted'] == 0
+
+    refresher = WeightedMarksRefresher()
+    assert client.portal.call(refresher.refresh) == len(lecturers) - 1
+    assert client.get(f'{url}/{good.id}').json()['mark_weighted'] == pytest.approx(calc_weighted_mark(2, 1, mean))
+    assert client.get(f'{url}/{unrated.id}').json()['mark_weighted'] == pytest.approx(mean)
+    # Средняя не изменилась: пересчитывать нечего
+    assert client.portal.call(refresher.refresh) == 0
+
+
+@pytest.mark.usefixtures('lecturers_with_comments')
+@pytest.mark.parametrize(
+    'order_by', ['mark_weighted', '-mark_kindness', 'mark_general', 'last_name', '-last_name', 'relevance']
+)
+def test_get_lecturers_cursor(client, order_by):
+    """Страницы по next_cursor совпадают с выдачей одним запросом"""
+    expected = [lecturer['id'] for lecturer in client.get(url, params={'order_by': order_by}).json()['lecturers']]
+    lecturer_ids, params = [], {'order_by': order_by, 'limit': 1}
+    while True:
+        response = client.get(url, params=params)
+        assert response.status_code == status.HTTP_200_OK
+        lecturer_ids += [lecturer['id'] for lecturer in response.json()['lecturers']]
+        if response.json()['next_cursor'] is None:
+            break
+        params['cursor'] = response.json()['next_cursor']
+    assert lecturer_ids == expected
+
+
+@pytest.mark.usefixtures('lecturers_with_comments')
+def test_get_lecturers_invalid_cursor(client):
+    cursor = client.get(url, params={'order_by': 'last_name', 'limit': 1}).json()['next_cursor']
+    response = client.get(url, params={'order_by': '-last_name', 'cursor': cursor})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    response = client.get(url, params={'cursor': 'not-a-cursor'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.parametrize(
+    'path, params, index',
+    [
+        ('/timetable-id/2004242', {}, 'ix_lecturer_timetable_id'),
+        # Сортировка по оценке идет по подзапросу в lecturer_stats для каждого преподавателя
+        ('', {'order_by': '-mark_kindness'}, 'lecturer_stats_pkey'),
+        ('', {'mark': 1}, 'ix_lecturer_stats_mark_general'),
+        ('', {'name': 'lastname4242 firstname4242'}, 'ix_lecturer_search_name_trgm'),
+        ('', {'subject': 'subject142'}, 'ix_lecturer_subject_search_subject_trgm'),
+        ('', {'subject': 'бs'}, 'ix_lecturer_subject_search_subject'),
+        # Место считается числом преподавателей с большей оценкой
+        ('/2004242', {}, 'ix_lecturer_mark_weighted'),
+    ],
+    ids=['by_timetable_id', 'by_mark_kindness', 'by_mark', 'by_name', 'by_subject', 'by_subject_prefix', 'rank'],
+)
+def test_get_lecturers_uses_index(client, planner_dataset, explain, path, params, index):
+    """Запросы GET /lecturer должны идти по индексам, а не сканировать таблицы"""
+    with explain() as plans:
+        assert client.get(f'{url}{path}', params=params).status_code == status.HTTP_200_OK
+    assert f' {index} ' in "\n".join(plans)
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    'query',
+    [
+        {},
+        {'order_by': '-mark_general'},
+        {'mark': 0},
+        {'subject': 'subject1', 'name': 'lastname'},
+        {'offset': 9000},
+    ],
+    ids=['default', 'order_by_mark_general', 'mark', 'subject_and_name', 'last_pages'],
+)
+def test_get_lecturers_benchmark(client, dbsession, large_dataset, timeit, query):
+    """Задержка GET /lecturer и подсчета total на 10k преподавателей и 500k отзывов"""
+    response = timeit(f'GET /lecturer {query}', lambda: client.get(url, params=query)).result
+    assert response.status_code == status.HTTP_200_OK
+
+    # Прежний подсчет total: сгруппированный и отсортированный запрос с join, обернутый в подзапрос
+    grouped_query = (
+        select(Lecturer.id)
+        .outerjoin(Lecturer.comments)
+        .where(~Lecturer.is_deleted, Lecturer.search_by_mark(query.get('mark')))
+        .group_by(Lecturer.id)
+        .order_by(*Lecturer.order_by_mark('mark_weighted', False))
+    )
+    if 'subject' in query:
+        grouped_query = grouped_query.where(Lecturer.search_by_subject(query['subject']))
+    if 'name' in query:
+        grouped_query = grouped_query.where(Lecturer.search_by_name(query['name']))
+    grouped_total = timeit(
+        'total через группировку',
+        lambda: dbsession.scalar(select(func.count()).select_from(grouped_query.subquery())),
+        repeat=3,
+    ).result
+    assert response.json()['total'] == grouped_total
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize(
+    'name',
+    ['Lastname1234', 'Lastname1234 Firstname1234', 'Lastnme1234 Firstname1234 Middlename1234'],
+    ids=['one_word', 'two_words', 'three_words_with_typo'],
+)
+def test_search_by_name_benchmark(client, dbsession, large_dataset, timeit, name):
+    """Поиск по ФИО на 10k преподавателей: триграммный индекс против прежнего LIKE по трем колонкам"""
+    response = timeit(
+        f'GET /lecturer?name={name}', lambda: client.get(url, params={'name': name, 'order_by': 'relevance'})
+    ).result
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['lecturers'][0]['id'] == 1_001_234
+
+    # Одинаковые запросы подсчета: условие поиска ручки и прежняя подстрока в lower() каждой из колонок
+    trigram_query = select(func.count()).where(~Lecturer.is_deleted, Lecturer.search_by_name(name))
+    like_query = select(func.count()).where(
+        ~Lecturer.is_deleted,
+        *[
+            func.lower(Lecturer.first_name).contains(word)
+            | func.lower(Lecturer.middle_name).contains(word)
+            | func.lower(Lecturer.last_name).contains(word)
+            for word in name.lower().split()
+        ],
+    )
+    trigram_total = timeit('count по триграммному индексу', lambda: dbsession.scalar(trigram_query)).result
+    like_total = timeit('count по LIKE', lambda: dbsession.scalar(like_query)).result
+    # Поиск по индексу находит все, что находил LIKE, и вдобавок слова с опечатками
+    assert trigram_total == response.json()['total']
+    assert trigram_total >= like_total
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize('q', ['Lastname1', 'Lastname1234 F', 'Middlename99 Firstname9'])
+def test_suggest_lecturers_benchmark(client, large_dataset, timeit, q):
+    """Задержка подсказок на 10k преподавателей: поиск в индексе и ответ ручки целиком"""
+    client.get(f'{url}/suggest', params={'q': q})
+    found = timeit('поиск в индексе', lambda: suggest_index.lookup(q, 10), repeat=100)
+    response = timeit(f'GET /lecturer/suggest?q={q}', lambda: client.get(f'{url}/suggest', params={'q': q}), repeat=100)
+    assert response.result.status_code == status.HTTP_200_OK and found.result
+    assert [lecturer['id'] for lecturer in response.result.json()] == [lecturer.id for lecturer in found.result]
+    # Поиск в индексе - малая доля ответа, остальное - HTTP и сериализация
+    assert found.p95 < response.p50 / 10
+
+
+@pytest.mark.benchmark
+def test_lecturer_rank_benchmark(client, dbsession, large_dataset, timeit):
+    """Места преподавателей среди 10k в карточке и в списке совпадают с rank() полного пересчета"""
+    lecturers_count, _ = large_dataset
+    assert client.post(f'{url}/recompute_rating').status_code == status.HTTP_200_OK
+    lecturer_ids = [1_000_001 + n * 97 % lecturers_count for n in range(100)]
+    requests = iter(lecturer_ids)
+    timeit(f'GET /lecturer/{{id}} с местом среди {lecturers_count}', lambda: client.get(f'{url}/{next(requests)}'), 100)
+    for lecturer_id in lecturer_ids:
+        assert client.get(f'{url}/{lecturer_id}').json()['rank'] == dbsession.get(Lecturer, lecturer_id).rank
+    # Страница из глубины рейтинга: места всех строк считаются одним rank() на запрос
+    params = {'order_by': '-mark_weighted', 'limit': 100, 'offset': lecturers_count // 2}
+    listed = timeit(f'GET /lecturer, 100 мест среди {lecturers_count}', lambda: client.get(url, params=params))
+    # Подзапрос места на каждую строку отвечал здесь секунды
+    assert listed.p95 < 0.5
+    page = client.get(url, params=params).json()['lecturers']
+    assert len(page) == 100
+    for lecturer in page:
+        assert lecturer['rank'] == dbsession.get(Lecturer, lecturer['id']).rank